@@ -46,6 +46,8 @@ from iscesys.Component.ProductManager import ProductManager
 from iscesys.DateTimeUtil.DateTimeUtil import DateTimeUtil as DTUtil
 import os
 import glob
+import json
+import bisect
 import numpy as np
 import shelve
 
@@ -822,49 +824,32 @@ class Sentinel1(Component):
         Extract precise orbit from given Orbit file.
         '''
         try:
-            fp = open(self.orbitFile,'r')
+            times, states, qualities = s1_readOrbitStateVectors(self.orbitFile)
         except IOError as strerr:
             print("IOError: %s" % strerr)
             return
 
-        _xml_root = ET.ElementTree(file=fp).getroot()
-       
-        node = _xml_root.find('Data_Block/List_of_OSVs')
-
         print('Extracting orbit from Orbit File: ', self.orbitFile)
         orb = Orbit()
         orb.configure()
 
-        margin = datetime.timedelta(seconds=margin)
-        tstart = self.product.bursts[0].sensingStart - margin
-        tend = self.product.bursts[-1].sensingStop + margin
-
-        for child in node.getchildren():
-            timestamp = self.convertToDateTime(child.find('UTC').text[4:])
-
-            if (timestamp >= tstart) and (timestamp < tend):
-
-                pos = [] 
-                vel = []
-
-                for tag in ['VX','VY','VZ']:
-                    vel.append(float(child.find(tag).text))
-
-                for tag in ['X','Y','Z']:
-                    pos.append(float(child.find(tag).text))
+        tstart = s1_toEpoch(self.product.bursts[0].sensingStart) - margin
+        tend = s1_toEpoch(self.product.bursts[-1].sensingStop) + margin
 
-                ###Warn if state vector quality is not nominal
-                quality = child.find('Quality').text.strip()
-                if quality != 'NOMINAL':
-                    print('WARNING: State Vector at time {0} tagged as {1} in orbit file {2}'.format(timestamp, quality, self.orbitFile))
+        ####State vectors are sorted by time
+        for ind in range(np.searchsorted(times, tstart), np.searchsorted(times, tend)):
+            timestamp = S1_EPOCH + datetime.timedelta(microseconds=int(round(times[ind] * 1.0e6)))
 
-                vec = StateVector()
-                vec.setTime(timestamp)
-                vec.setPosition(pos)
-                vec.setVelocity(vel)
-                orb.addStateVector(vec)
+            ###Warn if state vector quality is not nominal
+            quality = str(qualities[ind])
+            if quality != 'NOMINAL':
+                print('WARNING: State Vector at time {0} tagged as {1} in orbit file {2}'.format(timestamp, quality, self.orbitFile))
 
-        fp.close()
+            vec = StateVector()
+            vec.setTime(timestamp)
+            vec.setPosition(states[ind, 0:3].tolist())
+            vec.setVelocity(states[ind, 3:6].tolist())
+            orb.addStateVector(vec)
 
         return orb
 
@@ -1216,6 +1201,181 @@ Sentinel-1A specific utilities.
 '''
 #################
 
+####Index of the validity intervals of the orbit and aux files of a directory
+####kept in memory and in <dir>/.s1_index/ (a subdirectory, so that writing it does not change the directory)
+S1_INDEX_DIR = '.s1_index'
+S1_INDEX_FILE = 'file_index.json'
+S1_INDEX_VERSION = 1
+S1_EPOCH = datetime.datetime(1970, 1, 1)
+_s1_fileIndices = {}
+
+def s1_toEpoch(timeStamp):
+    '''
+    Seconds since 1970 of a (UTC) datetime.
+    '''
+    return (timeStamp - S1_EPOCH).total_seconds()
+
+def s1_parseFileName(name):
+    '''
+    Returns key (e.g. S1A_POEORB, S1A_AUX_CAL), start and end of validity (epoch seconds) of an orbit file
+    (S1A_OPER_AUX_POEORB_OPOD_...) or aux file (S1A_AUX_CAL_...), None for other files.
+    '''
+    datefmt = "%Y%m%dT%H%M%S"
+    fields = name.split('_')
+    try:
+        if len(fields) > 6 and fields[1:3] == ['OPER', 'AUX'] and fields[4].startswith('OPOD'):
+            key = fields[0] + '_' + fields[3]
+            taft = datetime.datetime.strptime(fields[-1][0:15], datefmt)
+        elif len(fields) > 4 and fields[1:3] == ['AUX', 'CAL']:
+            key = fields[0] + '_AUX_CAL'
+            taft = datetime.datetime.strptime(fields[-1][1:16], datefmt)
+        else:
+            return None
+        tbef = datetime.datetime.strptime(fields[-2][1:16], datefmt)
+    except ValueError:
+        return None
+
+    return [key, int(s1_toEpoch(tbef)), int(s1_toEpoch(taft))]
+
+def s1_readFileIndex(directory):
+    try:
+        with open(os.path.join(directory, S1_INDEX_DIR, S1_INDEX_FILE), 'r') as fid:
+            index = json.load(fid)
+    except (IOError, ValueError):
+        return None
+
+    if index.get('version') != S1_INDEX_VERSION:
+        return None
+    return index
+
+def s1_writeFileIndex(directory, index):
+    '''
+    Writes the index if the directory is writable (the index is only kept in memory otherwise).
+    '''
+    indexDir = os.path.join(directory, S1_INDEX_DIR)
+    tmpFile = os.path.join(indexDir, S1_INDEX_FILE + '.' + str(os.getpid()))
+    try:
+        os.makedirs(indexDir, exist_ok=True)
+        with open(tmpFile, 'w') as fid:
+            json.dump(index, fid, separators=(',', ':'))
+        os.replace(tmpFile, os.path.join(indexDir, S1_INDEX_FILE))
+    except (IOError, OSError):
+        pass
+
+    return
+
+def s1_getFileIndex(directory):
+    '''
+    Returns the validity intervals of the orbit and aux files of a directory sorted by start of validity:
+    {key: {'tbef': [...], 'taft': [...], 'name': [...], 'maxlen': longest interval}}.
+    Only the file names added since the index was written are parsed when the directory changed.
+    '''
+    mtime = os.stat(directory).st_mtime_ns
+    index = _s1_fileIndices.get(directory)
+    if index is not None and index['mtime'] == mtime:
+        return index['intervals']
+
+    if index is None:
+        index = s1_readFileIndex(directory)
+
+    if index is None or index['mtime'] != mtime:
+        known = {} if index is None else index['files']
+        files = {}
+        for name in os.listdir(directory):
+            entry = known.get(name) or s1_parseFileName(name)
+            if entry is not None:
+                files[name] = entry
+        index = {'version': S1_INDEX_VERSION, 'mtime': mtime, 'files': files}
+        s1_writeFileIndex(directory, index)
+
+    intervals = {}
+    for name, (key, tbef, taft) in sorted(index['files'].items(), key=lambda x: x[1][1]):
+        item = intervals.setdefault(key, {'tbef': [], 'taft': [], 'name': [], 'maxlen': 0})
+        item['tbef'].append(tbef)
+        item['taft'].append(taft)
+        item['name'].append(name)
+        item['maxlen'] = max(item['maxlen'], taft - tbef)
+
+    index['intervals'] = intervals
+    _s1_fileIndices[directory] = index
+    return intervals
+
+def s1_findIntervals(intervals, tstart, tstop):
+    '''
+    Returns (name, tbef, taft) of the files valid from tstart to tstop (epoch seconds). Only files starting
+    less than the longest interval before tstart are checked.
+    '''
+    match = []
+    if intervals is None:
+        return match
+
+    ind = bisect.bisect_right(intervals['tbef'], tstart)
+    while (ind > 0) and (intervals['tbef'][ind-1] >= tstart - intervals['maxlen']):
+        ind -= 1
+        if intervals['taft'][ind] >= tstop:
+            match.append((intervals['name'][ind], intervals['tbef'][ind], intervals['taft'][ind]))
+
+    return match
+
+####State vectors of the orbit files parsed once and cached as <orbit dir>/.s1_index/<orbit file>.npz
+S1_ORBIT_CACHE_VERSION = 1
+####Orbit files kept in memory
+S1_ORBIT_CACHE_SIZE = 8
+_s1_orbitVectors = {}
+
+def s1_parseOrbitFile(orbitFile):
+    '''
+    Returns times (seconds since 1970), state vectors (X, Y, Z, VX, VY, VZ) and quality of the OSVs of an orbit file.
+    '''
+    with open(orbitFile, 'r') as fp:
+        node = ET.ElementTree(file=fp).getroot().find('Data_Block/List_of_OSVs')
+
+    osvs = list(node)
+    times = np.array([child.find('UTC').text[4:].strip() for child in osvs], dtype='datetime64[us]')
+    times = (times - np.datetime64('1970-01-01T00:00:00', 'us')).astype(np.int64) / 1.0e6
+    states = np.array([[float(child.find(tag).text) for tag in ['X','Y','Z','VX','VY','VZ']] for child in osvs],
+                      dtype=np.float64).reshape(-1, 6)
+    qualities = np.array([child.find('Quality').text.strip() for child in osvs], dtype=np.str_)
+
+    indices = np.argsort(times, kind='stable')
+    return times[indices], states[indices], qualities[indices]
+
+def s1_readOrbitStateVectors(orbitFile):
+    '''
+    Returns times, state vectors and quality of the OSVs of an orbit file (see s1_parseOrbitFile) from the cache.
+    The orbit file is parsed if it is not cached or changed since it was cached (size, mtime).
+    '''
+    stat = os.stat(orbitFile)
+    signature = [S1_ORBIT_CACHE_VERSION, stat.st_size, stat.st_mtime_ns]
+    if orbitFile in _s1_orbitVectors and _s1_orbitVectors[orbitFile][0] == signature:
+        return _s1_orbitVectors[orbitFile][1]
+
+    cacheFile = os.path.join(os.path.dirname(orbitFile), S1_INDEX_DIR, os.path.basename(orbitFile) + '.npz')
+    vectors = None
+    try:
+        with np.load(cacheFile) as data:
+            if data['signature'].tolist() == signature:
+                vectors = (data['times'], data['states'], data['qualities'])
+    except Exception:
+        pass
+
+    if vectors is None:
+        vectors = s1_parseOrbitFile(orbitFile)
+        tmpFile = cacheFile + '.' + str(os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+            with open(tmpFile, 'wb') as fid:
+                np.savez(fid, signature=np.array(signature, dtype=np.int64), times=vectors[0], states=vectors[1],
+                         qualities=vectors[2])
+            os.replace(tmpFile, cacheFile)
+        except (IOError, OSError):
+            pass
+
+    if len(_s1_orbitVectors) >= S1_ORBIT_CACHE_SIZE:
+        del _s1_orbitVectors[next(iter(_s1_orbitVectors))]
+    _s1_orbitVectors[orbitFile] = (signature, vectors)
+    return vectors
+
 def s1_findAuxFile(auxDir, timeStamp, mission='S1A'):
     '''
     Find appropriate auxiliary information file based on time stamps.
@@ -1224,23 +1384,12 @@ def s1_findAuxFile(auxDir, timeStamp, mission='S1A'):
     if auxDir is None:
         return
 
-    datefmt = "%Y%m%dT%H%M%S"
-        
-    match = []
+    tstamp = s1_toEpoch(timeStamp)
 
-    files = glob.glob(os.path.join(auxDir, mission+'_AUX_CAL_*'))
-        
-    ###List all AUX files
+    ###List all AUX files defined prior to the acquisition
     ### Bugfix: Bekaert David [DB 03/2017] : Give the latest generated AUX file
-    for result in files:
-        fields = result.split('_')
-        
-        taft = datetime.datetime.strptime(fields[-1][1:16], datefmt)
-        tbef = datetime.datetime.strptime(fields[-2][1:16], datefmt)
-        
-        ##### Get all AUX files defined prior to the acquisition
-        if (tbef <= timeStamp) and (taft >= timeStamp):
-            match.append((result, abs((timeStamp-taft).total_seconds())))
+    match = [(os.path.join(auxDir, name), abs(tstamp - taft)) for name, tbef, taft in
+             s1_findIntervals(s1_getFileIndex(auxDir).get(mission + '_AUX_CAL'), tstamp, tstamp)]
    
     ##### Return the latest generated AUX file 
     if len(match) != 0:
@@ -1261,25 +1410,18 @@ def s1_findOrbitFile(orbitDir, tstart, tstop, mission='S1A'):
     Find correct orbit file in the orbit directory.
     '''
 
-    datefmt = "%Y%m%dT%H%M%S"
     types = ['POEORB', 'RESORB']
     match = []
 
-    timeStamp = tstart + 0.5 * (tstop - tstart)
+    timeStamp = s1_toEpoch(tstart + 0.5 * (tstop - tstart))
+    intervals = s1_getFileIndex(orbitDir)
 
     for orbType in types:
-        files = glob.glob( os.path.join(orbitDir, mission+'_OPER_AUX_' + orbType + '_OPOD*'))
-            
-        ###List all orbit files
-        for result in files:
-            fields = result.split('_')
-            taft = datetime.datetime.strptime(fields[-1][0:15], datefmt)
-            tbef = datetime.datetime.strptime(fields[-2][1:16], datefmt)
-                
-            #####Get all files that span the acquisition
-            if (tbef <= tstart) and (taft >= tstop):
-                tmid = tbef + 0.5 * (taft - tbef)
-                match.append((result, abs((timeStamp-tmid).total_seconds())))
+        #####Get all files that span the acquisition
+        for name, tbef, taft in s1_findIntervals(intervals.get(mission + '_' + orbType),
+                                                 s1_toEpoch(tstart), s1_toEpoch(tstop)):
+            tmid = tbef + 0.5 * (taft - tbef)
+            match.append((os.path.join(orbitDir, name), abs(timeStamp - tmid)))
 
         #####Return the file with the image is aligned best to the middle of the file
         if len(match) != 0:
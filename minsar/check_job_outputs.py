@@ -4,7 +4,6 @@
 #######################
 import argparse
 import os
-from minsar.job_submission import check_words_in_file
 import minsar.utils.process_utilities as putils
 import numpy as np
 import shutil
@@ -54,6 +53,7 @@ def main(iargs=None):
         run_file = job_name
 
     matched_error_strings = []
+    files_to_check = []
     for job_file in job_files:
        print('checking:  ' + job_file)
        job_name = job_file.split('.')[0]
@@ -69,11 +69,17 @@ def main(iargs=None):
        error_files = natsorted(error_files)
        out_files = natsorted(out_files)
 
-       for file in error_files + out_files:
-           for error_string in error_strings:
-               if check_words_in_file(file, error_string):
-                   matched_error_strings.append('Error: \"' + error_string + '\" found in ' + file + '\n')
-                   print( 'Error: \"' + error_string + '\" found in ' + file )
+       files_to_check.extend(error_files + out_files)
+
+    # all files are read once and in parallel
+    matches = putils.scan_files_for_strings(files_to_check, error_strings)
+    for file in files_to_check:
+       for error_string in error_strings:
+           line_numbers = [str(x[0]) for x in matches.get(file, []) if x[1] == error_string]
+           if len(line_numbers) > 0:
+               message = 'Error: \"' + error_string + '\" found in ' + file + ' (lines ' + ','.join(line_numbers) + ')'
+               matched_error_strings.append(message + '\n')
+               print(message)
 
     if len(matched_error_strings) != 0:
         with open(run_file + '_error_matches.e', 'w') as f:
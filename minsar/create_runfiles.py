@@ -14,6 +14,8 @@ from minsar.utils.stack_run import CreateRun
 import minsar.utils.process_utilities as putils
 from minsar.job_submission import JOB_SUBMIT
 from minsar.objects.unpack_sensors import Sensors
+from minsar.objects.execution_state import ExecutionState
+from minsar.objects.download_pipeline import DownloadPipeline, has_prepared_dates
 
 pathObj = PathFind()
 
@@ -89,7 +91,15 @@ def main(iargs=None):
 
     inps.Stack_template = pathObj.correct_for_isce_naming_convention(inps)
     runObj = CreateRun(inps)
-    runObj.run_stack_workflow()
+
+    # the dates unpacked while downloading (process_rsmas.py --pipeline) are kept and their tasks recorded as completed
+    pipeline = None
+    if inps.prefix == 'tops' and has_prepared_dates(inps.work_dir):
+        pipeline = DownloadPipeline(inps.work_dir, inps.template)
+        with pipeline.keep_prepared_dates():
+            runObj.run_stack_workflow()
+    else:
+        runObj.run_stack_workflow()
 
     run_file_list = putils.make_run_list(inps.work_dir)
 
@@ -97,6 +107,9 @@ def main(iargs=None):
         for item in run_file_list:
             run_file.writelines(item + '\n')
 
+    if pipeline is not None:
+        pipeline.record_prepared_tasks(ExecutionState(inps.work_dir))
+
     if inps.prefix == 'tops':
         # check for orbits
         orbit_dir = os.getenv('SENTINEL_ORBITS')
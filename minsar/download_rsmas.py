@@ -97,33 +97,36 @@ def main(iargs=None):
     download('ssara', inps.custom_template_file, download_dir, outnum=1)
     #download('asfserial', inps.custom_template_file, download_dir, outnum = 1)
 
+    # files are verified while downloading (checksum, zip central directory). Only files that were not verified are
+    # checked, and the download skips verified files, so that only the failed granules are downloaded again
     for i_download in [2, 3]:
-        download_success = run_check_download(download_dir = download_dir)
+        bad_files = run_check_download(download_dir = download_dir)
 
-        if not download_success:
-           print('check_download.py: There were bad files, download again')
-           message_rsmas.log(inps.work_dir,'check_download.py: there were bad files, download again')
+        if len(bad_files) > 0:
+           print('check_download.py: There were bad files, download again: {}'.format(' '.join(bad_files)))
+           message_rsmas.log(inps.work_dir,'check_download.py: there were bad files, download again: {}'.format(
+               ' '.join(bad_files)))
 
            download('ssara', inps.custom_template_file, download_dir, outnum = i_download)
            #download('asfserial', inps.custom_template_file, download_dir, outnum = i_download)
+        else:
+           break
 
 ###########################################################################################
 
 def run_check_download(download_dir):
     """ 
-    Runs check_download script and returns True if all *zip files are fine and False otherwise.
+    Runs check_download script on the *zip files that were not verified while downloading and removes bad files.
     :param download_dir: SLC/download directory to check
+    :return: list of bad files
     """
     f = io.StringIO()
     with redirect_stdout(f):
-        check_download.main([download_dir, '--delete'])
-        out = f.getvalue()
-   
-    if 'Broken zipfiles' in out or 'Files with ' in out:
+        bad_files = check_download.main([download_dir, '--delete'])
+
+    if len(bad_files) > 0:
         print ('Bad downloads found')
-        return False
-    else:
-        return True
+    return bad_files
 
 ###########################################################################################
 
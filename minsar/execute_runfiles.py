@@ -9,12 +9,20 @@ import time
 import datetime
 from minsar.objects import message_rsmas
 import minsar.utils.process_utilities as putils
-from minsar.job_submission import JOB_SUBMIT
+from minsar.job_submission import JOB_SUBMIT, cancel_jobs, get_job_dependencies, query_job_states, is_array_job_file
+from minsar.objects.auto_defaults import supported_platforms
+from minsar.objects.execution_state import ExecutionState
 
 import warnings
 # warnings.filterwarnings("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore")
 
+# suffix of the batch file with the remaining tasks of a partially processed run file
+RESUME_SUFFIX = putils.RESUME_SUFFIX
+# schedulers for which query_job_states reports failed jobs as FAILED (SLURM: sacct state, LSF: EXIT,
+# PBS: Exit_status, dependents deleted by PBS never ran and are FAILED), required to stop a chain at a failure
+CHAIN_SCHEDULERS = ['SLURM', 'LSF', 'PBS']
+
 ##############################################################################
 
 
@@ -66,22 +74,34 @@ def main(iargs=None):
 
     run_file_list = run_file_list[inps.start_run:inps.end_run]
 
-    for item in run_file_list:
-        putils.remove_last_job_running_products(run_file=item)
-        
-        job_obj.write_batch_jobs(batch_file=item)
-        job_status = job_obj.submit_batch_jobs(batch_file=item)
+    state = ExecutionState(inps.work_dir)
+    job_obj.execution_state = state
+
+    if inps.resume_flag:
+        run_file_list = get_run_files_to_resume(run_file_list, state, job_obj)
+        if len(run_file_list) == 0:
+            print('All run files have been completed')
+            return
 
-        if job_status:
+    if (inps.chain_flag or inps.dag_flag) and not job_obj.scheduler in CHAIN_SCHEDULERS:
+        print('WARNING: failed jobs can not be detected with scheduler {}, run files are submitted one after the '
+              'other'.format(job_obj.scheduler))
 
-            putils.remove_zero_size_or_length_error_files(run_file=item)
-            putils.rerun_job_if_exit_code_140(run_file=item, inps_dict=inps)
-            putils.raise_exception_if_job_exited(run_file=item)
-            putils.concatenate_error_files(run_file=item, work_dir=inps.work_dir)
-            putils.move_out_job_files_to_stdout(run_file=item)
+    if (inps.chain_flag or inps.dag_flag) and job_obj.platform_name in supported_platforms and \
+            job_obj.scheduler in CHAIN_SCHEDULERS:
+        run_chained_jobs(job_obj, run_file_list, inps)
+    else:
+        for item in run_file_list:
+            putils.remove_last_job_running_products(run_file=item)
+            state.start_run_file(get_run_file_of_batch_file(item))
 
-            date_str = datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d:%H%M%S')
-            print(date_str + ' * Job {} completed'.format(item))
+            job_obj.write_batch_jobs(batch_file=item)
+            job_status = job_obj.submit_batch_jobs(batch_file=item)
+
+            if job_status:
+                check_outputs_of_run_file(item, inps)
+
+            record_completed_run_file(state, item)
 
     date_str = datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d:%H%M%S')
     print(date_str + ' * all jobs from {} to {} have been completed'.format(os.path.basename(run_file_list[0]),
@@ -90,6 +110,156 @@ def main(iargs=None):
     return
 
 
+def check_outputs_of_run_file(run_file, inps):
+    """ checks the job outputs of a completed run file, reruns jobs that exceeded walltime and cleans up """
+
+    putils.remove_zero_size_or_length_error_files(run_file=run_file)
+    putils.rerun_job_if_exit_code_140(run_file=run_file, inps_dict=inps)
+    putils.raise_exception_if_job_exited(run_file=run_file)
+    putils.concatenate_error_files(run_file=run_file, work_dir=inps.work_dir)
+    putils.move_out_job_files_to_stdout(run_file=run_file)
+
+    date_str = datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d:%H%M%S')
+    print(date_str + ' * Job {} completed'.format(run_file))
+
+    return
+
+
+def get_run_files_to_resume(run_file_list, state, job_obj):
+    """
+    Skips the run files completed since they were last changed. For a partially processed run file, waits for its
+    jobs that are still queued or running (e.g. after a crash of the login node) and writes the tasks that did not
+    complete into <run_file>_resume.
+    :param run_file_list: run files to process
+    :param state: ExecutionState of the work directory
+    :param job_obj: JOB_SUBMIT object
+    :return: run files or *_resume files to process
+    """
+
+    batch_files = []
+    for run_file in run_file_list:
+        status = state.get_run_file_status(run_file)
+        if status == 'completed':
+            print('Skipping {}: completed'.format(os.path.basename(run_file)))
+            continue
+        if status == 'changed':
+            batch_files.append(run_file)
+            continue
+
+        job_numbers, job_files = state.get_unfinished_jobs(run_file)
+        if len(job_numbers) > 0 and job_obj.platform_name in supported_platforms:
+            array_jobs = [job_number for job_number, job_file in zip(job_numbers, job_files)
+                          if is_array_job_file(os.path.join(os.path.dirname(run_file), job_file))]
+            job_obj.array_jobs.update(array_jobs)
+            job_states = query_job_states(job_numbers, job_obj.scheduler, array_jobs)
+            active_jobs = [(job_number, job_file) for job_number, job_file in zip(job_numbers, job_files)
+                           if job_states.get(job_number) in ['PENDING', 'RUNNING']]
+            if len(active_jobs) > 0:
+                print('Waiting for {} jobs of {} submitted before'.format(len(active_jobs), os.path.basename(run_file)))
+                job_obj.wait_for_jobs([x[0] for x in active_jobs], [x[1] for x in active_jobs],
+                                      work_dir=os.path.dirname(run_file))
+            state.update_job_states({job_number: job_states.get(job_number, 'UNKNOWN') for job_number in job_numbers
+                                     if not job_states.get(job_number) in ['PENDING', 'RUNNING']})
+
+        state.add_tasks(run_file, putils.get_task_exit_codes(run_file))
+        completed_tasks = state.get_completed_tasks(run_file)
+
+        with open(run_file) as f:
+            tasks = f.readlines()
+        remaining_tasks = [task for task in tasks if not task.strip() in completed_tasks]
+
+        if len(remaining_tasks) == 0:
+            print('Skipping {}: all tasks completed'.format(os.path.basename(run_file)))
+            state.start_run_file(run_file)
+            state.finish_run_file(run_file)
+        elif len(remaining_tasks) < len(tasks):
+            print('Resuming {}: {} of {} tasks remaining'.format(os.path.basename(run_file), len(remaining_tasks),
+                                                                 len(tasks)))
+            with open(run_file + RESUME_SUFFIX, 'w') as f:
+                f.writelines(remaining_tasks)
+            batch_files.append(run_file + RESUME_SUFFIX)
+        else:
+            batch_files.append(run_file)
+
+    return batch_files
+
+
+def get_run_file_of_batch_file(batch_file):
+    """ returns the run file of a batch file created by get_run_files_to_resume """
+    return putils.strip_resume_suffix(batch_file)
+
+
+def record_completed_run_file(state, batch_file):
+    """ records the tasks of a processed run file and marks it completed """
+    run_file = get_run_file_of_batch_file(batch_file)
+    state.add_tasks(run_file, putils.get_task_exit_codes(run_file))
+    state.finish_run_file(run_file)
+    return
+
+
+def run_chained_jobs(job_obj, run_file_list, inps):
+    """
+    Writes the jobs of all run files up front and submits them at once. The jobs of each run file depend on the
+    successful completion of the jobs of the previous run file, so every step starts without waiting in the queue
+    again. With --dag a job only depends on the jobs of the previous run file processing the same dates, so that e.g.
+    merge_reference_secondary_slc of a date starts as soon as fullBurst_resample of this date is done.
+    If jobs time out, the remaining jobs are cancelled, the timed out jobs are rerun and the remaining run
+    files are submitted again.
+    :param job_obj: JOB_SUBMIT object
+    :param run_file_list: run files to process
+    :param inps: input arguments
+    """
+
+    job_files = {}
+    job_tasks = {}
+    for item in run_file_list:
+        putils.remove_last_job_running_products(run_file=item)
+        job_obj.execution_state.start_run_file(get_run_file_of_batch_file(item))
+        job_obj.write_batch_jobs(batch_file=item)
+        job_files[item] = job_obj.job_files
+        job_tasks[item] = job_obj.job_tasks
+
+    remaining_run_files = run_file_list
+    while len(remaining_run_files) > 0:
+        job_dependencies = None
+        if inps.dag_flag:
+            job_dependencies = [None] + [get_job_dependencies(job_tasks[previous], job_tasks[item]) for previous, item
+                                         in zip(remaining_run_files[:-1], remaining_run_files[1:])]
+
+        job_numbers = job_obj.submit_dependent_jobs([job_files[item] for item in remaining_run_files],
+                                                    work_dir=job_obj.out_dir, job_dependencies=job_dependencies)
+        time.sleep(2)
+
+        for index, item in enumerate(remaining_run_files):
+            job_states = job_obj.wait_for_jobs(job_numbers[index], job_files[item], work_dir=job_obj.out_dir)
+
+            if not all(state == 'COMPLETED' for state in job_states.values()):
+                cancel_jobs([x for numbers in job_numbers[index + 1:] for x in numbers], job_obj.scheduler)
+
+                failed_jobs = [job_file for job_number, job_file in zip(job_numbers[index], job_files[item])
+                               if job_states.get(job_number) == 'FAILED']
+                if len(failed_jobs) > 0:
+                    raise RuntimeError('Error: {} job was terminated with Error'.format(failed_jobs[0]))
+
+                # LSF jobs exceeding walltime are rerun by rerun_job_if_exit_code_140
+                if not job_obj.scheduler == 'LSF':
+                    job_obj.rerun_timed_out_jobs([job_file for job_number, job_file in
+                                                  zip(job_numbers[index], job_files[item])
+                                                  if job_states.get(job_number) == 'TIMEOUT'])
+
+            job_obj.check_job_error_files(job_files[item])
+            check_outputs_of_run_file(item, inps)
+            record_completed_run_file(job_obj.execution_state, item)
+
+            if not all(state == 'COMPLETED' for state in job_states.values()):
+                remaining_run_files = remaining_run_files[index + 1:]
+                break
+        else:
+            remaining_run_files = []
+
+    return
+
+
 ###########################################################################################
 
 if __name__ == "__main__":
@@ -20,6 +20,7 @@ multiTask_singleNode           ---> distribute tasks of a batch file into jobs w
 multiTask_multiNode            ---> submit tasks of a batch file in one job with required number of nodes
 launcher_multiTask_singleNode  ---> distribute tasks of a batch file into jobs with one node, submit with launcher
 launcher_multiTask_multiNode   ---> submit tasks of a batch file in one job with required number of nodes using launcher
+jobArray                       ---> submit tasks of a batch file as one array job, each array element runs one task
 
 """
 
@@ -31,8 +32,12 @@ import time
 import glob
 import numpy as np
 import math
+import heapq
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from minsar.objects import message_rsmas
 from minsar.objects.auto_defaults import queue_config_file, supported_platforms
+from minsar.objects.job_accounting import JobAccounting
 import warnings
 import minsar.utils.process_utilities as putils
 from datetime import datetime
@@ -40,6 +45,26 @@ import re
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
+# poll intervals (seconds) for checking job status
+MIN_POLL_INTERVAL = 10
+RUNNING_POLL_INTERVAL = 60
+PENDING_POLL_INTERVAL = 120
+POLL_BACKOFF_FACTOR = 1.5
+
+TERMINAL_JOB_STATES = ['COMPLETED', 'TIMEOUT', 'FAILED']
+# minimum number of finished tasks of a job to detect stragglers by the median task duration
+MIN_FINISHED_TASKS = 3
+# straggling tasks are migrated (restarted in a new job) after running this factor times the expected duration
+MIN_MIGRATION_FACTOR = 2
+# strings in .e files of jobs indicating a failed task
+JOB_ERROR_STRINGS = ['Segmentation fault', 'Aborted', 'ERROR', 'Error']
+# steps whose task walltime grows with the temporal baseline of the pair (decorrelation)
+BASELINE_COST_STEPS = ['filter_coherence', 'unwrap']
+# walltime increase of a pair with twice the median temporal baseline of its run file
+BASELINE_COST_FACTOR = 0.5
+# the memory of a task covering few bursts is not estimated below this fraction of the step memory
+MIN_MEMORY_FACTOR = 0.5
+
 
 def create_argument_parser():
     """
@@ -111,7 +136,8 @@ class JOB_SUBMIT:
 
         self.submission_scheme, self.platform_name, self.scheduler, self.queue_name, \
         self.number_of_cores_per_node, self.number_of_threads_per_core, self.max_jobs_per_queue, \
-        self.max_memory_per_node, self.wall_time_factor = set_job_queue_values(inps)
+        self.max_memory_per_node, self.wall_time_factor, self.resource_quantile, \
+        self.straggler_factor = set_job_queue_values(inps)
 
         if not 'num_bursts' in inps or not inps.num_bursts:
             self.num_bursts = None
@@ -134,6 +160,14 @@ class JOB_SUBMIT:
 
         self.email_notif = True
         self.job_files = []
+        self.job_tasks = []
+        self.number_of_job_tasks = {}
+        # tasks running at the same time on a node (LAUNCHER_PPN) of the launcher jobs of split_jobs
+        self.number_of_parallel_job_tasks = {}
+        # ExecutionState to record submitted jobs (set by execute_runfiles)
+        self.execution_state = None
+        # job numbers of submitted array jobs (queried as <job>[] on PBS)
+        self.array_jobs = set()
 
         try:
             dem_file = glob.glob(self.work_dir + '/DEM/*.wgs84')[0]
@@ -190,6 +224,7 @@ class JOB_SUBMIT:
         message_rsmas.log(self.work_dir, 'job_submission.py {a} --outdir {b} --writeonly'.format(a=batch_file, b=self.out_dir))
 
         self.job_files = []
+        self.job_tasks = []
 
         if self.platform_name in supported_platforms:
             print('\nWorking on a {} machine ...\n'.format(self.scheduler))
@@ -203,7 +238,11 @@ class JOB_SUBMIT:
             number_of_nodes = np.int(np.ceil(number_of_tasks * float(self.default_num_threads) / (
                     self.number_of_cores_per_node * self.number_of_threads_per_core)))
 
-            if 'singleTask' in self.submission_scheme:
+            if 'jobArray' in self.submission_scheme:
+
+                self.write_batch_array_job(batch_file, tasks)
+
+            elif 'singleTask' in self.submission_scheme:
 
                 self.write_batch_singletask_jobs(batch_file)
 
@@ -216,10 +255,18 @@ class JOB_SUBMIT:
                                                          number_of_nodes=number_of_nodes, work_dir=self.out_dir)
                 self.job_files.append(self.add_tasks_to_job_file_lines(job_file_lines, tasks,
                                                                        batch_file=batch_file_name))
+                self.job_tasks.append(tasks)
 
             elif 'multiTask_singleNode' in self.submission_scheme:
 
-                self.split_jobs(batch_file, tasks, number_of_nodes)
+                self.split_jobs(batch_file, tasks)
+
+        for job_file, job_tasks in zip(self.job_files, self.job_tasks):
+            # each element of an array job runs one task
+            if 'jobArray' in self.submission_scheme:
+                self.number_of_job_tasks[os.path.basename(job_file)] = 1
+            else:
+                self.number_of_job_tasks[os.path.basename(job_file)] = len(job_tasks)
 
         if len(self.job_files) > 0:
             for job_file in self.job_files:
@@ -242,35 +289,86 @@ class JOB_SUBMIT:
 
         else:
             print('\nWorking on a single machine ...\n')
-            system_path = os.getenv('PATH')
-            with open(batch_file, 'r') as f:
-                command_lines = f.readlines()
-                if self.prefix == 'stripmap':
-                    cmd = 'export PATH=$ISCE_STACK/stripmapStack:$PATH; '
-                else:
-                    cmd = 'export PATH=$ISCE_STACK/topsStack:$PATH; '
-                for command_line in command_lines:
-                    os.system(cmd + command_line)
-                    os.environ['PATH'] = system_path
+            self.run_batch_tasks_locally(batch_file)
 
             return False
 
-    def submit_single_job(self, job_file_name, work_dir):
+    def run_batch_tasks_locally(self, batch_file):
+        """
+        Runs the tasks of a batch file on the local machine with a pool of processes. The number of concurrent tasks
+        is limited by the available cores (num_threads of the step in job_defaults.cfg per task) and memory.
+        Outputs are written to <batch_file>_N.o and <batch_file>_N.e as in jobs without launcher.
+        :param batch_file: File containing the tasks
+        """
+
+        with open(batch_file, 'r') as f:
+            tasks = [x for x in f.readlines() if x.strip()]
+
+        if len(tasks) == 0:
+            return
+
+        self.get_memory_walltime(batch_file, job_type='batch')
+
+        number_of_threads = max(1, int(self.default_num_threads))
+        number_of_processes = max(1, (os.cpu_count() or 1) // number_of_threads)
+        try:
+            available_memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+            number_of_processes = min(number_of_processes, max(1, int(available_memory / float(self.default_memory))))
+        except (ValueError, TypeError, OSError):
+            pass
+        number_of_processes = min(number_of_processes, len(tasks))
+
+        environment = dict(os.environ)
+        environment['PATH'] = self.stack_path + ':' + environment['PATH']
+        environment['OMP_NUM_THREADS'] = str(number_of_threads)
+
+        def run_task(count):
+            out_file = os.path.abspath(batch_file) + '_{}.o'.format(count)
+            err_file = os.path.abspath(batch_file) + '_{}.e'.format(count)
+            with open(out_file, 'w') as out, open(err_file, 'w') as err:
+                return subprocess.call(tasks[count], shell=True, stdout=out, stderr=err, env=environment,
+                                       executable='/bin/bash')
+
+        print('Running {} tasks of {} with {} processes ({} threads each)'.format(
+            len(tasks), os.path.basename(batch_file), number_of_processes, number_of_threads))
+        with ThreadPoolExecutor(max_workers=number_of_processes) as executor:
+            exit_codes = list(executor.map(run_task, range(len(tasks))))
+
+        error_files = [os.path.abspath(batch_file) + '_{}.e'.format(count) for count in range(len(tasks))]
+        matches = putils.scan_files_for_strings(error_files, JOB_ERROR_STRINGS)
+        for count, exit_code in enumerate(exit_codes):
+            if not exit_code == 0 or error_files[count] in matches:
+                raise RuntimeError('Error in task {} of {} (exit code {}), see {}'.format(
+                    count, batch_file, exit_code, error_files[count]))
+
+        return
+
+    def submit_single_job(self, job_file_name, work_dir, dependencies=None):
         """
         Submit a single job (to bsub or qsub). Used by submit_jobs_individually and submit_job_with_launcher and submit_script.
         :param job_file_name: Name of job file to submit.
+        :param dependencies: job numbers that have to complete successfully before this job starts
         :return: Job number of submission
         """
         job_num_exists = True
         # use bsub or qsub to submit based on scheduler
         if self.scheduler == "LSF":
-            command = "bsub < " + os.path.join(work_dir, job_file_name)
+            dependency_option = ''
+            if dependencies:
+                dependency_option = '-w "{}" '.format(' && '.join('done({})'.format(x) for x in dependencies))
+            command = "bsub " + dependency_option + "< " + os.path.join(work_dir, job_file_name)
         elif self.scheduler == "PBS":
-            command = "qsub < " + os.path.join(work_dir, job_file_name)
+            dependency_option = ''
+            if dependencies:
+                dependency_option = '-W depend=afterok:{} '.format(':'.join(dependencies))
+            command = "qsub " + dependency_option + "< " + os.path.join(work_dir, job_file_name)
         elif self.scheduler == 'SLURM':
             hostname = subprocess.Popen("hostname", shell=True, stdout=subprocess.PIPE).stdout.read().decode("utf-8")
             if hostname.startswith('login') or hostname.startswith('comet'):
-                command = "sbatch {}".format(os.path.join(work_dir, job_file_name))
+                dependency_option = ''
+                if dependencies:
+                    dependency_option = '--dependency=afterok:{} --kill-on-invalid-dep=yes '.format(':'.join(dependencies))
+                command = "sbatch {}{}".format(dependency_option, os.path.join(work_dir, job_file_name))
             else:
                 # In case we are in compute note, only one job allowed at a time
                 command = "{}".format(os.path.join(work_dir, job_file_name))
@@ -278,16 +376,73 @@ class JOB_SUBMIT:
         else:
             raise Exception("ERROR: scheduler {0} not supported".format(self.scheduler))
 
+        if job_num_exists:
+            self.wait_for_queue_slot()
+
         output_job = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True)
 
         if job_num_exists:
             job_number = re.findall('\d+', output_job.decode("utf-8"))
             job_number = str(max([int(x) for x in job_number]))
+            if is_array_job_file(os.path.join(work_dir, job_file_name)):
+                self.array_jobs.add(job_number)
         else:
             job_number = 'None'
 
+        if self.execution_state and job_num_exists:
+            self.execution_state.add_job(job_number, job_file_name)
+
         return job_number
 
+    def wait_for_queue_slot(self):
+        """
+        Waits until the user has fewer than MAX_QUEUED_JOBS (environment variable set by run_operations.py for all
+        datasets) jobs queued or running
+        """
+        max_queued_jobs = os.getenv('MAX_QUEUED_JOBS')
+        if not max_queued_jobs:
+            return
+
+        poll_interval = MIN_POLL_INTERVAL
+        while query_queue_depth(self.scheduler) >= int(max_queued_jobs):
+            print('{} jobs queued (MAX_QUEUED_JOBS), waiting {} seconds to submit'.format(max_queued_jobs, poll_interval))
+            time.sleep(poll_interval)
+            poll_interval = min(PENDING_POLL_INTERVAL, poll_interval * POLL_BACKOFF_FACTOR)
+
+        return
+
+    def submit_dependent_jobs(self, job_file_lists, work_dir, job_dependencies=None):
+        """
+        Submits several lists of job files (e.g. the jobs of consecutive run files) without waiting. The jobs of each
+        list depend on the successful completion of all jobs of the previous list, or only of the jobs given in
+        job_dependencies.
+        :param job_file_lists: list of lists of job file names
+        :param work_dir: directory containing the job files
+        :param job_dependencies: for each list and job the indices of the jobs of the previous list it depends on
+                                 (see get_job_dependencies)
+        :return: list of lists of job numbers
+        """
+        job_numbers = []
+
+        for step, job_files in enumerate(job_file_lists):
+            numbers = []
+            for index, job_file_name in enumerate(job_files):
+                if step == 0:
+                    dependencies = None
+                elif job_dependencies is None:
+                    dependencies = job_numbers[-1]
+                else:
+                    dependencies = [job_numbers[-1][i] for i in job_dependencies[step][index]]
+
+                if dependencies:
+                    dependencies = [x for x in dependencies if not x == 'None']
+
+                os.system('chmod +x {}'.format(os.path.join(work_dir, job_file_name)))
+                numbers.append(self.submit_single_job(job_file_name, work_dir, dependencies=dependencies))
+            job_numbers.append(numbers)
+
+        return job_numbers
+
     def write_single_job_file(self, job_name, job_file_name, command_line, work_dir=None, number_of_nodes=1):
         """
         Writes a job file for a single job.
@@ -330,6 +485,59 @@ class JOB_SUBMIT:
         for i, command_line in enumerate(job_list):
             job_file_name = os.path.abspath(batch_file).split(os.sep)[-1] + "_" + str(i)
             self.write_single_job_file(job_file_name, job_file_name, command_line, work_dir=self.out_dir)
+            self.job_tasks.append([command_line])
+
+        return
+
+    def write_batch_array_job(self, batch_file, tasks):
+        """
+        Writes one array job for all tasks of a batch file. Array element i runs line i of the task file
+        <batch_file>_0, so that all tasks are submitted with one sbatch/bsub/qsub call. At most MAX_JOBS_PER_QUEUE
+        elements run at the same time (SLURM, LSF).
+        :param batch_file: File containing the tasks
+        :param tasks: lines of the batch file
+        """
+
+        batch_file_name = batch_file + '_0'
+        job_name = os.path.basename(batch_file_name)
+
+        task_lines = []
+        for count, line in enumerate(tasks):
+            status_file = putils.get_task_status_file(batch_file_name, count)
+            os.makedirs(os.path.dirname(status_file), exist_ok=True)
+            if os.path.exists(status_file):
+                os.remove(status_file)
+            task_lines.append(putils.add_task_status_markers(line, status_file))
+
+        with open(batch_file_name, 'w') as batch_f:
+            batch_f.writelines(task_lines)
+
+        job_file_lines = self.get_job_file_lines(job_name, job_name, work_dir=self.out_dir, number_of_nodes=1,
+                                                 array_size=len(tasks))
+
+        if self.scheduler == 'LSF':
+            task_id = '$LSB_JOBINDEX'
+        elif self.scheduler == 'PBS':
+            task_id = '${PBS_ARRAY_INDEX:-$PBS_ARRAYID}'
+        else:
+            task_id = '$SLURM_ARRAY_TASK_ID'
+
+        job_file_lines.append("\n\nexport OMP_NUM_THREADS={0}".format(self.default_num_threads))
+        job_file_lines.append("\nexport PATH={0}:$PATH".format(self.stack_path))
+        job_file_lines.append("\nexport ARRAY_TASK_FILE={0}\n".format(os.path.abspath(batch_file_name)))
+        # without array index (job run directly on a compute node) all tasks are run one after the other
+        job_file_lines.append('\ntask_ids={0}'.format(task_id))
+        job_file_lines.append('\nif [ -z "$task_ids" ]; then task_ids=$(seq 1 $(wc -l < $ARRAY_TASK_FILE)); fi')
+        job_file_lines.append('\nfor task_id in $task_ids; do')
+        job_file_lines.append('\n    eval "$(sed -n "${task_id}p" $ARRAY_TASK_FILE)"')
+        job_file_lines.append('\ndone\n')
+
+        job_file_name = "{0}.job".format(job_name)
+        with open(os.path.join(self.out_dir, job_file_name), "w+") as job_f:
+            job_f.writelines(job_file_lines)
+
+        self.job_files.append(job_file_name)
+        self.job_tasks.append(tasks)
 
         return
 
@@ -343,146 +551,427 @@ class JOB_SUBMIT:
         """
 
         job_numbers = []
-        jobs_out = []
-        jobs_err = []
 
         for job_file_name in job_files:
             os.system('chmod +x {}'.format(os.path.join(work_dir, job_file_name)))
             job_num = self.submit_single_job(job_file_name, work_dir)
-            out = os.path.join(work_dir, "{}_{}.o".format(job_file_name.split('.')[0], job_num))
-            err = os.path.join(work_dir, "{}_{}.e".format(job_file_name.split('.')[0], job_num))
             job_numbers.append(job_num)
-            jobs_out.append(out)
-            jobs_err.append(err)
 
-        i = 0
-        wait_time_sec = 60
-        total_wait_time_min = 0
         time.sleep(2)
 
-        if self.scheduler == 'SLURM':
-            rerun_job_files = []
-            job_status_file = os.path.join(work_dir, 'job_status')
-            for job_number, job_file_name in zip(job_numbers, job_files):
-                if not job_number == 'None':
-                    job_stat = 'wait'
-                    while job_stat == 'wait':
-                        os.system('sacct --format="State" -j {} > {}'.format(job_number, job_status_file))
-                        time.sleep(2)
-                        with open(job_status_file, 'r') as stat_file:
-                            status = stat_file.readlines()
-                            if len(status) < 3:
-                                continue
-                        if 'PENDING' in status[2] or 'RUNNING' in status[2]:
-                            print("Waiting for job {} output file after {} minutes".format(job_file_name,
-                                                                                           total_wait_time_min))
-                            total_wait_time_min += wait_time_sec / 60
-                            time.sleep(wait_time_sec - 2)
-                            i += 1
-                        elif 'COMPLETED' in status[2]:
-                            job_stat = 'complete'
-                        elif 'TIMEOUT' in status[2]:
-                            job_stat = 'timeout'
-                            rerun_job_files.append(job_file_name)
-                        else:
-                            job_stat = 'failed'
-                            raise RuntimeError('Error: {} job was terminated with Error'.format(job_file_name))
-
-            if len(rerun_job_files) > 0:
-               for job_file_name in rerun_job_files:
-                   wall_time = putils.extract_walltime_from_job_file(job_file_name)
-                   new_wall_time = putils.multiply_walltime(wall_time, factor=1.2)
-                   putils.replace_walltime_in_job_file(job_file_name, new_wall_time)
-
-                   dateStr=datetime.strftime(datetime.now(), '%Y%m%d:%H-%M')
-                   string = dateStr + ': re-running: ' + os.path.basename(job_file_name) + ': ' + wall_time + ' --> ' + new_wall_time
-
-                   with open(self.work_dir + '/run_files/rerun.log', 'a') as rerun:
-                      rerun.writelines(string)
-
-               self.submit_and_check_job_status(rerun_job_files, work_dir=self.work_dir)
+        # the jobs are followed by their state (array elements write <job>_<number>_<element>.o files and jobs
+        # deleted before they started write no output file)
+        job_states = self.wait_for_jobs(job_numbers, job_files, work_dir=work_dir)
 
-        else:
-            for out, job_file_name in zip(jobs_out, job_files):
-                if not 'None' in out:
-                    while not os.path.exists(out):
-                        print("Waiting for job {} output file after {} minutes".format(job_file_name, total_wait_time_min))
-                        total_wait_time_min += wait_time_sec / 60
-                        time.sleep(wait_time_sec)
-                        # i += 1
+        rerun_job_files = []
+        for job_number, job_file_name in zip(job_numbers, job_files):
+            if job_states.get(job_number) == 'FAILED':
+                raise RuntimeError('Error: {} job was terminated with Error'.format(job_file_name))
+            # LSF jobs exceeding walltime are rerun by rerun_job_if_exit_code_140
+            if job_states.get(job_number) == 'TIMEOUT' and not self.scheduler == 'LSF':
+                rerun_job_files.append(job_file_name)
+
+        if len(rerun_job_files) > 0:
+            self.rerun_timed_out_jobs(rerun_job_files)
+
+        self.check_job_error_files(job_files)
 
-        for job_file_name in job_files:
-            error_files = glob.glob(job_file_name.split('.')[0] + '*.e')
-            for errfile in error_files:
-                job_exit = [check_words_in_file(errfile, 'Segmentation fault'),
-                            check_words_in_file(errfile, 'Aborted'),
-                            check_words_in_file(errfile, 'ERROR'),
-                            check_words_in_file(errfile, 'Error')]
-                if np.array(job_exit).any():
-                    raise RuntimeError('Error terminating job: {}'.format(job_file_name))
-                    
         return
 
-    def split_jobs(self, batch_file, tasks, number_of_nodes):
+    def rerun_timed_out_jobs(self, rerun_job_files):
         """
-        splits the batch file tasks into multiple jobs with one node
-        :param batch_file:
-        :param tasks:
-        :param number_of_nodes: Total number of nodes required for all tasks
-        :return:
+        Increases the walltime of timed out jobs by a factor of 1.2 and runs them again. Launcher jobs only rerun the
+        tasks that did not finish (according to the task status files)
+        :param rerun_job_files: job files of the jobs that timed out
         """
+        job_files = []
+        for job_file_name in rerun_job_files:
+            number_of_tasks = putils.write_unfinished_launcher_tasks(job_file_name)
+            if number_of_tasks == 0:
+                print('All tasks of {} finished, no rerun'.format(job_file_name))
+                continue
 
-        number_of_jobs = number_of_nodes
-        number_of_nodes_per_job = 1
+            wall_time = putils.extract_walltime_from_job_file(job_file_name)
+            new_wall_time = putils.multiply_walltime(wall_time, factor=1.2)
+            putils.replace_walltime_in_job_file(job_file_name, new_wall_time)
 
-        while number_of_jobs > int(self.max_jobs_per_queue):
-            number_of_nodes_per_job = number_of_nodes_per_job + 1
-            number_of_jobs = np.ceil(number_of_nodes/number_of_nodes_per_job)
+            dateStr=datetime.strftime(datetime.now(), '%Y%m%d:%H-%M')
+            string = dateStr + ': re-running: ' + os.path.basename(job_file_name) + ': ' + wall_time + ' --> ' + new_wall_time
+            if number_of_tasks:
+                string = string + ' ({} unfinished tasks)'.format(number_of_tasks)
 
-        number_of_parallel_tasks = int(np.ceil(len(tasks) / number_of_jobs))
-        number_of_limited_memory_tasks = int(self.max_memory_per_node*number_of_nodes_per_job/self.default_memory)
-        #if ( "run_15_filter_coherence" in batch_file) :
-        #    import pdb; pdb.set_trace()
+            with open(self.work_dir + '/run_files/rerun.log', 'a') as rerun:
+                rerun.writelines(string + '\n')
+            job_files.append(job_file_name)
 
-        while number_of_limited_memory_tasks < number_of_parallel_tasks:
-            if number_of_jobs < int(self.max_jobs_per_queue):
-                number_of_jobs += 1
-                number_of_parallel_tasks = int(np.ceil(len(tasks) / number_of_jobs))
-            else:
+        if len(job_files) > 0:
+            self.submit_and_check_job_status(job_files, work_dir=self.work_dir)
+
+        return
+
+    def check_job_error_files(self, job_files):
+        """
+        Raises an exception if the error files of the jobs contain error messages
+        :param job_files: job file names
+        """
+        error_files = {}
+        for job_file_name in job_files:
+            for errfile in glob.glob(job_file_name.split('.')[0] + '*.e'):
+                error_files[errfile] = job_file_name
+
+        matches = putils.scan_files_for_strings(list(error_files.keys()), JOB_ERROR_STRINGS)
+        for errfile in error_files:
+            if errfile in matches:
+                line_number, error_string, line = matches[errfile][0]
+                print('Error: "{}" found in {} line {}'.format(error_string, errfile, line_number))
+                raise RuntimeError('Error terminating job: {}'.format(error_files[errfile]))
+
+        return
+
+    def wait_for_jobs(self, job_numbers, job_files, work_dir=None):
+        """
+        Waits until all submitted jobs are finished. All outstanding jobs are queried with one scheduler call per
+        poll. The poll interval is long while jobs are pending and short when jobs finish or approach their walltime.
+        :param job_numbers: job numbers returned by submit_single_job ('None' for jobs run on a compute node)
+        :param job_files: job file names corresponding to job_numbers
+        :param work_dir: directory containing the job files
+        :return: dictionary of job number: final state (COMPLETED, TIMEOUT or FAILED)
+        """
+
+        jobs = {}
+        for job_number, job_file_name in zip(job_numbers, job_files):
+            if not job_number == 'None':
+                jobs[job_number] = job_file_name
+
+        wall_time_seconds = {}
+        for job_number, job_file_name in jobs.items():
+            try:
+                wall_time = putils.extract_walltime_from_job_file(os.path.join(work_dir, job_file_name))
+            except OSError:
+                wall_time = None
+            if wall_time is None:
+                wall_time = self.default_wall_time
+            wall_time_seconds[job_number] = putils.walltime_to_seconds(wall_time)
+
+        final_states = {}
+        previous_states = {}
+        # jobs reported by the scheduler at least once
+        listed_jobs = set()
+        running_since = {}
+        migration_jobs = {}
+        migration_states = {}
+        # jobs cancelled by their migration job
+        migrated_jobs = set()
+        poll_interval = MIN_POLL_INTERVAL
+        start_time = time.time()
+
+        while len(final_states) < len(jobs):
+            outstanding = [job_number for job_number in jobs if not job_number in final_states]
+            outstanding_migration = [x for x in migration_jobs.values() if not x in migration_states]
+            states = query_job_states(outstanding + outstanding_migration, self.scheduler, self.array_jobs)
+            now = time.time()
+
+            state_changed = False
+            for job_number in outstanding_migration + outstanding:
+                state = states.get(job_number)
+                previous_state = previous_states.get(job_number)
+                if not state is None:
+                    listed_jobs.add(job_number)
+                else:
+                    # SLURM: not yet in the accounting database. LSF/PBS: finished job dropped from the records
+                    # (only for jobs the scheduler listed before, a job never listed is still PENDING)
+                    if previous_state in TERMINAL_JOB_STATES:
+                        state = previous_state
+                    elif job_number in listed_jobs and not self.scheduler == 'SLURM':
+                        state = 'COMPLETED'
+                    else:
+                        state = previous_states.get(job_number, 'PENDING')
+
+                if not state == previous_state:
+                    state_changed = True
+                previous_states[job_number] = state
+
+                if job_number in outstanding_migration:
+                    if state in TERMINAL_JOB_STATES:
+                        migration_states[job_number] = state
+                    continue
+
+                migration_job = migration_jobs.get(job_number)
+                if state in TERMINAL_JOB_STATES and not migration_job is None:
+                    if state == 'COMPLETED':
+                        if not migration_job in migration_states:
+                            print('Job {} finished before its migration job {} started, cancelling it'.format(
+                                job_number, migration_job))
+                            cancel_jobs([migration_job], self.scheduler)
+                            migration_states[migration_job] = 'FAILED'
+                    elif migration_job in migration_states:
+                        # the job was cancelled by its migration job, which determines the result
+                        state = migration_states[migration_job]
+                        migrated_jobs.add(job_number)
+                    else:
+                        state = 'RUNNING'
+
+                if state in TERMINAL_JOB_STATES:
+                    final_states[job_number] = state
+                    print('Job {} ({}) finished with state {}'.format(jobs[job_number], job_number, state))
+                elif state == 'RUNNING':
+                    running_since.setdefault(job_number, now)
+                    if self.straggler_factor and migration_job is None:
+                        migration_job = self.submit_migration_job(job_number, jobs[job_number], work_dir)
+                        if not migration_job is None:
+                            migration_jobs[job_number] = migration_job
+
+            if len(final_states) == len(jobs):
                 break
 
-        while number_of_limited_memory_tasks < number_of_parallel_tasks:
-            number_of_nodes_per_job = number_of_nodes_per_job + 1
-            number_of_limited_memory_tasks = int(self.max_memory_per_node * number_of_nodes_per_job / self.default_memory)
+            running = [job_number for job_number in running_since if not job_number in final_states]
+            seconds_to_walltime = [wall_time_seconds[job_number] - (now - running_since[job_number])
+                                   for job_number in running if not wall_time_seconds[job_number] is None]
+
+            poll_interval = get_poll_interval(poll_interval, len(running) > 0, state_changed,
+                                              min(seconds_to_walltime) if seconds_to_walltime else None)
+
+            print("Waiting for {} of {} jobs ({} running) after {:.1f} minutes".format(
+                len(jobs) - len(final_states), len(jobs), len(running), (now - start_time) / 60))
+            time.sleep(poll_interval)
+
+        self.record_job_accounting(jobs, final_states, migrated_jobs)
+        if self.execution_state:
+            self.execution_state.update_job_states(final_states)
+
+        return final_states
+
+    def submit_migration_job(self, job_number, job_file_name, work_dir):
+        """
+        Migrates straggling tasks of a running launcher job to a new job: submits a job for the tasks that take longer
+        than STRAGGLER_FACTOR (at least MIN_MIGRATION_FACTOR) times the median duration of the finished tasks of the
+        job (of previous jobs of the step if fewer than MIN_FINISHED_TASKS finished, see JobAccounting), once all
+        other tasks of the job are finished and its nodes are idle. When the migration job starts it cancels the
+        original job and runs the straggling tasks again from the start. If the original job finishes first, the
+        migration job is cancelled (see wait_for_jobs).
+        Both copies can not run to completion side by side: the outputs of a task are given by its config file, so
+        two copies would write the same files. A migrated task needs about the expected duration, so migrating a
+        task that already ran MIN_MIGRATION_FACTOR times longer pays off unless it was about to finish; stragglers
+        of this kind are usually caused by a slow or overloaded node rather than by the task.
+        :param job_number: job number of the running job
+        :param job_file_name: job file name of the running job
+        :param work_dir: directory containing the job file
+        :return: job number of the migration job or None
+        """
+
+        job_file = os.path.join(work_dir, job_file_name)
+        batch_file, tasks, unfinished_tasks = putils.get_unfinished_launcher_tasks(job_file)
+        if batch_file is None or len(tasks) < 2 or len(unfinished_tasks) == 0:
+            return None
+
+        now = time.time()
+        durations = []
+        running_tasks = []
+        for line in tasks:
+            status_file, task, status = putils.read_task_status(line)
+            start_time, end_time = putils.get_task_times(status_file)
+            if status is None or start_time is None:
+                # tasks waiting for a free slot: the nodes of the job are still busy
+                return None
+            if status == 'running':
+                running_tasks.append((line, status_file, now - start_time))
+            elif not end_time is None:
+                durations.append(end_time - start_time)
+
+        if len(running_tasks) == 0:
+            return None
+
+        if len(durations) >= MIN_FINISHED_TASKS:
+            expected_duration = np.median(durations)
+        elif self.platform_name:
+            step_name = putils.extract_step_name_from_stdout_name(os.path.basename(job_file_name).split('.job')[0])
+            expected_duration = JobAccounting().predict(step_name, self.platform_name,
+                                                        self.num_bursts if self.num_bursts else 1, quantile=0.5)[0]
+        else:
+            expected_duration = None
+
+        if not expected_duration:
+            return None
+
+        # only if all running tasks are stragglers, otherwise the job still uses its nodes
+        straggler_factor = max(self.straggler_factor, MIN_MIGRATION_FACTOR)
+        if not all(elapsed > straggler_factor * expected_duration for line, status_file, elapsed in running_tasks):
+            return None
+
+        job_name = os.path.basename(job_file_name).split('.job')[0] + '_migration'
+        wall_time = self.default_wall_time
+        self.default_wall_time = putils.extract_walltime_from_job_file(job_file)
+        job_file_lines = self.get_job_file_lines(job_name, job_name, number_of_nodes=1, work_dir=work_dir)
+        self.default_wall_time = wall_time
+
+        job_file_lines.append('\n')
+        with open(job_file) as f:
+            job_file_lines.extend(['\n' + line.strip() for line in f.readlines()
+                                   if line.startswith('export OMP_NUM_THREADS') or line.startswith('export PATH')])
+
+        if self.scheduler == 'LSF':
+            cancel_command = 'bkill'
+        elif self.scheduler == 'PBS':
+            cancel_command = 'qdel'
+        else:
+            cancel_command = 'scancel'
+        job_file_lines.append('\n\n{} {}\nsleep 10'.format(cancel_command, job_number))
+        job_file_lines.append('\nexport LAUNCHER_JID=migration\n')
+        for line, status_file, elapsed in running_tasks:
+            job_file_lines.append("\nif ! grep -qs '^0 ' {}; then {}; fi &".format(status_file, line.strip()))
+        job_file_lines.append('\nwait\n')
+
+        with open(os.path.join(work_dir, job_name + '.job'), 'w+') as job_f:
+            job_f.writelines(job_file_lines)
+        os.system('chmod +x {}'.format(os.path.join(work_dir, job_name + '.job')))
+
+        migration_job = self.submit_single_job(job_name + '.job', work_dir)
+        print('Job {}: {} tasks running longer than {} times the expected {:.0f} s, submitted migration job {}'.format(
+            job_number, len(running_tasks), straggler_factor, expected_duration, migration_job))
+
+        if migration_job == 'None':
+            return None
+
+        return migration_job
+
+    def record_job_accounting(self, jobs, final_states, migrated_jobs=()):
+        """
+        Stores elapsed time and memory of finished jobs in the job accounting database used by get_memory_walltime.
+        Jobs cancelled by their migration job are stored with state MIGRATED, which is not used for predictions:
+        their elapsed time ends at the cancellation. The migration jobs (straggling tasks only) are not stored.
+        :param jobs: dictionary of job number: job file name
+        :param final_states: dictionary of job number: final state
+        :param migrated_jobs: job numbers of the jobs cancelled by their migration job
+        """
+
+        if not self.platform_name in supported_platforms or len(jobs) == 0:
+            return
+
+        records = []
+        accounting = query_job_accounting(list(jobs.keys()), self.scheduler, self.array_jobs)
+        for job_number, job in accounting.items():
+            if not job_number in jobs:
+                continue
+            job_name = os.path.basename(jobs[job_number]).split('.job')[0]
+            records.append({'job_id': job_number,
+                            'platform': self.platform_name,
+                            'step': putils.extract_step_name_from_stdout_name(job_name),
+                            'job_name': job_name,
+                            'state': 'MIGRATED' if job_number in migrated_jobs else final_states.get(job_number),
+                            'num_bursts': self.num_bursts if self.num_bursts else 1,
+                            'num_tasks': self.number_of_job_tasks.get(os.path.basename(jobs[job_number]), 1),
+                            'tasks_per_node': self.number_of_parallel_job_tasks.get(
+                                os.path.basename(jobs[job_number])),
+                            'num_nodes': job['num_nodes'] if job['num_nodes'] else 1,
+                            'elapsed': job['elapsed'],
+                            'max_rss': job['max_rss']})
+
+        try:
+            JobAccounting().add_jobs(records)
+        except (OSError, sqlite3.Error) as e:
+            print('WARNING: could not store job accounting: {}'.format(e))
+
+        return
+
+    def split_jobs(self, batch_file, tasks):
+        """
+        splits the batch file tasks into multiple jobs. The tasks are packed into jobs and nodes based on their
+        estimated walltime and memory (see plan_task_packing), respecting MAX_JOBS_PER_QUEUE, CPUS_PER_NODE and
+        MEM_PER_NODE. The walltime of each job is set to its estimated makespan.
+        :param batch_file:
+        :param tasks:
+        :return:
+        """
+
+        task_walltimes, task_memories = self.estimate_task_costs(tasks, batch_file=batch_file)
 
-        self.number_of_parallel_tasks_per_node = math.ceil(number_of_parallel_tasks / number_of_nodes_per_job)
+        number_of_slots_per_node = int(self.number_of_cores_per_node * self.number_of_threads_per_core /
+                                       float(self.default_num_threads))
+        number_of_limited_memory_tasks = int(self.max_memory_per_node / max(task_memories))
+        number_of_slots_per_node = max(1, min(number_of_slots_per_node, number_of_limited_memory_tasks))
+
+        # without launcher all tasks of a job start at once, so tasks can not share a slot
+        number_of_nodes_per_job, job_task_indices, job_walltimes = plan_task_packing(
+            task_walltimes, number_of_slots_per_node, int(self.max_jobs_per_queue), stack_tasks=self.use_launcher())
 
         if number_of_nodes_per_job > 1:
             print('Note: Number of jobs exceed the numbers allowed per queue for jobs with 1 node...\n'
                   'Number of Nodes per job are adjusted to {}'.format(number_of_nodes_per_job))
 
-        start_lines = np.ogrid[0:len(tasks):number_of_parallel_tasks].tolist()
-        end_lines = [x + number_of_parallel_tasks for x in start_lines]
-        end_lines[-1] = len(tasks)
+        default_wall_time = self.default_wall_time
 
-        for start_line, end_line in zip(start_lines, end_lines):
-            job_count = start_lines.index(start_line)
+        for job_count, (task_indices, job_walltime) in enumerate(zip(job_task_indices, job_walltimes)):
             batch_file_name = batch_file + '_{}'.format(job_count)
             job_name = os.path.basename(batch_file_name)
+            job_tasks = [tasks[i] for i in task_indices]
+
+            # tasks stacked in the same lane wait for a free slot, the slots are limited by cores and memory
+            self.number_of_parallel_tasks_per_node = min(number_of_slots_per_node,
+                                                         math.ceil(len(job_tasks) / number_of_nodes_per_job))
+            if job_walltime > 0:
+                self.default_wall_time = putils.seconds_to_walltime(job_walltime, self.scheduler)
 
-            job_file_lines = self.get_job_file_lines(job_name, batch_file_name, number_of_tasks=end_line-start_line,
+            job_file_lines = self.get_job_file_lines(job_name, batch_file_name, number_of_tasks=len(job_tasks),
                                                      number_of_nodes=number_of_nodes_per_job, work_dir=self.out_dir)
 
-            job_file_name = self.add_tasks_to_job_file_lines(job_file_lines, tasks[start_line:end_line],
-                                                             batch_file=batch_file_name)
+            job_file_name = self.add_tasks_to_job_file_lines(job_file_lines, job_tasks, batch_file=batch_file_name)
+            self.number_of_parallel_job_tasks[os.path.basename(job_file_name)] = \
+                self.number_of_parallel_tasks_per_node
 
             self.job_files.append(job_file_name)
+            self.job_tasks.append(job_tasks)
+
+        self.default_wall_time = default_wall_time
 
         return
 
+    def estimate_task_costs(self, tasks, batch_file=None):
+        """
+        estimates walltime and memory of each task of a batch file. The walltime and memory of the step (see
+        get_memory_walltime, estimated for the bursts of the stack) are scaled by the bursts covered by the dates of
+        the task (see get_date_bursts). The walltime of the steps in BASELINE_COST_STEPS is also scaled by the
+        temporal baseline of the pair relative to the median baseline of the batch file.
+        :param tasks: lines of the batch file
+        :param batch_file: the batch file (for the step name)
+        :return: list of walltimes in seconds, list of memory in MB
+        """
+        wall_time_seconds = putils.walltime_to_seconds(self.default_wall_time)
+        memory = float(self.default_memory)
+
+        task_dates = [get_task_dates(task) for task in tasks]
+
+        burst_factors = [1.0] * len(tasks)
+        if self.prefix == 'tops' and self.num_bursts:
+            date_bursts = {}
+            for i, dates in enumerate(task_dates):
+                for date in dates:
+                    if not date in date_bursts:
+                        date_bursts[date] = get_date_bursts(self.work_dir, date)
+                # bursts common to the dates of the task
+                bursts = [date_bursts[date] for date in dates if date_bursts[date]]
+                if len(bursts) > 0:
+                    burst_factors[i] = min(bursts) / float(self.num_bursts)
+
+        baseline_factors = [1.0] * len(tasks)
+        step_name = putils.extract_step_name_from_stdout_name(batch_file) if batch_file else None
+        if step_name in BASELINE_COST_STEPS:
+            baselines = [get_temporal_baseline(dates) for dates in task_dates]
+            known_baselines = [x for x in baselines if x]
+            if len(known_baselines) > 0:
+                median_baseline = float(np.median(known_baselines))
+                baseline_factors = [1 + BASELINE_COST_FACTOR * (x / median_baseline - 1) if x else 1.0
+                                    for x in baselines]
+
+        task_walltimes = [wall_time_seconds * burst_factor * baseline_factor
+                          for burst_factor, baseline_factor in zip(burst_factors, baseline_factors)]
+        task_memories = [memory * max(MIN_MEMORY_FACTOR, min(1.0, burst_factor)) for burst_factor in burst_factors]
+
+        return task_walltimes, task_memories
+
     def get_memory_walltime(self, job_name, job_type='batch'):
         """
-        get memory, walltime and number of threads for the job from job_defaults.cfg
+        get memory, walltime and number of threads for the job from job_defaults.cfg, or from the accounting
+        of previous jobs of the step if JOB_RESOURCE_QUANTILE is set and enough jobs completed
         :param job_name: the job file name
         :param job_type: 'batch' or 'script'
         """
@@ -490,7 +979,7 @@ class JOB_SUBMIT:
 
         if job_type == 'batch':
             step_name = '_'
-            step_name = step_name.join(job_name.split('/')[-1].split('_')[2::])
+            step_name = step_name.join(putils.strip_resume_suffix(job_name.split('/')[-1]).split('_')[2::])
         else:
             step_name = job_name
 
@@ -503,7 +992,14 @@ class JOB_SUBMIT:
         else:
             number_of_bursts = 1
 
-        if self.memory in [None, 'None']:
+        predicted_wall_time, predicted_memory = None, None
+        if self.resource_quantile and self.platform_name:
+            predicted_wall_time, predicted_memory = JobAccounting().predict(step_name, self.platform_name,
+                                                                            number_of_bursts, self.resource_quantile)
+
+        if self.memory in [None, 'None'] and predicted_memory:
+            self.default_memory = int(np.ceil(predicted_memory))
+        elif self.memory in [None, 'None']:
             if step_name in config:
                 c_memory = config[step_name]['c_memory']
                 s_memory = config[step_name]['s_memory']
@@ -534,6 +1030,9 @@ class JOB_SUBMIT:
         self.default_wall_time = putils.scale_walltime(number_of_bursts, self.wall_time_factor,
                                                        c_walltime, s_walltime, self.scheduler)
 
+        if self.wall_time in [None, 'None'] and predicted_wall_time:
+            self.default_wall_time = putils.seconds_to_walltime(predicted_wall_time, self.scheduler)
+
         if step_name in config:
             self.default_num_threads = config[step_name]['num_threads']
         else:
@@ -541,13 +1040,15 @@ class JOB_SUBMIT:
 
         return
 
-    def get_job_file_lines(self, job_name, job_file_name, number_of_tasks=1, number_of_nodes=1, work_dir=None):
+    def get_job_file_lines(self, job_name, job_file_name, number_of_tasks=1, number_of_nodes=1, work_dir=None,
+                           array_size=None):
         """
         Generates the lines of a job submission file that are based on the specified scheduler.
         :param job_name: Name of job.
         :param job_file_name: Name of job file.
         :param number_of_tasks: Number of lines in batch file to be supposed as number of tasks
         :param number_of_nodes: Number of nodes based on number of tasks (each node is able to perform 68 tasks)
+        :param array_size: Number of elements of an array job (None for a single job)
         :return: List of lines for job submission file
         """
 
@@ -601,11 +1102,26 @@ class JOB_SUBMIT:
         if self.queue == 'parallel':
             number_of_nodes *= 16
 
+        array_option = False
+        if array_size:
+            if self.scheduler == 'LSF':
+                name_option = '-J "{0}[1-' + str(array_size) + ']%' + str(self.max_jobs_per_queue) + '"'
+                stdout_option = "-o {0}_%J_%I.o"
+                stderr_option = "-e {0}_%J_%I.e"
+            elif self.scheduler == 'PBS':
+                array_option = "-J 1-{0}".format(array_size)
+            else:
+                array_option = "--array=1-{0}%{1}".format(array_size, self.max_jobs_per_queue)
+                stdout_option = "-o {0}_%A_%a.o"
+                stderr_option = "-e {0}_%A_%a.e"
+
         job_file_lines = [
             "#! " + shell,
             prefix + name_option.format(os.path.basename(job_name)),
             prefix + project_option.format(os.getenv('JOBSHEDULER_PROJECTNAME'))
         ]
+        if array_option:
+            job_file_lines.append(prefix + array_option)
         if self.email_notif:
             job_file_lines.append(prefix + email_option.format(os.getenv("NOTIFICATIONEMAIL")))
 
@@ -630,13 +1146,10 @@ class JOB_SUBMIT:
 
         return job_file_lines
 
-    def add_tasks_to_job_file_lines(self, job_file_lines, tasks, batch_file=None):
+    def use_launcher(self):
         """
-        complete job file lines based on job submission scheme. if it uses launcher, add launcher specific lines
-        :param job_file_lines: raw job file lines from function 'get_job_file_lines'
-        :param tasks:number of tasks to be include in this job
-        :param batch_file: name of batch file containing tasks
-        :return:
+        :return: True if the tasks of a job are run by launcher (LAUNCHER_PPN tasks at the same time per node),
+                 otherwise the job file starts all its tasks at once
         """
         do_launcher = False
         if self.scheduler == 'SLURM':
@@ -644,16 +1157,33 @@ class JOB_SUBMIT:
             if not hostname.startswith('login') or not hostname.startswith('comet'):
                 do_launcher = True
 
+        return 'launcher' in self.submission_scheme or do_launcher
+
+    def add_tasks_to_job_file_lines(self, job_file_lines, tasks, batch_file=None):
+        """
+        complete job file lines based on job submission scheme. if it uses launcher, add launcher specific lines
+        :param job_file_lines: raw job file lines from function 'get_job_file_lines'
+        :param tasks:number of tasks to be include in this job
+        :param batch_file: name of batch file containing tasks
+        :return:
+        """
         job_file_name = "{0}.job".format(batch_file)
 
         tasks_with_output = []
-        if 'launcher' in self.submission_scheme or do_launcher:
-            for line in tasks:
+        if self.use_launcher():
+            for count, line in enumerate(tasks):
                 config_file = putils.extract_config_file_from_task_string(line)
                 date_string = putils.extract_date_string_from_config_file_name(config_file)
-                tasks_with_output.append("{} > {} 2>{}\n".format(line.split('\n')[0],
-                                                                 os.path.abspath(batch_file) + '_' + date_string + '_$LAUNCHER_JID.o',
-                                                                 os.path.abspath(batch_file) + '_' + date_string + '_$LAUNCHER_JID.e'))
+                task_with_output = "{} > {} 2>{}".format(line.split('\n')[0],
+                                                        os.path.abspath(batch_file) + '_' + date_string + '_$LAUNCHER_JID.o',
+                                                        os.path.abspath(batch_file) + '_' + date_string + '_$LAUNCHER_JID.e')
+
+                # start and exit code of each task, used to rerun only unfinished tasks (see rerun_timed_out_jobs)
+                status_file = putils.get_task_status_file(batch_file, count)
+                os.makedirs(os.path.dirname(status_file), exist_ok=True)
+                if os.path.exists(status_file):
+                    os.remove(status_file)
+                tasks_with_output.append(putils.add_task_status_markers(task_with_output, status_file))
             if os.path.exists(batch_file):
                 os.remove(batch_file)
 
@@ -673,7 +1203,7 @@ class JOB_SUBMIT:
             job_file_lines.append("\nexport PATH={0}:$PATH".format(self.stack_path))
             job_file_lines.append("\nexport LAUNCHER_WORKDIR={0}".format(self.out_dir))
             job_file_lines.append("\nexport LAUNCHER_PPN={0}\n".format(self.number_of_parallel_tasks_per_node))
-            job_file_lines.append("\nexport LAUNCHER_JOB_FILE={0}\n".format(batch_file))
+            job_file_lines.append("\nexport LAUNCHER_JOB_FILE={0}\n".format(os.path.abspath(batch_file)))
            
             if self.scheduler == 'SLURM':
 
@@ -726,15 +1256,500 @@ def check_words_in_file(errfile, eword):
     :return: True if the word is in the file
     """
 
-    with open(errfile, 'r') as f:
-        lines = f.readlines()
+    return len(putils.scan_file_for_strings(errfile, [eword])) > 0
+
+
+def plan_task_packing(task_walltimes, number_of_slots_per_node, max_jobs_per_queue, stack_tasks=True):
+    """
+    Cost-aware distribution of tasks over jobs. Tasks are first packed first-fit-decreasing into lanes (a lane is
+    one task slot of a node running tasks one after another) not longer than the longest task, so that short tasks
+    share slots without increasing the makespan. The lanes determine the number of nodes, which are split into at
+    most max_jobs_per_queue jobs. The tasks are then distributed over all slots longest-processing-time first.
+    Without stack_tasks every task has its own slot, so that a job has at most number_of_slots_per_node tasks per node.
+    :param task_walltimes: estimated walltime of each task in seconds
+    :param number_of_slots_per_node: number of tasks running in parallel on one node (limited by cores and memory)
+    :param max_jobs_per_queue: maximum number of jobs
+    :param stack_tasks: True if the tasks of a job wait for a free slot (launcher), False if they start at once
+    :return: number of nodes per job, list with the task indices of each job (longest task first),
+             list with the estimated walltime of each job in seconds
+    """
+
+    if max(task_walltimes) > 0:
+        task_costs = task_walltimes
+    else:
+        # walltimes unknown: all tasks cost the same
+        task_costs = [1] * len(task_walltimes)
+
+    order = sorted(range(len(task_costs)), key=lambda i: task_costs[i], reverse=True)
+    makespan = max(task_costs)
+
+    lanes = []
+    for i in order:
+        for k, load in enumerate(lanes):
+            if stack_tasks and load + task_costs[i] <= makespan:
+                lanes[k] = load + task_costs[i]
+                break
+        else:
+            lanes.append(task_costs[i])
+
+    number_of_nodes = math.ceil(len(lanes) / number_of_slots_per_node)
+    number_of_jobs = min(number_of_nodes, max_jobs_per_queue)
+    number_of_nodes_per_job = math.ceil(number_of_nodes / number_of_jobs)
+    number_of_jobs = math.ceil(number_of_nodes / number_of_nodes_per_job)
+
+    slots = [(0, slot, job) for job in range(number_of_jobs)
+             for slot in range(number_of_nodes_per_job * number_of_slots_per_node)]
+    heapq.heapify(slots)
+
+    job_task_indices = [[] for job in range(number_of_jobs)]
+    job_walltimes = [0] * number_of_jobs
+    for i in order:
+        finish_time, slot, job = heapq.heappop(slots)
+        job_task_indices[job].append(i)
+        job_walltimes[job] = max(job_walltimes[job], finish_time + task_walltimes[i])
+        heapq.heappush(slots, (finish_time + task_costs[i], slot, job))
+
+    return number_of_nodes_per_job, job_task_indices, job_walltimes
+
+
+def get_task_dates(task):
+    """
+    Extracts the dates from the config file name of a run file task
+    (e.g. ['20200101'] for configs/config_fullBurst_resample_20200101)
+    :param task: line of a run file
+    :return: list of dates (YYYYMMDD), empty if the task is not date specific
+    """
+
+    config_file = putils.extract_config_file_from_task_string(task)
+    date_string = putils.extract_date_string_from_config_file_name(config_file.strip())
+
+    return [x for x in date_string.split('_') if x.isdigit() and len(x) == 8]
+
+
+def get_temporal_baseline(dates):
+    """
+    :param dates: dates of a task (see get_task_dates)
+    :return: temporal baseline in days of a pair, None for other tasks
+    """
+
+    if not len(dates) == 2:
+        return None
+
+    return abs((datetime.strptime(dates[1], '%Y%m%d') - datetime.strptime(dates[0], '%Y%m%d')).days)
+
+
+def get_date_bursts(work_dir, date):
+    """
+    Counts the bursts of a date unpacked or coregistered by topsStack (e.g. coreg_secondarys/20200101/IW1/burst_01.xml)
+    :param work_dir: the work directory
+    :param date: date (YYYYMMDD)
+    :return: number of bursts, None if the date is not unpacked (yet)
+    """
+
+    for directory in ['coreg_secondarys', 'secondarys']:
+        bursts = set(os.path.basename(os.path.dirname(x)) + os.path.basename(x).split('.')[0] for x in
+                     glob.glob(os.path.join(work_dir, directory, date, 'IW*', 'burst_*.xml')))
+        if len(bursts) > 0:
+            return len(bursts)
+
+    return None
+
+
+def get_task_dependencies(previous_tasks, tasks):
+    """
+    Builds the per-date dependencies between the tasks of two consecutive run files. A task depends on the task of
+    the previous run file with the same date (or date pair), otherwise on all previous tasks sharing one of its dates.
+    Tasks without dates or without matching previous tasks depend on all previous tasks. Previous tasks without
+    dates are always included.
+    :param previous_tasks: lines of the previous run file
+    :param tasks: lines of the run file
+    :return: for each task the list of indices of previous_tasks it depends on
+    """
+
+    previous_dates = [get_task_dates(x) for x in previous_tasks]
+    undated = [i for i, dates in enumerate(previous_dates) if len(dates) == 0]
+
+    task_dependencies = []
+    for task in tasks:
+        dates = get_task_dates(task)
+
+        matches = []
+        if len(dates) > 0:
+            matches = [i for i, x in enumerate(previous_dates) if x == dates]
+            if len(matches) == 0:
+                matches = [i for i, x in enumerate(previous_dates) if set(x) & set(dates)]
+
+        if len(matches) == 0:
+            matches = list(range(len(previous_tasks)))
+
+        task_dependencies.append(sorted(set(matches + undated)))
+
+    return task_dependencies
+
+
+def get_job_dependencies(previous_job_tasks, job_tasks):
+    """
+    Converts the per-date task dependencies between two consecutive run files into job dependencies
+    :param previous_job_tasks: for each job of the previous run file the list of its tasks (JOB_SUBMIT.job_tasks)
+    :param job_tasks: for each job of the run file the list of its tasks
+    :return: for each job the list of indices of the previous jobs it depends on
+    """
+
+    previous_tasks = [task for tasks in previous_job_tasks for task in tasks]
+    job_of_previous_task = [index for index, tasks in enumerate(previous_job_tasks) for task in tasks]
+
+    job_dependencies = []
+    for tasks in job_tasks:
+        task_dependencies = get_task_dependencies(previous_tasks, tasks)
+        job_dependencies.append(sorted(set(job_of_previous_task[i] for x in task_dependencies for i in x)))
+
+    return job_dependencies
+
+
+def query_job_states(job_numbers, scheduler, array_jobs=()):
+    """
+    Queries the states of all given jobs with a single scheduler call (sacct, bjobs or qstat)
+    :param job_numbers: list of job numbers
+    :param scheduler: SLURM, LSF or PBS
+    :param array_jobs: job numbers of array jobs (see is_array_job_file)
+    :return: dictionary of job number: state (PENDING, RUNNING, COMPLETED, TIMEOUT or FAILED).
+             Jobs unknown to the scheduler are not included.
+    """
+
+    if len(job_numbers) == 0:
+        return {}
+
+    if scheduler == 'SLURM':
+        command = ['sacct', '--noheader', '--parsable2', '--allocations', '--format=JobID,State',
+                   '--jobs', ','.join(job_numbers)]
+    elif scheduler == 'LSF':
+        command = ['bjobs', '-noheader', '-o', "jobid stat exit_code delimiter='|'"] + job_numbers
+    elif scheduler == 'PBS':
+        # full output for the exit status of finished jobs
+        command = ['qstat', '-x', '-f'] + get_pbs_job_ids(job_numbers, array_jobs)
+    else:
+        raise Exception("ERROR: scheduler {0} not supported".format(scheduler))
+
+    try:
+        # bjobs and qstat exit non-zero if any job is unknown but still report the others
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout
+    except OSError as e:
+        print('WARNING: could not query job status: {}'.format(e))
+        return {}
+
+    return parse_job_states(output, scheduler)
+
+
+def parse_job_states(output, scheduler):
+    """
+    Parses the output of sacct, bjobs or qstat -f (as called by query_job_states) into job states.
+    Array job elements are combined into one state for the job (the least advanced state wins).
+    :param output: the scheduler output
+    :param scheduler: SLURM, LSF or PBS
+    :return: dictionary of job number: state (PENDING, RUNNING, COMPLETED, TIMEOUT or FAILED)
+    """
+
+    state_priority = ['RUNNING', 'PENDING', 'FAILED', 'TIMEOUT', 'COMPLETED']
+
+    if scheduler == 'PBS':
+        lines = parse_pbs_job_states(output)
+    else:
+        lines = output.splitlines()
+
+    job_states = {}
+    for line in lines:
+        if scheduler == 'SLURM':
+            fields = line.strip().split('|')
+            if len(fields) < 2 or not fields[0][:1].isdigit():
+                continue
+            job_number = re.split('[_.]', fields[0])[0]
+            slurm_state = fields[1].split(' ')[0]
+            if slurm_state in ['PENDING', 'REQUEUED', 'SUSPENDED', 'RESV_DEL_HOLD', 'REQUEUE_HOLD']:
+                state = 'PENDING'
+            elif slurm_state in ['RUNNING', 'CONFIGURING', 'COMPLETING', 'RESIZING', 'STAGE_OUT', 'SIGNALING']:
+                state = 'RUNNING'
+            elif slurm_state in ['COMPLETED', 'TIMEOUT']:
+                state = slurm_state
+            else:
+                state = 'FAILED'
+
+        elif scheduler == 'LSF':
+            fields = line.strip().split('|')
+            if len(fields) < 3 or not fields[0][:1].isdigit():
+                continue
+            job_number = fields[0].split('[')[0]
+            lsf_state = fields[1]
+            if lsf_state in ['PEND', 'PSUSP', 'WAIT']:
+                state = 'PENDING'
+            elif lsf_state in ['RUN', 'USUSP', 'SSUSP', 'PROV', 'UNKWN']:
+                state = 'RUNNING'
+            elif lsf_state == 'DONE':
+                state = 'COMPLETED'
+            elif lsf_state == 'EXIT' and fields[2].strip() == '140':
+                state = 'TIMEOUT'
+            else:
+                state = 'FAILED'
+
+        elif scheduler == 'PBS':
+            job_number, state = line
+        else:
+            raise Exception("ERROR: scheduler {0} not supported".format(scheduler))
+
+        if job_number in job_states:
+            state = min(state, job_states[job_number], key=state_priority.index)
+        job_states[job_number] = state
+
+    return job_states
+
+
+def get_pbs_job_ids(job_numbers, array_jobs=()):
+    """
+    Returns the arguments of qstat for the given jobs: array jobs are only found as <job>[] and their elements are
+    listed with -t
+    """
+
+    job_ids = [x + '[]' if x in array_jobs else x for x in job_numbers]
+    if any(x in array_jobs for x in job_numbers):
+        job_ids = ['-t'] + job_ids
 
-    check_eword = [eword in item for item in lines]
+    return job_ids
 
-    if np.sum(1*check_eword) > 0:
-        return True
+
+def is_array_job_file(job_file):
+    """
+    :param job_file: job file (see get_job_file_lines)
+    :return: True if the job file submits an array job
+    """
+
+    try:
+        with open(job_file) as f:
+            for line in f:
+                if re.match(r'^(#SBATCH --array=|#BSUB -J "?[^\s\[]+\[1-|#PBS -J )', line):
+                    return True
+    except OSError:
+        pass
+
+    return False
+
+
+def parse_pbs_job_states(output):
+    """
+    Parses the output of qstat -x -f into (job number, state) of every job and array element. A finished job is
+    COMPLETED with Exit_status 0, TIMEOUT with the walltime exit status (-29) and FAILED otherwise. A finished job
+    without Exit_status never ran (e.g. deleted because a job it depends on failed) and is FAILED.
+    :param output: the qstat output
+    :return: list of (job number, state)
+    """
+
+    records = []
+    for line in output.splitlines():
+        if line.startswith('Job Id:'):
+            job_id = line.split(':', 1)[1].strip().split('.')[0]
+            records.append({'job_id': job_id, 'job_state': None, 'exit_status': None})
+        elif len(records) > 0 and '=' in line:
+            key, value = [x.strip() for x in line.split('=', 1)]
+            if key == 'job_state':
+                records[-1]['job_state'] = value
+            elif key.lower() == 'exit_status':
+                records[-1]['exit_status'] = value
+
+    job_states = []
+    for record in records:
+        pbs_state = record['job_state']
+        if pbs_state is None:
+            continue
+        if pbs_state in ['Q', 'H', 'W', 'T', 'S', 'U']:
+            state = 'PENDING'
+        elif pbs_state in ['R', 'E', 'B', 'M']:
+            state = 'RUNNING'
+        elif record['exit_status'] == '0':
+            state = 'COMPLETED'
+        elif record['exit_status'] == '-29':
+            state = 'TIMEOUT'
+        elif record['exit_status'] is None and record['job_id'].endswith('[]'):
+            # the finished array job itself, its state is given by the array elements
+            state = 'COMPLETED'
+        else:
+            state = 'FAILED'
+        job_states.append((record['job_id'].split('[')[0], state))
+
+    return job_states
+
+
+def query_queue_depth(scheduler):
+    """
+    Returns the number of queued and running jobs of the user
+    :param scheduler: SLURM, LSF or PBS
+    :return: number of jobs (0 if the scheduler can not be queried)
+    """
+
+    user = os.getenv('USER')
+    if scheduler == 'SLURM':
+        command = ['squeue', '--noheader', '--user', user, '--format=%i']
+    elif scheduler == 'LSF':
+        command = ['bjobs', '-noheader', '-u', user]
+    elif scheduler == 'PBS':
+        command = ['qstat', '-u', user]
+    else:
+        raise Exception("ERROR: scheduler {0} not supported".format(scheduler))
+
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout
+    except OSError as e:
+        print('WARNING: could not query queue: {}'.format(e))
+        return 0
+
+    return len([line for line in output.splitlines() if line.strip()[:1].isdigit()])
+
+
+def query_job_accounting(job_numbers, scheduler, array_jobs=()):
+    """
+    Queries elapsed time, maximum memory and number of nodes of finished jobs with a single scheduler call
+    :param job_numbers: list of job numbers
+    :param scheduler: SLURM, LSF or PBS
+    :param array_jobs: job numbers of array jobs (see is_array_job_file)
+    :return: dictionary of job number: {'elapsed': seconds, 'max_rss': MB or None, 'num_nodes': nodes}
+    """
+
+    if len(job_numbers) == 0:
+        return {}
+
+    if scheduler == 'SLURM':
+        command = ['sacct', '--noheader', '--parsable2', '--format=JobID,ElapsedRaw,MaxRSS,NNodes',
+                   '--jobs', ','.join(job_numbers)]
+    elif scheduler == 'LSF':
+        command = ['bjobs', '-a', '-noheader', '-o', "jobid run_time max_mem nexec_host delimiter='|'"] + job_numbers
+    elif scheduler == 'PBS':
+        command = ['qstat', '-x', '-f'] + get_pbs_job_ids(job_numbers, array_jobs)
+    else:
+        raise Exception("ERROR: scheduler {0} not supported".format(scheduler))
+
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout
+    except OSError as e:
+        print('WARNING: could not query job accounting: {}'.format(e))
+        return {}
+
+    return parse_job_accounting(output, scheduler)
+
+
+def parse_job_accounting(output, scheduler):
+    """
+    Parses the output of sacct, bjobs or qstat -f (as called by query_job_accounting). The elapsed time and memory
+    of a job are the maximum over its steps or array elements.
+    :param output: the scheduler output
+    :param scheduler: SLURM, LSF or PBS
+    :return: dictionary of job number: {'elapsed': seconds, 'max_rss': MB or None, 'num_nodes': nodes}
+    """
+
+    records = []
+    if scheduler == 'PBS':
+        record = None
+        for line in output.splitlines():
+            if line.startswith('Job Id:'):
+                record = {'job_number': line.split(':')[1].strip().split('.')[0].split('[')[0], 'elapsed': None,
+                          'max_rss': None, 'num_nodes': 1}
+                records.append(record)
+            elif record is not None and '=' in line:
+                key, value = [x.strip() for x in line.split('=', 1)]
+                if key == 'resources_used.walltime':
+                    record['elapsed'] = putils.walltime_to_seconds(value)
+                elif key == 'resources_used.mem':
+                    record['max_rss'] = memory_to_megabytes(value)
+                elif key == 'exec_host':
+                    record['num_nodes'] = len(set(x.split('/')[0] for x in value.split('+')))
+    else:
+        for line in output.splitlines():
+            fields = [x.strip() for x in line.split('|')]
+            if len(fields) < 4 or not fields[0]:
+                continue
+            elapsed = fields[1].split()[0] if fields[1] else ''
+            records.append({'job_number': re.split('[._\\[]', fields[0])[0],
+                            'elapsed': float(elapsed) if elapsed.isdigit() else None,
+                            'max_rss': memory_to_megabytes(fields[2]),
+                            # the steps of a SLURM job report the nodes of the step, the allocation all nodes
+                            'num_nodes': int(fields[3]) if fields[3].isdigit() else None})
+
+    accounting = {}
+    for record in records:
+        job = accounting.setdefault(record['job_number'], {'elapsed': None, 'max_rss': None, 'num_nodes': None})
+        for key in ['elapsed', 'max_rss', 'num_nodes']:
+            if record[key] is not None:
+                job[key] = record[key] if job[key] is None else max(job[key], record[key])
+
+    return {job_number: job for job_number, job in accounting.items() if not job['elapsed'] is None}
+
+
+def memory_to_megabytes(memory):
+    """
+    Converts a memory string of the schedulers (e.g. 2048K, 1.5G, 512 Mbytes, 123456kb) into MB
+    :return: memory in MB or None
+    """
+
+    match = re.match('^([0-9.]+)\\s*([KMGT]?)', memory.strip().upper())
+    if match is None or match.group(1) in ['', '.']:
+        return None
+
+    # memory without unit is in bytes
+    factor = {'K': 1. / 1024, '': 1. / 1024 ** 2, 'M': 1., 'G': 1024., 'T': 1024. ** 2}[match.group(2)]
+
+    return float(match.group(1)) * factor
+
+
+def cancel_jobs(job_numbers, scheduler):
+    """
+    Cancels the given jobs (scancel, bkill or qdel)
+    :param job_numbers: list of job numbers
+    :param scheduler: SLURM, LSF or PBS
+    """
+
+    job_numbers = [x for x in job_numbers if not x == 'None']
+    if len(job_numbers) == 0:
+        return
+
+    if scheduler == 'SLURM':
+        command = ['scancel'] + job_numbers
+    elif scheduler == 'LSF':
+        command = ['bkill'] + job_numbers
+    elif scheduler == 'PBS':
+        command = ['qdel'] + job_numbers
+    else:
+        raise Exception("ERROR: scheduler {0} not supported".format(scheduler))
+
+    print('Cancelling jobs: {}'.format(' '.join(job_numbers)))
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return
+
+
+def get_poll_interval(previous_interval, jobs_running, state_changed, seconds_to_walltime=None):
+    """
+    Adaptive poll interval for job monitoring: slow while all jobs are pending, reset to the minimum when
+    job states change (jobs of one step tend to finish together), growing again while nothing happens, and
+    short when a running job approaches its walltime.
+    :param previous_interval: the last poll interval in seconds
+    :param jobs_running: True if any job is running
+    :param state_changed: True if any job changed state since the last poll
+    :param seconds_to_walltime: seconds until the first running job reaches its walltime
+    :return: poll interval in seconds
+    """
+
+    if not jobs_running:
+        return PENDING_POLL_INTERVAL
+
+    if state_changed:
+        poll_interval = MIN_POLL_INTERVAL
     else:
-        return False
+        poll_interval = min(previous_interval * POLL_BACKOFF_FACTOR, RUNNING_POLL_INTERVAL)
+
+    if not seconds_to_walltime is None:
+        poll_interval = min(poll_interval, max(MIN_POLL_INTERVAL, seconds_to_walltime))
+
+    return poll_interval
+
 
 
 def set_job_queue_values(args):
@@ -769,6 +1784,22 @@ def set_job_queue_values(args):
                   'wall_time_factor': template['WALLTIME_FACTOR'],
                   'max_memory_per_node': template['MEM_PER_NODE']}
 
+    if template['JOB_RESOURCE_QUANTILE'] == 'auto' and os.getenv('JOB_RESOURCE_QUANTILE'):
+        template['JOB_RESOURCE_QUANTILE'] = os.getenv('JOB_RESOURCE_QUANTILE')
+
+    if template['JOB_RESOURCE_QUANTILE'] in ['auto', 'None', 'none', 'no']:
+        resource_quantile = None
+    else:
+        resource_quantile = float(template['JOB_RESOURCE_QUANTILE'])
+
+    if template['STRAGGLER_FACTOR'] == 'auto' and os.getenv('STRAGGLER_FACTOR'):
+        template['STRAGGLER_FACTOR'] = os.getenv('STRAGGLER_FACTOR')
+
+    if template['STRAGGLER_FACTOR'] in ['auto', 'None', 'none', 'no']:
+        straggler_factor = None
+    else:
+        straggler_factor = float(template['STRAGGLER_FACTOR'])
+
     for key in check_auto.keys():
         if not check_auto[key] == 'auto':
             if key == 'wall_time_factor':
@@ -826,7 +1857,7 @@ def set_job_queue_values(args):
 
     out_puts = (submission_scheme, platform_name, scheduler, check_auto['queue_name'], check_auto['number_of_cores_per_node'],
                 check_auto['number_of_threads_per_core'], check_auto['max_jobs_per_queue'],
-                check_auto['max_memory_per_node'], check_auto['wall_time_factor'])
+                check_auto['max_memory_per_node'], check_auto['wall_time_factor'], resource_quantile, straggler_factor)
 
     return out_puts
 
@@ -834,7 +1865,8 @@ def set_job_queue_values(args):
 def auto_template_not_existing_options(args):
 
     job_options = ['QUEUENAME', 'CPUS_PER_NODE', 'THREADS_PER_CORE', 'MAX_JOBS_PER_QUEUE',
-                   'WALLTIME_FACTOR', 'MEM_PER_NODE', 'job_submission_scheme']
+                   'WALLTIME_FACTOR', 'MEM_PER_NODE', 'JOB_RESOURCE_QUANTILE', 'STRAGGLER_FACTOR',
+                   'job_submission_scheme']
 
     if args.custom_template_file:
         from minsar.objects.dataset_template import Template
@@ -17,6 +17,8 @@ class PathFind:
         self.defaultdir = os.path.expandvars('${RSMASINSAR_HOME}/minsar/defaults')
         self.orbitdir = os.path.expandvars('$SENTINEL_ORBITS')
         self.auxdir = os.path.expandvars('$SENTINEL_AUX')
+        self.jobaccountingdb = os.getenv('JOB_ACCOUNTING_DB', os.path.expanduser('~/minsar_log/job_accounting.db'))
+        self.slccachedir = os.getenv('SLC_CACHE_DIR')
         self.georeferencedir = 'merged/geom_reference'
         self.minopydir = 'minopy'
         self.mintpydir = 'mintpy'
@@ -0,0 +1,230 @@
+## Preparation of downloaded dates while the download of a stack continues
+
+import os
+import re
+import json
+import glob
+import time
+import shutil
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from minsar.objects import message_rsmas
+from minsar.utils import check_download
+import minsar.utils.process_utilities as putils
+
+# seconds between checks of the download directory
+PIPELINE_POLL_INTERVAL = int(os.getenv('PIPELINE_POLL_INTERVAL', 60))
+# dates prepared at the same time
+PIPELINE_WORKERS = 4
+PIPELINE_CONFIG_DIR = 'configs_pipeline'
+# granules of the prepared dates, read by later create_runfiles.py runs (e.g. after --stop download)
+PREPARED_DATES_FILE = 'prepared_dates.json'
+SECONDARY_DIR = 'secondarys'
+UNPACK_SECONDARY_RUN_FILE = 'unpack_secondary_slc'
+
+
+class DownloadPipeline:
+    """ Unpacks the bursts of every date (topsStack unpack_secondary_slc: SentinelWrapper.py with the config written
+        by stackSentinel.py) as soon as all its granules downloaded so far are verified, while the download continues.
+        A date is prepared again if more granules of the date arrive. After the run files were created, the
+        unpack_secondary_slc tasks of the dates prepared with the configuration of stackSentinel.py are recorded as
+        completed in the ExecutionState, so that execute_runfiles.py --resume skips them. The prepared dates are
+        recorded in configs_pipeline/prepared_dates.json, so that create_runfiles.py keeps them if it runs later.
+        The SentinelWrapper.py processes (PIPELINE_WORKERS at the same time) run on the node of the caller.
+        Use as follows:
+            pipeline = DownloadPipeline(work_dir, template)
+            while download.poll() is None:
+                pipeline.prepare_new_dates()
+                time.sleep(PIPELINE_POLL_INTERVAL)
+            pipeline.finish()
+        and in create_runfiles.py (also in a later run, e.g. after process_rsmas.py --stop download):
+            pipeline = DownloadPipeline(work_dir, template)
+            with pipeline.keep_prepared_dates():
+                run_stack_workflow()
+            pipeline.record_prepared_tasks(ExecutionState(work_dir))
+    """
+
+    def __init__(self, work_dir, template):
+        self.work_dir = work_dir
+        self.slc_dir = template['topsStack.slcDir']
+        if self.slc_dir in [None, 'None']:
+            self.slc_dir = os.path.join(work_dir, 'SLC')
+        self.swaths = template['topsStack.subswath']
+        self.bbox = template['topsStack.boundingBox']
+        self.orbit_dir = template['topsStack.orbitDir']
+        self.aux_dir = template['topsStack.auxDir']
+        self.polarization = template['topsStack.polarization']
+        self.config_dir = os.path.join(work_dir, PIPELINE_CONFIG_DIR)
+        # granules of the prepared and of the running dates
+        self.prepared = read_prepared_dates(work_dir)
+        self.running = {}
+        self.executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS)
+
+    def get_ready_dates(self):
+        """ returns the downloaded granules of every date without partial downloads """
+        granules = {}
+        partial_dates = set()
+        for file in glob.glob(os.path.join(self.slc_dir, '*.zip*')):
+            date = get_granule_date(file)
+            if date is None:
+                continue
+            if file.endswith('.zip') and (check_download.is_verified(file) or is_complete_burst_download(file)):
+                granules.setdefault(date, []).append(file)
+            elif file.endswith('.part'):
+                partial_dates.add(date)
+        return {date: sorted(files) for date, files in granules.items() if date not in partial_dates}
+
+    def prepare_new_dates(self):
+        """ starts the preparation of dates that are ready and were not prepared with the same granules """
+        for date, future in list(self.running.items()):
+            if future.done():
+                granules, exit_code = future.result()
+                del self.running[date]
+                if exit_code == 0:
+                    self.prepared[date] = granules
+                    self.write_prepared_dates()
+                else:
+                    print('Preparation of {} failed (exit code {}), it is done by the run files'.format(date,
+                                                                                                    exit_code))
+
+        for date, granules in self.get_ready_dates().items():
+            if date in self.running or self.prepared.get(date) == granules:
+                continue
+            self.running[date] = self.executor.submit(self.prepare_date, date, granules)
+        return
+
+    def prepare_date(self, date, granules):
+        config_file = self.write_config(date, granules)
+        command = 'export PATH=$ISCE_STACK/topsStack:$PATH; SentinelWrapper.py -c ' + config_file
+        message_rsmas.log(self.work_dir, command)
+        with open(os.path.join(self.config_dir, 'out_' + date + '.o'), 'w') as f:
+            exit_code = subprocess.Popen(command, shell=True, stdout=f, stderr=subprocess.STDOUT).wait()
+        return granules, exit_code
+
+    def write_config(self, date, granules):
+        """ writes the unpack configuration of a date in the format of the configs of stackSentinel.py """
+        os.makedirs(self.config_dir, exist_ok=True)
+        config_file = os.path.join(self.config_dir, 'config_secondary_' + date)
+        with open(config_file, 'w') as f:
+            f.write('[Function-1]\n')
+            f.write('Sentinel1_TOPS : \n')
+            f.write('dirname : ' + ','.join(granules) + '\n')
+            f.write('swaths : ' + self.swaths + '\n')
+            f.write('orbitdir : ' + self.orbit_dir + '\n')
+            f.write('outdir : ' + os.path.join(self.work_dir, SECONDARY_DIR, date) + '\n')
+            f.write('auxdir : ' + self.aux_dir + '\n')
+            if self.bbox not in [None, 'None']:
+                f.write('bbox : ' + self.bbox + '\n')
+            f.write('pol : ' + self.polarization + '\n')
+        return config_file
+
+    def write_prepared_dates(self):
+        os.makedirs(self.config_dir, exist_ok=True)
+        prepared_dates_file = os.path.join(self.config_dir, PREPARED_DATES_FILE)
+        with open(prepared_dates_file + '.tmp', 'w') as f:
+            json.dump(self.prepared, f)
+        os.replace(prepared_dates_file + '.tmp', prepared_dates_file)
+        return
+
+    def finish(self):
+        """ waits for the running preparations after the download ended and prepares the remaining dates """
+        self.prepare_new_dates()
+        while len(self.running) > 0:
+            time.sleep(1)
+            self.prepare_new_dates()
+        self.executor.shutdown()
+        print('Prepared {} dates while downloading'.format(len(self.prepared)))
+        return
+
+    @contextmanager
+    def keep_prepared_dates(self):
+        """ keeps the prepared dates while the run files are created (CreateRun removes the secondarys directory) """
+        secondary_dir = os.path.join(self.work_dir, SECONDARY_DIR)
+        kept_dir = os.path.join(self.config_dir, SECONDARY_DIR)
+        if os.path.isdir(secondary_dir):
+            os.replace(secondary_dir, kept_dir)
+        try:
+            yield
+        finally:
+            if os.path.isdir(kept_dir):
+                if os.path.isdir(secondary_dir):
+                    shutil.rmtree(secondary_dir)
+                os.replace(kept_dir, secondary_dir)
+
+    def record_prepared_tasks(self, state):
+        """ records the unpack_secondary_slc tasks of the prepared dates as completed if stackSentinel.py configured
+            them like the pipeline, the dates prepared otherwise are removed and unpacked by the run files.
+            Records of earlier processings of the new run files are removed """
+        for run_file in putils.read_run_list(self.work_dir):
+            state.reset_run_file(run_file)
+
+        run_files = glob.glob(os.path.join(self.work_dir, 'run_files', 'run_*_' + UNPACK_SECONDARY_RUN_FILE))
+        tasks = []
+        if len(run_files) > 0:
+            with open(run_files[0]) as f:
+                tasks = f.readlines()
+
+        completed_tasks = []
+        number_of_prepared = len(self.prepared)
+        for date, granules in list(self.prepared.items()):
+            task = [x for x in tasks if x.strip().endswith('config_secondary_' + date)]
+            config_file = os.path.join(self.work_dir, 'configs', 'config_secondary_' + date)
+            config = read_config(config_file)
+            if len(task) == 1 and config is not None and \
+                    config == read_config(os.path.join(self.config_dir, 'config_secondary_' + date)):
+                completed_tasks.append((task[0], 0, time.time(), config_file))
+            else:
+                shutil.rmtree(os.path.join(self.work_dir, SECONDARY_DIR, date), ignore_errors=True)
+                del self.prepared[date]
+
+        self.write_prepared_dates()
+
+        if len(completed_tasks) > 0:
+            state.add_tasks(run_files[0], completed_tasks)
+        print('{} of {} dates prepared while downloading are used'.format(len(completed_tasks), number_of_prepared))
+        return
+
+
+def read_prepared_dates(work_dir):
+    """ returns the granules of the dates prepared while downloading that were not removed since """
+    try:
+        with open(os.path.join(work_dir, PIPELINE_CONFIG_DIR, PREPARED_DATES_FILE)) as f:
+            prepared = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {date: granules for date, granules in prepared.items()
+            if os.path.isdir(os.path.join(work_dir, SECONDARY_DIR, date))}
+
+
+def has_prepared_dates(work_dir):
+    return len(read_prepared_dates(work_dir)) > 0
+
+
+def get_granule_date(file):
+    """ returns the acquisition date of a Sentinel-1 granule (S1A_IW_SLC__1SDV_20200101T...) """
+    match = re.search(r'_(\d{8})T\d{6}_', os.path.basename(file))
+    return match.group(1) if match else None
+
+
+def is_complete_burst_download(file):
+    if not check_download.is_burst_download(file):
+        return False
+    from minsar.utils.burst_download import read_burst_record
+    record = read_burst_record(file)
+    return record is not None and len(record.get('bounding_boxes', [])) > 0
+
+
+def read_config(config_file):
+    """ returns the options of a config file (dirname as set of file names, None if the file does not exist) """
+    if not os.path.isfile(config_file):
+        return None
+    options = {}
+    with open(config_file) as f:
+        for line in f:
+            if ':' in line:
+                key, value = [x.strip() for x in line.split(':', 1)]
+                options[key] = value
+    if 'dirname' in options:
+        options['dirname'] = set(os.path.basename(x) for x in re.split(r'[,\s]+', options['dirname']) if x)
+    return options
@@ -0,0 +1,140 @@
+## Store of the processing state of a project (steps, run files, jobs and tasks) to resume processing
+
+import os
+import time
+import sqlite3
+import hashlib
+
+EXECUTION_STATE_DB = 'execution_state.db'
+
+
+class ExecutionState:
+    """ Records processing steps, run files, jobs and tasks with their status and timing in a sqlite database in the
+        work directory, so that an interrupted processing can be resumed where it stopped.
+        A run file counts as completed only if it did not change since it was processed.
+        Use as follows:
+            state = ExecutionState(work_dir)
+            state.start_run_file(run_file)
+            state.add_job(job_number, job_file)
+            state.add_tasks(run_file, putils.get_task_exit_codes(run_file))
+            state.finish_run_file(run_file)
+            state.is_run_file_completed(run_file)
+    """
+
+    def __init__(self, work_dir):
+        self.db_file = os.path.join(work_dir, EXECUTION_STATE_DB)
+
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS steps (
+                                  step TEXT PRIMARY KEY, status TEXT, start_time REAL, end_time REAL)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS run_files (
+                                  run_file TEXT PRIMARY KEY, checksum TEXT, status TEXT,
+                                  start_time REAL, end_time REAL)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                  job_id TEXT PRIMARY KEY, job_file TEXT, state TEXT,
+                                  submit_time REAL, end_time REAL)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                                  run_file TEXT, task TEXT, exit_code INTEGER, end_time REAL, artifact TEXT,
+                                  PRIMARY KEY (run_file, task))""")
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def start_step(self, step):
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO steps VALUES (?, 'running', ?, NULL)", (step, time.time()))
+
+    def finish_step(self, step):
+        with self.connect() as connection:
+            connection.execute("UPDATE steps SET status = 'completed', end_time = ? WHERE step = ?",
+                               (time.time(), step))
+
+    def is_step_completed(self, step):
+        with self.connect() as connection:
+            row = connection.execute("SELECT status FROM steps WHERE step = ?", (step,)).fetchone()
+        return row is not None and row[0] == 'completed'
+
+    def start_run_file(self, run_file):
+        """ records the start of a run file. Tasks recorded for a changed run file are discarded """
+        checksum = get_checksum(run_file)
+        with self.connect() as connection:
+            row = connection.execute("SELECT checksum FROM run_files WHERE run_file = ?", (run_file,)).fetchone()
+            if row is not None and not row[0] == checksum:
+                connection.execute("DELETE FROM tasks WHERE run_file = ?", (run_file,))
+            connection.execute("INSERT OR REPLACE INTO run_files VALUES (?, ?, 'running', ?, NULL)",
+                               (run_file, checksum, time.time()))
+
+    def finish_run_file(self, run_file):
+        with self.connect() as connection:
+            connection.execute("UPDATE run_files SET status = 'completed', end_time = ? WHERE run_file = ?",
+                               (time.time(), run_file))
+
+    def get_run_file_status(self, run_file):
+        """ returns 'running', 'completed', 'changed' (run file changed since it was processed) or None """
+        with self.connect() as connection:
+            row = connection.execute("SELECT status, checksum FROM run_files WHERE run_file = ?",
+                                     (run_file,)).fetchone()
+        if row is None:
+            return None
+        if not row[1] == get_checksum(run_file):
+            return 'changed'
+        return row[0]
+
+    def is_run_file_completed(self, run_file):
+        return self.get_run_file_status(run_file) == 'completed'
+
+    def reset_run_file(self, run_file):
+        """ forgets the processing of a run file and its tasks (e.g. after the run files were created again) """
+        with self.connect() as connection:
+            connection.execute("DELETE FROM tasks WHERE run_file = ?", (run_file,))
+            connection.execute("DELETE FROM run_files WHERE run_file = ?", (run_file,))
+
+    def add_job(self, job_number, job_file):
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, 'PENDING', ?, NULL)",
+                               (str(job_number), os.path.basename(job_file), time.time()))
+
+    def update_job_states(self, job_states):
+        """ :param job_states: dictionary of job number: state """
+        with self.connect() as connection:
+            connection.executemany("UPDATE jobs SET state = ?, end_time = ? WHERE job_id = ?",
+                                   [(state, time.time(), str(job_number)) for job_number, state in job_states.items()])
+
+    def get_unfinished_jobs(self, run_file):
+        """ returns job numbers and job files of a run file that were submitted but never recorded as finished """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT job_id, job_file FROM jobs WHERE end_time IS NULL").fetchall()
+        rows = [x for x in rows if x[1].startswith(os.path.basename(run_file) + '_')]
+        return [x[0] for x in rows], [x[1] for x in rows]
+
+    def add_tasks(self, run_file, tasks):
+        """ :param tasks: list of (task, exit code, end time, artifact) """
+        with self.connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)",
+                                   [(run_file, task.strip(), exit_code, end_time, artifact)
+                                    for task, exit_code, end_time, artifact in tasks])
+
+    def get_completed_tasks(self, run_file):
+        with self.connect() as connection:
+            rows = connection.execute("SELECT task FROM tasks WHERE run_file = ? AND exit_code = 0",
+                                      (run_file,)).fetchall()
+        return set(x[0] for x in rows)
+
+    def get_progress(self):
+        """ returns the completed and running steps and the number of completed and running run files """
+        with self.connect() as connection:
+            steps = connection.execute("SELECT step, status FROM steps ORDER BY start_time").fetchall()
+            run_files = connection.execute("SELECT status, count(*) FROM run_files GROUP BY status").fetchall()
+        run_files = dict(run_files)
+        return {'steps_completed': [x[0] for x in steps if x[1] == 'completed'],
+                'steps_running': [x[0] for x in steps if x[1] == 'running'],
+                'run_files_completed': run_files.get('completed', 0),
+                'run_files_running': run_files.get('running', 0)}
+
+
+def get_checksum(file):
+    """ returns the md5 checksum of a file (None if it does not exist) """
+    if not os.path.isfile(file):
+        return None
+    with open(file, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
@@ -0,0 +1,139 @@
+## Store of completed job accounting and walltime/memory model
+
+import os
+import sqlite3
+import datetime
+import numpy as np
+from minsar.objects.auto_defaults import PathFind
+
+pathObj = PathFind()
+
+# minimum number of completed jobs of a step/platform to use the model instead of job_defaults.cfg
+MIN_SAMPLES = 5
+# number of most recent jobs used for fitting
+MAX_SAMPLES = 200
+# a timed out job took at least this factor times its elapsed time (the walltime increase of reruns)
+TIMEOUT_FACTOR = 1.2
+# iterations of the fit with the values of timed out jobs raised to the fitted values
+CENSORED_ITERATIONS = 5
+
+
+class JobAccounting:
+    """ Stores accounting information (elapsed time, MaxRSS, nodes, bursts) of finished jobs in a sqlite database
+        and fits per-step/per-platform models  value = c + num_bursts * s  (the form used in job_defaults.cfg)
+        to predict walltime and memory of the tasks of new jobs.
+        Use as follows:
+            accounting = JobAccounting()
+            accounting.add_jobs(records)
+            wall_time_seconds, memory = accounting.predict('fullBurst_resample', 'stampede2', num_bursts=30, quantile=0.95)
+    """
+
+    def __init__(self, db_file=None):
+        if db_file is None:
+            db_file = pathObj.jobaccountingdb
+        self.db_file = db_file
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_file)), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                  job_id TEXT, platform TEXT, step TEXT, job_name TEXT, state TEXT,
+                                  num_bursts INTEGER, num_tasks INTEGER, num_nodes INTEGER,
+                                  elapsed REAL, max_rss REAL, date TEXT,
+                                  PRIMARY KEY (platform, job_id))""")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_step ON jobs (step, platform, state)")
+            try:
+                # databases created before the tasks running at the same time were recorded
+                connection.execute("ALTER TABLE jobs ADD COLUMN tasks_per_node INTEGER")
+            except sqlite3.OperationalError:
+                pass
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def add_jobs(self, records):
+        """ Adds finished jobs.
+            :param records: list of dictionaries with keys job_id, platform, step, job_name, state, num_bursts,
+                            num_tasks, num_nodes, elapsed (seconds), max_rss (MB, None if unknown),
+                            tasks_per_node (tasks running at the same time on a node, None if all tasks run at once)
+        """
+        date = datetime.datetime.now().strftime('%Y%m%d:%H%M%S')
+        with self.connect() as connection:
+            connection.executemany("""INSERT OR REPLACE INTO jobs (job_id, platform, step, job_name, state,
+                                      num_bursts, num_tasks, num_nodes, elapsed, max_rss, date, tasks_per_node)
+                                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                   [(x['job_id'], x['platform'], x['step'], x['job_name'], x['state'],
+                                     x['num_bursts'], x['num_tasks'], x['num_nodes'], x['elapsed'],
+                                     x['max_rss'], date, x.get('tasks_per_node')) for x in records])
+        return
+
+    def get_jobs(self, step, platform):
+        """ returns (num_bursts, num_tasks, num_nodes, elapsed, max_rss, tasks_per_node, state) of the most recent
+            completed and timed out jobs of a step (jobs cancelled by a migration job are stored as MIGRATED and
+            not used) """
+        with self.connect() as connection:
+            rows = connection.execute("""SELECT num_bursts, num_tasks, num_nodes, elapsed, max_rss, tasks_per_node,
+                                         state FROM jobs
+                                         WHERE step = ? AND platform = ? AND state IN ('COMPLETED', 'TIMEOUT')
+                                         ORDER BY date DESC LIMIT ?""", (step, platform, MAX_SAMPLES)).fetchall()
+        return rows
+
+    def predict(self, step, platform, num_bursts, quantile=0.95):
+        """ Predicts walltime and memory of a task from previous jobs of the same step and platform.
+            The task walltime of a job is its elapsed time divided by the number of waves of tasks (tasks per node
+            divided by the tasks running at the same time on a node). Timed out jobs are lower bounds of the task
+            walltime (see fit_and_predict). The memory of a task is MaxRSS divided by the tasks running at the same
+            time on a node. The safety margin is the given quantile of the residuals of the fit.
+            :param step: step name (e.g. fullBurst_resample)
+            :param platform: platform name (e.g. stampede2)
+            :param num_bursts: number of bursts
+            :param quantile: quantile of the residuals added to the prediction
+            :return: walltime in seconds and memory in MB (None if there are not enough jobs)
+        """
+        rows = self.get_jobs(step, platform)
+        if len(rows) < MIN_SAMPLES:
+            return None, None
+
+        bursts = np.array([x[0] or 1 for x in rows], dtype=float)
+        tasks_per_node = np.array([np.ceil((x[1] or 1) / (x[2] or 1)) for x in rows], dtype=float)
+        # jobs recorded without tasks_per_node ran all their tasks at once
+        parallel_tasks = np.array([min(x[5], tasks) if x[5] else tasks for x, tasks in zip(rows, tasks_per_node)],
+                                  dtype=float)
+        waves = np.ceil(tasks_per_node / parallel_tasks)
+        elapsed = np.array([x[3] for x in rows], dtype=float)
+        timed_out = np.array([x[6] == 'TIMEOUT' for x in rows])
+
+        wall_time_seconds = fit_and_predict(bursts, elapsed / waves, num_bursts, quantile, censored=timed_out)
+
+        memory = None
+        has_memory = np.array([x[4] is not None for x in rows])
+        if np.sum(has_memory) >= MIN_SAMPLES:
+            max_rss = np.array([x[4] for x in rows if x[4] is not None], dtype=float)
+            memory = fit_and_predict(bursts[has_memory], max_rss / parallel_tasks[has_memory], num_bursts, quantile)
+
+        return wall_time_seconds, memory
+
+
+def fit_and_predict(num_bursts, values, new_num_bursts, quantile, censored=None):
+    """ Fits values = c + num_bursts * s (s >= 0) and predicts the value for new_num_bursts plus the given quantile
+        of the residuals. A constant model is used if all jobs had the same number of bursts.
+        Censored values (timed out jobs) are lower bounds: they are raised to TIMEOUT_FACTOR times the bound and
+        then iteratively to the fitted value where it is larger.
+    """
+    if censored is None:
+        censored = np.zeros(len(values), dtype=bool)
+    bounds = values * TIMEOUT_FACTOR
+    values = np.where(censored, bounds, values)
+
+    for iteration in range(CENSORED_ITERATIONS if np.any(censored) else 1):
+        if len(np.unique(num_bursts)) > 1:
+            s, c = np.polyfit(num_bursts, values, 1)
+            if s < 0:
+                s, c = 0., np.mean(values)
+        else:
+            s, c = 0., np.mean(values)
+        values = np.where(censored, np.maximum(bounds, c + s * num_bursts), values)
+
+    residuals = values - (c + s * num_bursts)
+    prediction = c + s * new_num_bursts + max(0., np.quantile(residuals, quantile))
+
+    return float(max(prediction, np.min(values)))
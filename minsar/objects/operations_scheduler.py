@@ -0,0 +1,114 @@
+## Scheduler admitting operational datasets by priority with a global limit of queued jobs
+
+import os
+import json
+import time
+import subprocess
+from datetime import datetime
+from minsar.objects.execution_state import ExecutionState, EXECUTION_STATE_DB
+
+
+class OperationsScheduler:
+    """ Runs the processing (minsar_wrapper.bash) of several datasets with a global view of the queue.
+        Datasets are admitted by priority (SLA priority of the template, then days of data not yet processed,
+        then smaller stacks first) while fewer than max_datasets are processing and the number of queued jobs of the
+        user is below max_queued_jobs. The processing of every dataset is started with MAX_QUEUED_JOBS in its
+        environment, so that JOB_SUBMIT throttles job submissions across all datasets.
+        completion_callback(dataset) is called when the processing of a dataset ended.
+        Queue depth and per-dataset progress (from the execution_state.db of the datasets) are written to status_file.
+        Use as follows:
+            scheduler = OperationsScheduler(max_datasets=4, max_queued_jobs=50, scheduler='SLURM', status_file=file)
+            scheduler.add_dataset('GalapagosSenDT128', template_file, work_dir, sla_priority=1, days_behind=12, size=80)
+            scheduler.run()
+    """
+
+    def __init__(self, max_datasets, max_queued_jobs, scheduler, status_file, poll_interval=300,
+                 completion_callback=None):
+        self.max_datasets = max_datasets
+        self.max_queued_jobs = max_queued_jobs
+        self.scheduler = scheduler
+        self.status_file = status_file
+        self.poll_interval = poll_interval
+        self.completion_callback = completion_callback
+        self.datasets = []
+
+    def add_dataset(self, dataset, template_file, work_dir, sla_priority=0, days_behind=0, size=0):
+        self.datasets.append({'dataset': dataset, 'template_file': template_file, 'work_dir': work_dir,
+                              'sla_priority': sla_priority, 'days_behind': days_behind, 'size': size,
+                              'state': 'waiting', 'process': None, 'start_time': None, 'end_time': None})
+
+    def get_waiting_datasets(self):
+        """ returns the waiting datasets, highest priority first """
+        waiting = [x for x in self.datasets if x['state'] == 'waiting']
+        return sorted(waiting, key=lambda x: (-x['sla_priority'], -x['days_behind'], x['size']))
+
+    def get_queue_depth(self):
+        if self.scheduler is None:
+            return 0
+        from minsar.job_submission import query_queue_depth
+        return query_queue_depth(self.scheduler)
+
+    def start_dataset(self, dataset):
+        environment = dict(os.environ)
+        environment['MAX_QUEUED_JOBS'] = str(self.max_queued_jobs)
+        dataset['process'] = subprocess.Popen(['minsar_wrapper.bash', dataset['template_file']], env=environment,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        dataset['state'] = 'processing'
+        dataset['start_time'] = time.time()
+        print('Started processing of {} (priority {}, {} days behind, size {})'.format(
+            dataset['dataset'], dataset['sla_priority'], dataset['days_behind'], dataset['size']))
+
+    def update_datasets(self):
+        for dataset in self.datasets:
+            if dataset['state'] == 'processing':
+                exit_code = dataset['process'].poll()
+                if exit_code is not None:
+                    dataset['state'] = 'completed' if exit_code == 0 else 'failed'
+                    dataset['end_time'] = time.time()
+                    print('Processing of {} {}'.format(dataset['dataset'], dataset['state']))
+                    if self.completion_callback is not None:
+                        self.completion_callback(dataset)
+
+    def run(self):
+        """ admits datasets until all are processed """
+        while True:
+            self.update_datasets()
+            queue_depth = self.get_queue_depth()
+
+            processing = [x for x in self.datasets if x['state'] == 'processing']
+            for dataset in self.get_waiting_datasets():
+                if len(processing) >= self.max_datasets or queue_depth >= self.max_queued_jobs:
+                    break
+                self.start_dataset(dataset)
+                processing.append(dataset)
+
+            self.write_status(queue_depth)
+
+            if len(processing) == 0 and len(self.get_waiting_datasets()) == 0:
+                break
+            time.sleep(self.poll_interval)
+
+        return
+
+    def write_status(self, queue_depth):
+        """ writes queue depth and the state and progress of all datasets to the status file """
+        status = {'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                  'queue_depth': queue_depth,
+                  'max_queued_jobs': self.max_queued_jobs,
+                  'max_datasets': self.max_datasets,
+                  'datasets': []}
+
+        for dataset in self.datasets:
+            progress = None
+            if os.path.exists(os.path.join(dataset['work_dir'], EXECUTION_STATE_DB)):
+                progress = ExecutionState(dataset['work_dir']).get_progress()
+            status['datasets'].append({'dataset': dataset['dataset'], 'state': dataset['state'],
+                                       'sla_priority': dataset['sla_priority'], 'days_behind': dataset['days_behind'],
+                                       'size': dataset['size'], 'start_time': dataset['start_time'],
+                                       'end_time': dataset['end_time'], 'progress': progress})
+
+        with open(self.status_file + '.tmp', 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(self.status_file + '.tmp', self.status_file)
+
+        return
@@ -0,0 +1,180 @@
+## Site-wide cache of downloaded SLC granules shared by all projects
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from minsar.utils import check_download
+
+SLC_CACHE_DB = 'slc_cache.db'
+# maximum size of the cache in GB before the least recently used granules are evicted
+SLC_CACHE_MAX_SIZE = float(os.getenv('SLC_CACHE_MAX_SIZE', 20000))
+MD5_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class SLCCache:
+    """ Content-addressed cache of SLC granules (e.g. S1A_IW_SLC__1SDV_20200101T...zip) shared by all projects.
+        A granule is stored once as <cache_dir>/<granule>/<md5>.zip and hardlinked (symlinked if the cache is on
+        another file system) into the SLC directory of every project that needs it. A lock per granule makes
+        concurrent projects wait for a running download instead of downloading the same file twice. The least
+        recently used granules are evicted when the cache exceeds max_size GB.
+        The cache is used if $SLC_CACHE_DIR is set. Use as follows:
+            cache = SLCCache()
+            with cache.lock(granule):
+                if not cache.link(file):
+                    download(file)
+                    cache.add(file)
+    """
+
+    def __init__(self, cache_dir=None, max_size=SLC_CACHE_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = get_slc_cache_dir()
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024 ** 3
+
+        os.makedirs(os.path.join(self.cache_dir, 'locks'), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS granules (
+                                  granule TEXT PRIMARY KEY, md5 TEXT, size INTEGER, path TEXT,
+                                  add_time REAL, access_time REAL)""")
+
+    def connect(self):
+        return sqlite3.connect(os.path.join(self.cache_dir, SLC_CACHE_DB), timeout=60)
+
+    @contextmanager
+    def lock(self, granule, blocking=True):
+        """ exclusive lock of a granule across processes and projects. Yields False if blocking is False and the
+            granule is locked by another process """
+        with open(os.path.join(self.cache_dir, 'locks', granule + '.lock'), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, granule):
+        """ returns the cached file of a granule (None if it is not cached) and updates its access time """
+        with self.connect() as connection:
+            row = connection.execute("SELECT path, size FROM granules WHERE granule = ?", (granule,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.isfile(row[0]) or not os.path.getsize(row[0]) == row[1]:
+                connection.execute("DELETE FROM granules WHERE granule = ?", (granule,))
+                return None
+            connection.execute("UPDATE granules SET access_time = ? WHERE granule = ?", (time.time(), granule))
+        return row[0]
+
+    def link(self, file):
+        """ links the cached granule into the project as file (e.g. $SCRATCHDIR/project/SLC/granule.zip) and marks
+            it as verified. Returns False if the granule is not cached """
+        cached_file = self.get(get_granule_id(file))
+        if cached_file is None:
+            return False
+
+        if os.path.lexists(file):
+            os.remove(file)
+        try:
+            os.link(cached_file, file)
+        except OSError:
+            os.symlink(cached_file, file)
+        check_download.write_verified_marker(file, os.path.basename(cached_file).split('.')[0])
+        print('{} linked from SLC cache {}'.format(os.path.basename(file), self.cache_dir))
+        return True
+
+    def add(self, file, md5=None):
+        """ adds a downloaded and verified file to the cache and evicts the least recently used granules
+            :param file: downloaded file
+            :param md5: md5 checksum of the file (from the verified marker or computed if not given)
+        """
+        granule = get_granule_id(file)
+        cached_file = self.get(granule)
+        if cached_file is not None:
+            return cached_file
+
+        if md5 is None:
+            md5 = get_md5(file)
+        cached_file = os.path.join(self.cache_dir, granule, md5 + os.path.splitext(file)[1])
+
+        if not os.path.isfile(cached_file):
+            os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+            try:
+                os.link(file, cached_file + '.tmp')
+            except OSError:
+                shutil.copyfile(file, cached_file + '.tmp')
+            os.replace(cached_file + '.tmp', cached_file)
+
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?)",
+                               (granule, md5, os.path.getsize(cached_file), cached_file, time.time(), time.time()))
+        self.evict()
+        return cached_file
+
+    def evict(self):
+        """ removes the least recently used granules (not locked by a running download) until the cache is smaller
+            than max_size. Granules hardlinked into projects are kept: removing them would not free any space.
+            Symlinks of evicted granules are dangling and are downloaded again """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT granule, size, path FROM granules ORDER BY access_time").fetchall()
+        cache_size = sum(x[1] for x in rows)
+
+        for granule, size, path in rows:
+            if cache_size <= self.max_size:
+                break
+            with self.lock(granule, blocking=False) as locked:
+                if not locked:
+                    continue
+                if os.path.isfile(path) and os.stat(path).st_nlink > 1:
+                    continue
+                with self.connect() as connection:
+                    connection.execute("DELETE FROM granules WHERE granule = ?", (granule,))
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            cache_size -= size
+            print('Evicted {} from SLC cache ({:.0f} GB)'.format(granule, cache_size / 1024 ** 3))
+        return
+
+
+def get_granule_id(file):
+    """ returns the granule ID of a downloaded file (file name without extension) """
+    return os.path.splitext(os.path.basename(file))[0]
+
+
+def get_verified_md5(file):
+    """ returns the md5 checksum recorded when the file was verified (None if unknown) """
+    try:
+        with open(check_download.get_verified_marker(file), 'r') as f:
+            return json.load(f).get('md5')
+    except (OSError, ValueError):
+        return None
+
+
+def get_md5(file):
+    md5 = get_verified_md5(file)
+    if md5 is not None:
+        return md5
+    md5 = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(MD5_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_slc_cache_dir():
+    """ returns $SLC_CACHE_DIR. PathFind is created when needed: it requires $OPERATIONS and $SCRATCHDIR, which the
+        downloaders importing this module do not """
+    from minsar.objects.auto_defaults import PathFind
+    return PathFind().slccachedir
+
+
+def get_slc_cache():
+    """ returns the site-wide SLC cache, None if $SLC_CACHE_DIR is not set """
+    if not get_slc_cache_dir():
+        return None
+    return SLCCache()
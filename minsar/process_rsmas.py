@@ -21,6 +21,8 @@ from minsar.objects import message_rsmas
 import minsar.utils.process_utilities as putils
 from minsar.job_submission import JOB_SUBMIT
 from minsar.objects.auto_defaults import PathFind
+from minsar.objects.execution_state import ExecutionState
+from minsar.objects.download_pipeline import DownloadPipeline, PIPELINE_POLL_INTERVAL, has_prepared_dates
 
 pathObj = PathFind()
 step_list, step_help = pathObj.process_rsmas_help()
@@ -35,6 +37,8 @@ EXAMPLE = """example:
       process_rsmas.py GalapagosSenDT128.template --dostep  download        # run the step 'download' only
       process_rsmas.py GalapagosSenDT128.template --start download        # start from the step 'download'
       process_rsmas.py GalapagosSenDT128.template --stop  ifgrams         # end after step 'interferogram'
+      process_rsmas.py GalapagosSenDT128.template --resume                # skip completed steps, run files and tasks
+      process_rsmas.py GalapagosSenDT128.template --pipeline              # dem and unpacking while downloading
     """
 
 
@@ -171,17 +175,24 @@ class RsmasInsar:
         else:
             self.method = 'minopy'
 
-        return
+        # DownloadPipeline of the dates unpacked while downloading (--pipeline)
+        self.pipeline = None
 
-    def run_download_data(self):
-        """ Downloading images using download_rsmas.py script.
-        """
+        return
 
+    def clean_directories(self):
         clean_list = pathObj.isce_clean_list()
         for item in clean_list[0:int(self.template['cleanopt'])]:
             for directory in item:
                 if os.path.isdir(os.path.join(self.work_dir, directory)):
                     shutil.rmtree(os.path.join(self.work_dir, directory))
+        return
+
+    def run_download_data(self):
+        """ Downloading images using download_rsmas.py script.
+        """
+
+        self.clean_directories()
 
         scp_args = [self.custom_template_file, '--submit']
         if self.remora:
@@ -190,6 +201,44 @@ class RsmasInsar:
 
         return
 
+    def run_pipelined_download(self, steps, state):
+        """ Downloading images with the submitted download_rsmas.py job while the DEM is downloaded and every
+        downloaded date is unpacked (unpack_secondary_slc), so that no time is spent waiting for the last image.
+        dem_rsmas.py and the unpacking (PIPELINE_WORKERS SentinelWrapper.py processes) run on the node of
+        process_rsmas.py.
+        """
+
+        self.clean_directories()
+
+        dem_process = None
+        if 'dem' in steps and not (self.inps.resume_flag and state.is_step_completed('dem')):
+            state.start_step('dem')
+            command = 'dem_rsmas.py ' + self.custom_template_file + ' ' + self.dem_flag
+            message_rsmas.log(self.work_dir, command)
+            dem_process = subprocess.Popen(command, shell=True)
+
+        command = 'download_rsmas.py ' + self.custom_template_file + ' --submit'
+        if self.remora:
+            command += ' --remora'
+        message_rsmas.log(self.work_dir, command)
+        download_process = subprocess.Popen(command, shell=True)
+
+        self.pipeline = DownloadPipeline(self.work_dir, self.template)
+        while download_process.poll() is None:
+            self.pipeline.prepare_new_dates()
+            time.sleep(PIPELINE_POLL_INTERVAL)
+        self.pipeline.finish()
+
+        if dem_process is not None:
+            if dem_process.wait() != 0:
+                raise Exception('ERROR in dem_rsmas.py')
+            state.finish_step('dem')
+
+        if download_process.returncode != 0:
+            raise Exception('ERROR in download_rsmas.py')
+
+        return
+
     def run_download_dem(self):
         """ Downloading DEM using dem_rsmas.py script.
         """
@@ -212,6 +261,9 @@ class RsmasInsar:
         scp_args = [self.custom_template_file]
         if self.remora:
             scp_args += ['--remora']
+        # create_runfiles.py recorded the unpacking of the dates prepared while downloading as completed
+        if self.inps.resume_flag or has_prepared_dates(self.work_dir):
+            scp_args += ['--resume']
         minsar.execute_runfiles.main(scp_args)
         return
 
@@ -266,11 +318,24 @@ class RsmasInsar:
 
     def run(self, steps=step_list):
         # run the chosen steps
+        state = ExecutionState(self.work_dir)
         for sname in steps:
 
+            if self.inps.resume_flag and state.is_step_completed(sname):
+                print('\n\n******************** step - {} completed, skipping ********************'.format(sname))
+                continue
+
+            if sname == 'dem' and self.pipeline is not None:
+                # downloaded together with the images
+                continue
+
             print('\n\n******************** step - {} ********************'.format(sname))
+            state.start_step(sname)
+
+            if sname == 'download' and self.inps.pipeline_flag and self.inps.prefix == 'tops':
+                self.run_pipelined_download(steps, state)
 
-            if sname == 'download':
+            elif sname == 'download':
                 self.run_download_data()
 
             elif sname == 'dem':
@@ -291,6 +356,8 @@ class RsmasInsar:
             elif sname == 'imageProducts':
                 self.run_image_products()
 
+            state.finish_step(sname)
+
         # message
         msg = '\n###############################################################'
         msg += '\nNormal end of Process Rsmas routine InSAR processing workflow!'
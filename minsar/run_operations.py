@@ -7,6 +7,8 @@ import argparse
 from datetime import datetime
 import shutil
 import time
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 from minsar.utils import generate_template_files
 from minsar.objects.rsmas_logging import RsmasLogger, loglevel
@@ -15,6 +17,8 @@ from minsar.objects.dataset_template import Template
 import minsar.utils.process_utilities as putils
 from minsar.objects.auto_defaults import PathFind
 from minsar.utils.download_ssara import add_polygon_to_ssaraopt
+from minsar.objects.operations_scheduler import OperationsScheduler
+from minsar.job_submission import set_job_queue_values
 
 pathObj = PathFind()
 
@@ -25,6 +29,13 @@ TEMPLATE_DIRECTORY = os.path.join(OPERATIONS_DIRECTORY, "TEMPLATES")
 LOGS_DIRECTORY = os.path.join(OPERATIONS_DIRECTORY, "LOGS")
 ERRORS_DIRECTORY = os.path.join(OPERATIONS_DIRECTORY, "ERRORS")
 STORED_DATE_FILE = os.path.join(OPERATIONS_DIRECTORY, "stored_date.date")
+STATUS_FILE = os.path.join(LOGS_DIRECTORY, "operations_status.json")
+CATALOG_CACHE_FILE = os.path.join(OPERATIONS_DIRECTORY, "catalog_cache.json")
+
+# seconds a cached ssara_federated_query.py result is used before the catalog is queried again
+CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', 3 * 3600))
+# number of catalog queries running at the same time
+CATALOG_QUERY_THREADS = 16
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
@@ -47,6 +58,15 @@ def create_run_operations_parser():
     data_args.add_argument('--sheet_id', dest="sheet_ids", metavar='SHEET ID', action='append', nargs=1, help='sheet id to use')
     data_args.add_argument('--restart', dest='restart', action='store_true', help='remove $OPERATIONS directory before starting')
 
+    scheduling_args = parser.add_argument_group("Scheduling", "admission of datasets (highest operations_priority "
+                                                "of the template first, then most days behind, then smallest)")
+    scheduling_args.add_argument('--max_datasets', dest='max_datasets', type=int, default=4,
+                                 help='maximum number of datasets processed at the same time (default: 4)')
+    scheduling_args.add_argument('--max_queued_jobs', dest='max_queued_jobs', type=int, default=None,
+                                 help='maximum number of queued jobs of all datasets (default: MAX_JOBS_PER_QUEUE)')
+    scheduling_args.add_argument('--poll_interval', dest='poll_interval', type=int, default=300,
+                                 help='seconds between checks of queue and datasets (default: 300)')
+
     # FA 8/2019: need to use --start, --end and --step as does process_rsmas.py
     process_args = parser.add_argument_group("Processing steps", "processing Steps")
     process_args.add_argument('--startssara', dest='startssara', action='store_true', help='process_rsmas.py --startssara')
@@ -128,10 +148,11 @@ def get_datasets_to_process(template_files, dataset=None):
 
     return datasets
 
-def get_newest_data_date(template_file):
+def get_newest_data_date(template_file, catalog_cache=None):
     """
     Obtains the most recent image date for a dataset
     :param template_file: the template file corresponding to the dataset being obtained
+    :param catalog_cache: dictionary of ssara query: {'time': query time, 'newest_date': date} (read and updated)
     :return: the newest image date in "YYYY-MM-DD T H:M:S.00000" format
     """
 
@@ -150,22 +171,84 @@ def get_newest_data_date(template_file):
     ssaraopt_cmd = ['ssara_federated_query.py'] + ssaraopt + ['--print']
     ssaraopt_cmd = ' '.join(ssaraopt_cmd[:])
 
+    # the query contains platform, relativeOrbit, polygon and date range
+    if catalog_cache is not None and ssaraopt_cmd in catalog_cache:
+        if time.time() - catalog_cache[ssaraopt_cmd]['time'] < CATALOG_CACHE_TTL:
+            return datetime.strptime(catalog_cache[ssaraopt_cmd]['newest_date'], DATE_FORMAT)
+
     print(ssaraopt_cmd)
     # Yield list of images in following format:
     # ASF,Sentinel-1A,15775,2017-03-20T11:49:56.000000,2017-03-20T11:50:25.000000,128,3592,3592,IW,NA,DESCENDING,R,VV+VH,https://datapool.asf.alaska.edu/SLC/SA/S1A_IW_SLC__1SDV_20170320T114956_20170320T115025_015775_019FA4_097A.zip
     ssara_output = subprocess.check_output(ssaraopt_cmd, shell=True)
 
     newest_data = ssara_output.decode('utf-8').split("\n")[-2]
+    newest_date = datetime.strptime(newest_data.split(",")[3], DATE_FORMAT)
+
+    if catalog_cache is not None:
+        catalog_cache[ssaraopt_cmd] = {'time': time.time(), 'newest_date': newest_date.strftime(DATE_FORMAT)}
 
-    return datetime.strptime(newest_data.split(",")[3], DATE_FORMAT)
+    return newest_date
 
-def get_last_downloaded_date(dset):
+def get_newest_data_dates(template_files):
+    """
+    Obtains the most recent image dates of several datasets with concurrent catalog queries. Query results are
+    cached in CATALOG_CACHE_FILE for CATALOG_CACHE_TTL seconds.
+    :param template_files: the template files of the datasets
+    :return: dictionary of template file: newest image date (None if the query failed)
+    """
+    catalog_cache = {}
+    if os.path.exists(CATALOG_CACHE_FILE):
+        try:
+            with open(CATALOG_CACHE_FILE, 'r') as f:
+                catalog_cache = json.load(f)
+        except ValueError:
+            catalog_cache = {}
+
+    def query(template_file):
+        try:
+            return get_newest_data_date(template_file, catalog_cache)
+        except (subprocess.CalledProcessError, IndexError, ValueError) as e:
+            logger_run_operations.log(loglevel.WARNING, "{}: catalog query failed: {}".format(template_file, e))
+            return None
+
+    num_threads = max(1, min(CATALOG_QUERY_THREADS, len(template_files)))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        newest_dates = dict(zip(template_files, executor.map(query, template_files)))
+
+    with open(CATALOG_CACHE_FILE + '.tmp', 'w') as f:
+        json.dump(catalog_cache, f, indent=2)
+    os.replace(CATALOG_CACHE_FILE + '.tmp', CATALOG_CACHE_FILE)
+
+    return newest_dates
+
+def read_stored_dates():
+    """
+    Reads the last processed image dates of all datasets from the stored_date.date file (lines `dataset: date`)
+    :return: dictionary of dataset: date
     """
-    Obtains the most recent date an image was downloaded for a given dataset by reading the stored_date.date file.
+    stored_dates = {}
+    if os.path.exists(STORED_DATE_FILE):
+        with open(STORED_DATE_FILE, 'r') as date_file:
+            for line in date_file.readlines():
+                if ': ' in line:
+                    dset, date = line.strip('\n').split(': ', 1)
+                    stored_dates[dset] = datetime.strptime(date, DATE_FORMAT)
+    return stored_dates
+
+def get_last_downloaded_date(dset, stored_dates=None):
+    """
+    Obtains the most recent date an image was processed for a given dataset from the stored_date.date file.
+    Datasets not in the file yet are looked up in the newest minsar_wrapper.bash log (`Last processed image date`).
     If this is the first time images were downloaded for a given dataset, the date 01-01-1970 is used.
     :param dset: the dataset to get the most recent download date from
+    :param stored_dates: dictionary of dataset: date as returned by read_stored_dates
     :return: the most recent download date in "YYYY-MM-DD T H:M:S.00000" format
     """
+    if stored_dates is None:
+        stored_dates = read_stored_dates()
+    if dset in stored_dates:
+        return stored_dates[dset]
+
     # dataset_line = None
     # with open(STORED_DATE_FILE, 'r') as date_file:
     #     for line in date_file.readlines():
@@ -183,8 +266,6 @@ def get_last_downloaded_date(dset):
     logfiles = glob.glob("{}/*{}*.o".format(os.path.expanduser(MINSAR_LOG_DIR), dset))
     logfiles.sort(key=os.path.getctime)
 
-    print(logfiles)
-
     l = None
     if len(logfiles) > 0:
         f = logfiles[-1]
@@ -195,13 +276,32 @@ def get_last_downloaded_date(dset):
                     l = line
                     break
 
-    if l:                
-        last_date = l.split(": ")[-1]
+    if l:
+        last_date = l.split(": ")[-1].strip()
     else:
         last_date = datetime.strftime(datetime(1970, 1, 1, 0, 0, 0), DATE_FORMAT)
 
     return datetime.strptime(last_date, DATE_FORMAT)
 
+def get_dataset_size(dset):
+    """
+    Returns the number of downloaded SLC files of a dataset (used to process smaller datasets first)
+    :param dset: the dataset
+    :return: number of files in $SCRATCHDIR/dset/SLC
+    """
+    slc_dir = os.path.join(SCRATCH_DIRECTORY, dset, 'SLC')
+    if not os.path.isdir(slc_dir):
+        return 0
+    return len(glob.glob(os.path.join(slc_dir, '*.zip')))
+
+def get_sla_priority(template_file):
+    """
+    Returns the operations_priority of a template (higher is processed first, default 0)
+    :param template_file: the template file of the dataset
+    """
+    options = Template(template_file).options
+    return float(options.get('operations_priority', 0))
+
 def run_process_rsmas(inps, template_file, dataset):
     """
     Submits `process_rsmas.py` as a job for the given dataset/template_file
@@ -267,21 +367,41 @@ def overwrite_stored_date(dset, newest_date):
     :param dset: the dataset to be overriden
     :param newest_date: the new date to override with
     """
-    new_line = "{}: {}\n".format(dset, newest_date.strftime(DATE_FORMAT))
+    stored_dates = read_stored_dates()
+    stored_dates[dset] = newest_date
 
-    lines = open(STORED_DATE_FILE, 'r').readlines()
-    
-    for i, line in enumerate(lines):
-        if dset in line:
-            lines[i] = new_line
-            date_file = open(STORED_DATE_FILE, 'w')
-            date_file.writelines(lines)
-            break
-    else:
-        date_file = open(STORED_DATE_FILE, 'a')
-        date_file.write(new_line)
-    
-    date_file.close()
+    with open(STORED_DATE_FILE + '.tmp', 'w') as date_file:
+        for key in sorted(stored_dates.keys()):
+            date_file.write("{}: {}\n".format(key, stored_dates[key].strftime(DATE_FORMAT)))
+    os.replace(STORED_DATE_FILE + '.tmp', STORED_DATE_FILE)
+
+def get_last_processed_date(dset):
+    """
+    Returns the date of the last image in the ssara listing of a dataset (the last processed image, as printed by
+    minsarApp.bash), None if there is no listing
+    :param dset: the dataset
+    """
+    listing_file = os.path.join(SCRATCH_DIRECTORY, dset, 'SLC', 'ssara_listing.txt')
+    if not os.path.exists(listing_file):
+        return None
+    with open(listing_file, 'r') as f:
+        lines = [line for line in f.readlines() if line.strip()]
+    try:
+        return datetime.strptime(lines[-1].split(',')[3], DATE_FORMAT)
+    except (IndexError, ValueError):
+        return None
+
+def record_processed_dataset(dataset):
+    """
+    Stores the last processed image date of a dataset that was processed successfully
+    (completion callback of OperationsScheduler)
+    :param dataset: the scheduler entry of the dataset
+    """
+    if not dataset['state'] == 'completed':
+        return
+    last_date = get_last_processed_date(dataset['dataset'])
+    if last_date is not None:
+        overwrite_stored_date(dataset['dataset'], last_date)
 
 
 def run_operations(args):
@@ -290,10 +410,11 @@ def run_operations(args):
         1. Generates the template files for all of the datasets in the provivded CSV or Google Sheet file
         2. Gets the dataset names for each template files
         for each dataset:
-            3. Gets the newest available image date from `ssara_federated_query.py`
-            4. Gets the last image date downloaded from the `stored_date.date` file
-            5. Runs `process_rsmas.py` if their is new data available
-        6. Waits for all of the output files from submitted `process_rsmas` calls to exist
+            3. Gets the newest available image date from `ssara_federated_query.py` (concurrently, cached)
+            4. Gets the last processed image date from the `stored_date.date` file
+            5. Adds the dataset to the scheduler if there is new data available
+        6. Runs `minsar_wrapper.bash` for the datasets by priority, limiting the number of datasets processed at
+           the same time and the number of queued jobs (see OperationsScheduler)
     :param args: command line arguments to use
     """
     inps = command_line_parse(args)
@@ -315,26 +436,40 @@ def run_operations(args):
 
     logger_run_operations.log(loglevel.INFO, "Datasets to Process: {}".format(datasets))
 
-    output_files = []
-    job_to_dset = {}
+    queue_values = set_job_queue_values(argparse.Namespace(queue=None, custom_template_file=None))
+    scheduler_name = queue_values[2]
+    if inps.max_queued_jobs is None:
+        inps.max_queued_jobs = queue_values[6]
 
-    for dset in datasets:
+    scheduler = OperationsScheduler(inps.max_datasets, inps.max_queued_jobs, scheduler_name, STATUS_FILE,
+                                    inps.poll_interval, completion_callback=record_processed_dataset)
 
-        template_file = "{}/{}.template".format(TEMPLATE_DIRECTORY, dset)
+    template_files = ["{}/{}.template".format(TEMPLATE_DIRECTORY, dset) for dset in datasets]
+    newest_dates = get_newest_data_dates(template_files)
+    stored_dates = read_stored_dates()
+
+    for dset, template_file in zip(datasets, template_files):
 
         logger_run_operations.log(loglevel.INFO, "{}: {}".format(dset, template_file))
 
-        newest_date = get_newest_data_date(template_file)
-        last_date = get_last_downloaded_date(dset)
+        newest_date = newest_dates[template_file]
+        last_date = get_last_downloaded_date(dset, stored_dates)
 
-        print(newest_date)
-        print(last_date)
+        print(dset, newest_date, last_date)
 
-        if newest_date > last_date:
-            print("Submitting minsar_wrapper.bash for {}".format(putils.get_project_name(template_file)))
-            subprocess.Popen(["minsar_wrapper.bash", template_file], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        if newest_date is None:
+            print("SKIPPING (catalog query failed)")
+        elif newest_date > last_date:
+            print("Scheduling minsar_wrapper.bash for {}".format(putils.get_project_name(template_file)))
+            days_behind = (newest_date - last_date).days
+            scheduler.add_dataset(dset, template_file, os.path.join(SCRATCH_DIRECTORY, dset),
+                                  sla_priority=get_sla_priority(template_file), days_behind=days_behind,
+                                  size=get_dataset_size(dset))
         else:
             print("SKIPPING")
+
+    scheduler.run()
+
     print("-------------- run_operations.py has completed. Exiting now. -------------- \n\n\n\n\n\n\n")
 
     sys.exit(0)
@@ -0,0 +1,283 @@
+## Burst-level retrieval of Sentinel-1 SLC zips with HTTP range requests
+
+import io
+import os
+import json
+import struct
+import zipfile
+import xml.etree.ElementTree as ET
+import requests
+from minsar.utils.download_ASF_serial import merge_ranges, get_missing_ranges
+from minsar.utils.check_download import BURST_DIRECTORY
+# minimum size of a range request (the small reads of zip and TIFF structures are combined)
+RANGE_BLOCK_SIZE = 256 * 1024
+RANGE_CHUNK_SIZE = 4 * 1024 * 1024
+# bursts retrieved before and after the bursts intersecting the bounding box
+BURST_MARGIN = 1
+ZIP_LOCAL_HEADER_SIZE = 30
+TIFF_TYPES = {3: 'H', 4: 'I'}
+TIFF_IMAGE_LENGTH = 257
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+
+
+class BurstDownloadError(Exception):
+    """ Raised if the bursts of a zip cannot be retrieved with range requests (compressed measurement files) """
+
+
+class RangeFile(io.RawIOBase):
+    """ Read-only file object of a remote file. The bytes read are fetched with HTTP range requests and written at the
+        same offsets into a sparse local copy of the file, bytes already in the local copy are read from it.
+        Use as follows:
+            with RangeFile(session, url, local_file, size, ranges=[]) as f:
+                zf = zipfile.ZipFile(f)
+                f.fetch(start, end)
+    """
+
+    def __init__(self, session, url, local_file, size, ranges=None, timeout=(60, 300)):
+        self.session = session
+        self.url = url
+        self.size = size
+        self.ranges = merge_ranges(ranges or [])
+        self.timeout = timeout
+        self.position = 0
+        self.fd = os.open(local_file, os.O_RDWR)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        self.fetch(self.position, end, block_size=RANGE_BLOCK_SIZE)
+        data = os.pread(self.fd, end - self.position, self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def fetch(self, start, end, block_size=0):
+        """ fetches the bytes [start, end) (at least block_size bytes) that are not in the local copy """
+        end = min(max(end, start + block_size), self.size)
+        for missing_start, missing_end in get_missing_ranges(self.ranges, end):
+            if missing_end <= start:
+                continue
+            missing_start, missing_end = max(missing_start, start), min(missing_end, end)
+            position = missing_start
+            headers = {'Range': 'bytes={0}-{1}'.format(missing_start, missing_end - 1)}
+            try:
+                with self.session.get(self.url, stream=True, timeout=self.timeout, headers=headers) as response:
+                    if not response.status_code == 206:
+                        raise requests.exceptions.RequestException(
+                            'status {0} for range request'.format(response.status_code))
+                    for chunk in response.iter_content(chunk_size=RANGE_CHUNK_SIZE):
+                        chunk = chunk[:missing_end - position]
+                        os.pwrite(self.fd, chunk, position)
+                        position += len(chunk)
+                        if position >= missing_end:
+                            break
+            finally:
+                self.ranges = merge_ranges(self.ranges + [[missing_start, position]])
+            if position < missing_end:
+                raise requests.exceptions.RequestException(
+                    'range {0}-{1} ended at {2}'.format(missing_start, missing_end - 1, position))
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+def download_bursts(session, url, download_file, bounding_box, timeout=(60, 300)):
+    """
+    Downloads the parts of a Sentinel-1 SLC zip needed to process the bursts intersecting the bounding box into a
+    sparse local zip with the layout of the remote zip: the central directory, all annotation, calibration and
+    manifest files, the TIFF headers of the measurement files and the lines of the bursts (plus BURST_MARGIN bursts).
+    The stack processing reads the local zip through /vsizip like a complete download. The fetched ranges are
+    recorded in .bursts/<file>.json, so that other bounding boxes or a complete download add the missing ranges.
+    :param session: requests session (with the ASF cookies)
+    :param url: url of the zip
+    :param download_file: local zip
+    :param bounding_box: [south, north, west, east]
+    :return: number of bytes fetched and size of the remote zip
+    :raises BurstDownloadError: if a measurement file is compressed (its lines are not at fixed offsets)
+    """
+    response = session.head(url, allow_redirects=True, timeout=timeout[0])
+    response.raise_for_status()
+    file_size = int(response.headers['Content-Length'])
+    etag = response.headers.get('ETag')
+
+    record = read_burst_record(download_file)
+    if record is None or not record['size'] == file_size or (etag and not record.get('etag') == etag):
+        record = {'url': url, 'size': file_size, 'etag': etag, 'ranges': [], 'bounding_boxes': []}
+        with open(download_file, 'wb') as f:
+            f.truncate(file_size)
+    if bounding_box in record['bounding_boxes']:
+        return 0, file_size
+
+    fetched_bytes = sum(end - start for start, end in record['ranges'])
+    range_file = RangeFile(session, url, download_file, file_size, record['ranges'], timeout=timeout)
+    try:
+        with zipfile.ZipFile(range_file) as zf:
+            members = sorted(zf.infolist(), key=lambda x: x.header_offset)
+            ends = [x.header_offset for x in members[1:]] + [zf.start_dir]
+            compressed = [x.filename for x in members if is_measurement(x.filename) and
+                          not x.compress_type == zipfile.ZIP_STORED]
+            if compressed:
+                raise BurstDownloadError('compressed measurement files: {0}'.format(', '.join(compressed)))
+
+            # everything except the measurement files is small and needed (annotation, calibration, manifest)
+            metadata_ranges = [[info.header_offset, end] for info, end in zip(members, ends)
+                               if not is_measurement(info.filename)]
+            for start, end in merge_ranges(metadata_ranges):
+                range_file.fetch(start, end)
+
+            for info in members:
+                if not is_measurement(info.filename):
+                    continue
+                annotation = get_annotation_name(info.filename)
+                if annotation not in zf.namelist():
+                    continue
+                lines = get_burst_lines(zf.read(annotation), bounding_box)
+                if lines is None:
+                    continue
+                offset = get_member_data_offset(range_file, info)
+                for start, end in get_tiff_line_ranges(range_file, offset, lines[0], lines[1]):
+                    range_file.fetch(offset + start, offset + end)
+                print(' > {0}: lines {1}-{2}'.format(os.path.basename(info.filename), lines[0], lines[1] - 1))
+    finally:
+        range_file.close()
+        record['ranges'] = range_file.ranges
+        write_burst_record(download_file, record)
+
+    record['bounding_boxes'].append(bounding_box)
+    write_burst_record(download_file, record)
+
+    return sum(end - start for start, end in record['ranges']) - fetched_bytes, file_size
+
+
+def is_measurement(member):
+    return '/measurement/' in member and member.endswith('.tiff')
+
+
+def get_annotation_name(measurement):
+    """ returns the annotation xml of a measurement tiff (SAFE/measurement/x.tiff -> SAFE/annotation/x.xml) """
+    safe = measurement.split('/measurement/')[0]
+    return safe + '/annotation/' + os.path.basename(measurement).replace('.tiff', '.xml')
+
+
+def get_burst_lines(annotation, bounding_box):
+    """ returns the first and last + 1 line of the bursts intersecting the bounding box (None if no burst does)
+        using the geolocation grid of the annotation xml
+        :param annotation: content of the annotation xml
+        :param bounding_box: [south, north, west, east]
+    """
+    root = ET.fromstring(annotation)
+    lines_per_burst = int(root.find('swathTiming/linesPerBurst').text)
+    number_of_bursts = len(root.findall('swathTiming/burstList/burst'))
+    points = [(int(x.find('line').text), float(x.find('latitude').text), float(x.find('longitude').text))
+              for x in root.findall('geolocationGrid/geolocationGridPointList/geolocationGridPoint')]
+    south, north, west, east = bounding_box
+
+    selected = []
+    for burst in range(number_of_bursts):
+        burst_points = [x for x in points if burst * lines_per_burst <= x[0] <= (burst + 1) * lines_per_burst]
+        if len(burst_points) == 0:
+            continue
+        latitudes = [x[1] for x in burst_points]
+        longitudes = [x[2] for x in burst_points]
+        if min(latitudes) < north and max(latitudes) > south and min(longitudes) < east and max(longitudes) > west:
+            selected.append(burst)
+
+    if len(selected) == 0:
+        return None
+    first_burst = max(0, selected[0] - BURST_MARGIN)
+    last_burst = min(number_of_bursts, selected[-1] + 1 + BURST_MARGIN)
+    return first_burst * lines_per_burst, last_burst * lines_per_burst
+
+
+def get_member_data_offset(range_file, info):
+    """ returns the offset of the data of a zip member from its local header """
+    range_file.seek(info.header_offset)
+    header = range_file.read(ZIP_LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def get_tiff_line_ranges(range_file, offset, first_line, last_line):
+    """ returns the byte ranges [start, end) relative to the TIFF start of the lines [first_line, last_line) of an
+        uncompressed striped TIFF (the Sentinel-1 measurement files) """
+    range_file.seek(offset)
+    header = range_file.read(8)
+    endian = '<' if header[:2] == b'II' else '>'
+    if not struct.unpack(endian + 'H', header[2:4])[0] == 42:
+        raise Exception('Only classic TIFF files are supported')
+
+    range_file.seek(offset + struct.unpack(endian + 'I', header[4:8])[0])
+    number_of_entries = struct.unpack(endian + 'H', range_file.read(2))[0]
+    entries = range_file.read(12 * number_of_entries)
+    tags = {}
+    for i in range(number_of_entries):
+        tag, tag_type, count, value = struct.unpack(endian + 'HHI4s', entries[12 * i:12 * i + 12])
+        if tag_type not in TIFF_TYPES:
+            continue
+        size = struct.calcsize(TIFF_TYPES[tag_type]) * count
+        if size > 4:
+            range_file.seek(offset + struct.unpack(endian + 'I', value)[0])
+            value = range_file.read(size)
+        tags[tag] = struct.unpack(endian + TIFF_TYPES[tag_type] * count, value[:size])
+
+    if not tags.get(TIFF_COMPRESSION, (1,))[0] == 1:
+        raise BurstDownloadError('Only uncompressed TIFF files are supported')
+    rows_per_strip = tags.get(TIFF_ROWS_PER_STRIP, tags[TIFF_IMAGE_LENGTH])[0]
+    strip_offsets = tags[TIFF_STRIP_OFFSETS]
+    strip_byte_counts = tags[TIFF_STRIP_BYTE_COUNTS]
+
+    strips = range(first_line // rows_per_strip, min(-(-last_line // rows_per_strip), len(strip_offsets)))
+    return merge_ranges([[strip_offsets[x], strip_offsets[x] + strip_byte_counts[x]] for x in strips])
+
+
+def get_burst_record(file):
+    return os.path.join(os.path.dirname(os.path.abspath(file)), BURST_DIRECTORY, os.path.basename(file) + '.json')
+
+
+def read_burst_record(file):
+    """ returns the record of a burst download: {'url', 'size', 'etag', 'ranges', 'bounding_boxes'} (None if the file
+        is not a burst download) """
+    if not os.path.isfile(file) or not os.path.isfile(get_burst_record(file)):
+        return None
+    try:
+        with open(get_burst_record(file), 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_burst_record(file, record):
+    record_file = get_burst_record(file)
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    with open(record_file + '.tmp', 'w') as f:
+        json.dump(record, f)
+    os.replace(record_file + '.tmp', record_file)
+
+
+def remove_burst_record(file):
+    if os.path.exists(get_burst_record(file)):
+        os.remove(get_burst_record(file))
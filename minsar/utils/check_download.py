@@ -10,14 +10,41 @@
 import os
 import glob
 import sys
-import argparse
+import json
+import time
+import struct
 import zipfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from minsar.objects import message_rsmas
 
+# zip records (https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT)
+EOCD_SIGNATURE = b'PK\x05\x06'
+ZIP64_EOCD_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_EOCD_SIGNATURE = b'PK\x06\x06'
+CENTRAL_DIRECTORY_SIGNATURE = b'PK\x01\x02'
+CENTRAL_DIRECTORY_ENTRY_SIZE = 46
+EOCD_SIZE = 22
+ZIP64_EOCD_LOCATOR_SIZE = 20
+ZIP64_EOCD_SIZE = 56
+# the end of central directory record is followed by a comment of at most 65535 bytes
+MAX_EOCD_SEARCH = EOCD_SIZE + 65535
+
+# downloaders record verified files in this subdirectory of the download directory
+VERIFIED_DIRECTORY = '.verified'
+
+# burst downloads (sparse zips with the bursts of a bounding box, see burst_download.py) are recorded here
+BURST_DIRECTORY = '.bursts'
+
+# read size for the CRC check of zip members (--deep)
+DEEP_CHECK_CHUNK_SIZE = 16 * 1024 * 1024
+
 
 EXAMPLE = """example:
-  check_downloads.py  $TESTDATA_ISCE/project/SLC/
-  check_downloads.py  $TESTDATA_ISCE/project/SLC/ --delete
+  check_download.py  $TESTDATA_ISCE/project/SLC/
+  check_download.py  $TESTDATA_ISCE/project/SLC/ --delete
+  check_download.py  $TESTDATA_ISCE/project/SLC/ --json
+  check_download.py  $TESTDATA_ISCE/project/SLC/ --deep --threads 16
 """
 
 def create_parser():
@@ -27,6 +54,12 @@ def create_parser():
 
     parser.add_argument('inputdir', nargs=1, help='directory for download zipfiles')
     parser.add_argument('--delete', action='store_true', default=False, help='whether delete data.')
+    parser.add_argument('--deep', action='store_true', default=False,
+                        help='check the CRC of all zip members (reads all data, includes verified files)')
+    parser.add_argument('--json', dest='json_flag', action='store_true', default=False,
+                        help='print the results as json')
+    parser.add_argument('--threads', dest='num_threads', type=int, default=None,
+                        help='number of files (members with --deep) checked at the same time (default: 32)')
 
     return parser
 
@@ -39,24 +72,178 @@ def cmd_line_parse(iargs=None):
     return inps
 
 
-def check_zipfiles(inps):
+def get_zip_error(file):
     """
-    check download zipfiles and get the reports
+    Checks the structure of a zip file from its tail: the end of central directory record (zip64 record if needed)
+    and the central directory it points to. Only these records are read (with pread), not the data.
+    :param file: zip file
+    :return: reason why the zip file is bad, None if it is good
     """
-    inputdir = "".join(inps.inputdir)
-    os.chdir(inputdir)
-    filelist = glob.glob('*.zip')
-    broken_list = []
-    for file in filelist:
-        try:
-            zf = zipfile.ZipFile(file,'r')
-        except zipfile.BadZipFile:
-            broken_list.append(file)
-    if broken_list:
-        print('Broken zipfiles:')
-        for filename in broken_list:
-            print(filename)
-    return broken_list
+    if not os.path.isfile(file):
+        return 'file not found'
+
+    size = os.path.getsize(file)
+    if size == 0:
+        return 'empty file'
+    if size < EOCD_SIZE:
+        return 'too small for a zip file ({} bytes)'.format(size)
+
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        tail_size = min(size, MAX_EOCD_SEARCH)
+        tail = os.pread(fd, tail_size, size - tail_size)
+
+        position = tail.rfind(EOCD_SIGNATURE)
+        if position < 0 or len(tail) - position < EOCD_SIZE:
+            return 'no end of central directory record (incomplete download or server response)'
+        entries, cd_size, cd_offset = struct.unpack('<HLL', tail[position + 10:position + 20])
+        eocd_offset = size - tail_size + position
+
+        if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+            # zip64: the locator before the record points to the zip64 end of central directory record
+            locator = tail[max(0, position - ZIP64_EOCD_LOCATOR_SIZE):position]
+            if not locator[:4] == ZIP64_EOCD_LOCATOR_SIGNATURE or not len(locator) == ZIP64_EOCD_LOCATOR_SIZE:
+                return 'no zip64 end of central directory locator'
+            eocd_offset = struct.unpack('<Q', locator[8:16])[0]
+            record = os.pread(fd, ZIP64_EOCD_SIZE, eocd_offset)
+            if len(record) < ZIP64_EOCD_SIZE or not record[:4] == ZIP64_EOCD_SIGNATURE:
+                return 'bad zip64 end of central directory record'
+            entries, cd_size, cd_offset = struct.unpack('<QQQ', record[32:56])
+
+        if entries == 0:
+            return 'no members'
+        if not cd_offset + cd_size == eocd_offset:
+            return 'central directory does not end at the end of central directory record'
+
+        central_directory = os.pread(fd, cd_size, cd_offset)
+    finally:
+        os.close(fd)
+
+    position = 0
+    for entry in range(entries):
+        header = central_directory[position:position + CENTRAL_DIRECTORY_ENTRY_SIZE]
+        if len(header) < CENTRAL_DIRECTORY_ENTRY_SIZE or not header[:4] == CENTRAL_DIRECTORY_SIGNATURE:
+            return 'bad central directory entry {}'.format(entry + 1)
+        name_length, extra_length, comment_length = struct.unpack('<HHH', header[28:34])
+        local_header_offset = struct.unpack('<L', header[42:46])[0]
+        if not local_header_offset == 0xFFFFFFFF and local_header_offset >= cd_offset:
+            return 'member {} starts after the central directory'.format(entry + 1)
+        position += CENTRAL_DIRECTORY_ENTRY_SIZE + name_length + extra_length + comment_length
+
+    if not position == cd_size:
+        return 'central directory size does not match its {} entries'.format(entries)
+
+    return None
+
+
+def check_end_of_central_directory(file):
+    """
+    Checks that a zip file is complete (see get_zip_error)
+    :param file: zip file
+    :return: True if the zip file is complete
+    """
+    return get_zip_error(file) is None
+
+
+def get_members_crc_error(file, members):
+    """
+    Reads zip members and checks their CRC
+    :param file: zip file
+    :param members: names of the members
+    :return: reason why a member is bad, None if all are good
+    """
+    with zipfile.ZipFile(file, 'r') as zf:
+        for member in members:
+            try:
+                with zf.open(member) as f:
+                    while f.read(DEEP_CHECK_CHUNK_SIZE):
+                        pass
+            except (zipfile.BadZipFile, OSError, EOFError, NotImplementedError) as e:
+                return '{}: {}'.format(member, e)
+    return None
+
+
+def get_verified_marker(file):
+    return os.path.join(os.path.dirname(os.path.abspath(file)), VERIFIED_DIRECTORY, os.path.basename(file) + '.json')
+
+
+def write_verified_marker(file, md5=None, md5_checked=False):
+    """
+    Records that a downloaded file passed the size and zip checks. The md5 checksum computed while downloading is
+    recorded as the key of the SLC cache; it is an integrity check only if it was compared with the catalogue md5
+    :param file: downloaded file
+    :param md5: md5 checksum of the file
+    :param md5_checked: True if the md5 checksum matched the md5 given by the catalogue
+    """
+    marker = get_verified_marker(file)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with open(marker + '.tmp', 'w') as f:
+        json.dump({'size': os.path.getsize(file), 'md5': md5, 'md5_checked': md5_checked, 'time': time.time()}, f)
+    os.replace(marker + '.tmp', marker)
+
+
+def is_verified(file):
+    """
+    Returns True if a file was verified and did not change since
+    :param file: downloaded file
+    """
+    marker = get_verified_marker(file)
+    if not os.path.isfile(file) or not os.path.isfile(marker):
+        return False
+    try:
+        with open(marker, 'r') as f:
+            record = json.load(f)
+    except ValueError:
+        return False
+    return record['size'] == os.path.getsize(file) and os.path.getmtime(marker) >= os.path.getmtime(file)
+
+
+def is_burst_download(file):
+    """
+    Returns True if a file is a burst download (checked range by range while downloading, incomplete by design)
+    :param file: downloaded file
+    """
+    return os.path.isfile(os.path.join(os.path.dirname(os.path.abspath(file)), BURST_DIRECTORY,
+                                       os.path.basename(file) + '.json'))
+
+
+def check_zipfiles(files, deep=False, num_threads=None):
+    """
+    Checks zip files at the same time (see get_zip_error). With deep, the CRC of the members of all structurally
+    good files are checked at the same time as well.
+    :param files: zip files
+    :param deep: check the CRC of all members
+    :param num_threads: number of files (members) checked at the same time (default: 32)
+    :return: list of results {'file', 'size', 'valid', 'reason'}
+    """
+    if num_threads is None:
+        num_threads = 32
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        reasons = list(executor.map(get_zip_error, files))
+
+        results = []
+        for file, reason in zip(files, reasons):
+            size = os.path.getsize(file) if os.path.isfile(file) else None
+            results.append({'file': file, 'size': size, 'valid': reason is None, 'reason': reason})
+
+        if deep:
+            # the members of a file are split into up to num_threads groups
+            member_groups = []
+            for result in results:
+                if result['valid']:
+                    with zipfile.ZipFile(result['file'], 'r') as zf:
+                        names = [name for name in zf.namelist() if not name.endswith('/')]
+                    num_groups = max(1, min(num_threads, len(names)))
+                    member_groups += [(result, names[i::num_groups]) for i in range(num_groups)]
+
+            member_errors = executor.map(lambda x: get_members_crc_error(x[0]['file'], x[1]), member_groups)
+            for (result, members), error in zip(member_groups, member_errors):
+                if error is not None and result['valid']:
+                    result['valid'] = False
+                    result['reason'] = 'CRC error in member {}'.format(error)
+
+    return results
 
 
 def delete_files(inps,broken_list):
@@ -64,55 +251,55 @@ def delete_files(inps,broken_list):
     inputdir = "".join(inps.inputdir)
     os.chdir(inputdir)
     for file in broken_list:
-        real_path = os.path.realpath(file)
-        if os.path.exists(real_path):
-            os.remove(real_path)
-            message_rsmas.log(os.getcwd(), os.path.basename(__file__) + ': deleting ' + real_path )
+        # only the project entry is removed: a symlink or hardlink into the SLC cache must not delete the cached
+        # granule of the other projects
+        if os.path.lexists(file):
+            os.remove(file)
+            if os.path.exists(get_verified_marker(file)):
+                os.remove(get_verified_marker(file))
+            message_rsmas.log(os.getcwd(), os.path.basename(__file__) + ': deleting ' + file )
     return
 
-def check_size(inps):
-    """check file size equal to 0 bit and 1568 bit"""
-    inputdir = "".join(inps.inputdir)
-    os.chdir(inputdir)
-    filelist = glob.glob('*.zip')
-    bit_0_list = []
-    bit_1568_list = []
-    for file in filelist:
-        real_path = os.path.realpath(file)
-        size_byte = os.path.getsize(real_path)
-        size_bit = size_byte / 8
-        if size_bit == 0:
-            bit_0_list.append(file)
-        if size_bit == 1568:
-            bit_1568_list.append(file)
-    if bit_0_list:
-        print('Files with 0-bit size:')
-        for file_0 in bit_0_list:
-            print(file_0)
-    if bit_1568_list:
-        print('Files with 1568-bit size:')
-        for file_1568 in bit_1568_list:
-            print(file_1568)
-    return bit_0_list,bit_1568_list       
-             
 ##############################################################################
 def main(iargs=None):
     inps = cmd_line_parse(iargs)
 
-    broken_files = check_zipfiles(inps)
-    bit_0_files,bit_1568_files = check_size(inps)
+    inputdir = "".join(inps.inputdir)
+    os.chdir(inputdir)
+
+    # files verified while downloading are only checked again with --deep
+    filelist = sorted([file for file in glob.glob('*.zip') if not is_burst_download(file)])
+    if not inps.deep:
+        filelist = [file for file in filelist if not is_verified(file)]
+
+    results = check_zipfiles(filelist, deep=inps.deep, num_threads=inps.num_threads)
 
-    bad_files = broken_files + bit_0_files + bit_1568_files
-    bad_files = list(set(bad_files))
+    for result in results:
+        if result['valid'] and not is_verified(result['file']):
+            write_verified_marker(result['file'])
+
+    bad_files = [result['file'] for result in results if not result['valid']]
     number_of_files = len(bad_files)
-    print ('Number of bad files: ', number_of_files)
+
+    if inps.json_flag:
+        print(json.dumps({'directory': os.path.abspath(inputdir), 'number_of_files': len(results),
+                          'number_of_bad_files': number_of_files, 'deep': inps.deep, 'results': results}, indent=2))
+    else:
+        if bad_files:
+            print('Broken zipfiles:')
+            for result in results:
+                if not result['valid']:
+                    print('{}  ({})'.format(result['file'], result['reason']))
+        print ('Number of bad files: ', number_of_files)
 
     if inps.delete and number_of_files > 0:
-        print ('Number of files deleted: ', number_of_files)
+        if not inps.json_flag:
+            print ('Number of files deleted: ', number_of_files)
         delete_files(inps,bad_files)
-        
+
+    return bad_files
+
 
 ##########################################################################
 if __name__ == '__main__':
     main(sys.argv[1:])
-
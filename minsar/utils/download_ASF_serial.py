@@ -30,13 +30,19 @@ import sys
 import csv
 import os
 import os.path
-import tempfile
-import shutil
-import re
 from minsar.objects import message_rsmas
 import base64
 import time
 import ssl
+import json
+import hashlib
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from minsar.utils import check_download
+from minsar.objects.slc_cache import get_slc_cache
 
 import xml.etree.ElementTree as ET
 
@@ -61,6 +67,24 @@ except ImportError as e:
     from http.cookiejar import MozillaCookieJar
     from io import StringIO
 
+# default number of files downloaded at the same time (--concurrency=N)
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 4))
+# read buffer size for downloads
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+# read buffer size of byte range downloads (--ranges) and minimum file size to split a file into ranges
+RANGE_CHUNK_SIZE = 4 * 1024 * 1024
+MIN_RANGE_FILE_SIZE = 64 * 1024 * 1024
+# attempts for every byte range
+RANGE_RETRIES = 5
+# seconds without received bytes after which a stream is restarted with a Range request (--stall_window=N),
+# number of restarts of a stalled file and seconds between progress reports of the streams
+STALL_WINDOW = int(os.getenv('DOWNLOAD_STALL_WINDOW', 300))
+STALL_RETRIES = 5
+PROGRESS_INTERVAL = 60
+# throughput of every downloaded file
+THROUGHPUT_LOG = 'download_throughput.log'
+URS_AUTHORIZE_URL = 'https://urs.earthdata.nasa.gov/oauth/authorize'
+
 
 class bulk_downloader:
     def __init__(self):
@@ -94,6 +118,21 @@ class bulk_downloader:
         # For SSL
         self.context = {}
 
+        # Number of byte ranges of a file downloaded at the same time (--ranges=N)
+        self.num_ranges = 1
+
+        # Number of files downloaded at the same time (--concurrency=N)
+        self.max_concurrent_downloads = MAX_CONCURRENT_DOWNLOADS
+
+        # Seconds without progress after which a stream is restarted (--stall_window=N)
+        self.stall_window = STALL_WINDOW
+
+        # Site-wide cache of granules shared by all projects ($SLC_CACHE_DIR)
+        self.slc_cache = get_slc_cache()
+
+        # Download only the bursts intersecting the bounding box [south, north, west, east] (--bounding_box=S,N,W,E)
+        self.bounding_box = None
+
         # Check if user handed in a Metalink or CSV:
         if len(sys.argv) > 0:
             download_files = []
@@ -109,6 +148,18 @@ class bulk_downloader:
                         # Python 2.6 won't complain about SSL Validation
                         pass
 
+                elif arg.startswith('--ranges='):
+                    self.num_ranges = max(1, int(arg.split('=')[1]))
+
+                elif arg.startswith('--concurrency='):
+                    self.max_concurrent_downloads = max(1, int(arg.split('=')[1]))
+
+                elif arg.startswith('--stall_window='):
+                    self.stall_window = max(1, int(arg.split('=')[1]))
+
+                elif arg.startswith('--bounding_box='):
+                    self.bounding_box = [float(x) for x in arg.split('=')[1].split(',')]
+
                 elif arg.endswith('.metalink') or arg.endswith('.csv'):
                     if os.path.isfile(arg):
                         input_files.append(arg)
@@ -300,160 +351,350 @@ class bulk_downloader:
 
         return False
 
+    # Session with a keep-alive connection sharing the URS cookie jar (the cookie jar is thread-safe). Every thread
+    # uses its own session: requests does not guarantee that a session is thread-safe
+    def get_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.cookies = self.cookie_jar
+        if 'context' in self.context:
+            session.verify = False
+        return session
+
+    # Bytes received per stream, reported by the watchdog
+    def start_stream(self, name, file_size):
+        with self.streams_lock:
+            self.streams[name] = {'bytes': 0, 'size': file_size, 'reported_bytes': 0, 'reported_time': time.time()}
+
+    def update_stream(self, name, num_bytes):
+        with self.streams_lock:
+            self.streams[name]['bytes'] += num_bytes
+
+    def end_stream(self, name):
+        with self.streams_lock:
+            self.streams.pop(name, None)
+
+    # Reports the throughput of the streams every PROGRESS_INTERVAL seconds. A stream that receives no bytes
+    # for self.stall_window seconds times out (read timeout) and is restarted with a Range request
+    def watchdog(self, stop):
+        while not stop.wait(PROGRESS_INTERVAL):
+            now = time.time()
+            with self.streams_lock:
+                for name, stream in self.streams.items():
+                    rate = (stream['bytes'] - stream['reported_bytes']) / 1024 ** 2 / (now - stream['reported_time'])
+                    print(" > {0}: {1:.0f}MB of {2}, {3:.2f}MB/sec".format(
+                        name, stream['bytes'] / 1024 ** 2,
+                        '{0:.0f}MB'.format(stream['size'] / 1024 ** 2) if stream['size'] else 'unknown size', rate))
+                    stream['reported_bytes'] = stream['bytes']
+                    stream['reported_time'] = now
+
+    # Link the file from the SLC cache or download it and add it to the cache. The granule lock makes other
+    # projects wait for this download instead of downloading the same file
+    def download_file_cached(self, session, url, file_count, total):
+        # burst downloads are partial and not shared
+        if self.slc_cache is None or self.bounding_box is not None:
+            return self.download_file_with_session(session, url, file_count, total)
+
+        download_file = os.path.basename(url).split('?')[0]
+        with self.slc_cache.lock(os.path.splitext(download_file)[0]):
+            if not check_download.is_verified(download_file) and self.slc_cache.link(download_file):
+                return None, None
+            size, total_size = self.download_file_with_session(session, url, file_count, total)
+            if check_download.is_verified(download_file):
+                self.slc_cache.add(download_file)
+        return size, total_size
+
     # Download the file
-    def download_file_with_cookiejar(self, url, file_count, total, recursion=False):
+    def download_file_with_session(self, session, url, file_count, total, attempt=0, bursts=True):
         # see if we've already download this file and if it is that it is the correct size
-        # httplib2.Http(disable_ssl_certificate_validation=True)
         download_file = os.path.basename(url).split('?')[0]
+        if check_download.is_verified(download_file):
+            print(" > Download file {0} exists and was verified! \n > Skipping download of {1}. ".format(
+                download_file, url))
+            return None, None
+
+        from minsar.utils import burst_download
+        if self.bounding_box is not None and bursts:
+            return self.download_file_bursts(session, url, download_file, file_count, total)
+
+        burst_record = burst_download.read_burst_record(download_file)
+        if burst_record is not None and attempt == 0:
+            # complete an earlier burst download: its fetched ranges are resumed like a partial download
+            print(" > Completing the burst download {0}".format(download_file))
+            os.replace(download_file, download_file + '.part')
+            self.write_sidecar(download_file + '.part', {'url': url, 'size': burst_record['size'],
+                                                         'etag': burst_record['etag'],
+                                                         'ranges': burst_record['ranges']})
+            burst_download.remove_burst_record(download_file)
+
         if os.path.isfile(download_file):
             try:
-                request = Request(url)
-                request.get_method = lambda: 'HEAD'
-                response = urlopen(request)
+                response = session.head(url, allow_redirects=True, timeout=60)
                 remote_size = self.get_total_size(response)
                 # Check that we were able to derive a size.
-                if remote_size:
+                if response.ok and remote_size:
                     local_size = os.path.getsize(download_file)
-                    if remote_size < (local_size + (local_size * .01)) and remote_size > (
-                            local_size - (local_size * .01)):
-                        print(" > Download file {0} exists! \n > Skipping download of {1}. ".format(download_file, url))
-                        return None, None
-                    # partial file size wasn't full file size, lets blow away the chunk and start again
-                    print(" > Found {0} but it wasn't fully downloaded. Removing file and downloading again.".format(
-                        download_file))
-                    os.remove(download_file)
-
-            except ssl.CertificateError as e:
+                    if local_size <= remote_size:
+                        # an unverified download (e.g. by an earlier version) is continued with a Range request and
+                        # verified like a .part file
+                        print(" > Found {0} but it was not verified. Resuming it at byte {1}.".format(download_file,
+                                                                                                     local_size))
+                        os.replace(download_file, download_file + '.part')
+                        self.write_sidecar(download_file + '.part', {'url': url, 'size': remote_size,
+                                                                     'etag': response.headers.get('ETag'),
+                                                                     'ranges': [[0, local_size]]})
+                    else:
+                        print(" > Found {0} but it is larger than the remote file. Removing file and downloading "
+                              "again.".format(download_file))
+                        os.remove(download_file)
+
+            except requests.exceptions.SSLError as e:
                 print(" > ERROR: {0}".format(e))
                 print(" > Could not validate SSL Cert. You may be able to overcome this using the --insecure flag")
                 return False, None
 
-            except HTTPError as e:
-                if e.code == 401:
-                    print(" > IMPORTANT: Your user may not have permission to download this type of data!")
-                else:
-                    print(" > Unknown Error, Could not get file HEAD: {0}".format(e))
-
-            except URLError as e:
-                print("URL Error (from HEAD): {0}, {1}".format(e.reason, url))
-                if "ssl.c" in "{0}".format(e.reason):
-                    print(
-                        "IMPORTANT: Remote location may not be accepting your SSL configuration. This is a terminal error.")
+            except requests.exceptions.RequestException as e:
+                print("URL Error (from HEAD): {0}, {1}".format(e, url))
                 return False, None
-        # attempt https connection
-        try:
-            request = Request(url)
-            response = urlopen(request)
-
-            # Watch for redirect
-            if response.geturl() != url:
 
-                # See if we were redirect BACK to URS for re-auth.
-                if 'https://urs.earthdata.nasa.gov/oauth/authorize' in response.geturl():
-
-                    if recursion:
-                        print(" > Entering seemingly endless auth loop. Aborting. ")
-                        return False, None
+        # the file is written under a temporary name and renamed when complete and verified. The sidecar of the
+        # .part file records the remote file and the byte ranges written, so that an interrupted download continues
+        # with a Range request
+        part_file = download_file + '.part'
+        sidecar = self.read_sidecar(part_file)
+        offset = self.get_validated_bytes(sidecar)
+        if offset > 0 and offset == sidecar['size']:
+            # interrupted after the last byte was written
+            return self.finalize_part_file(part_file, download_file, sidecar['size'])
+
+        if self.num_ranges > 1:
+            result = self.download_file_in_ranges(session, url, part_file, download_file, file_count, total)
+            # None: the file is small or the server does not support ranges
+            if result is not None:
+                return result
+
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            if sidecar.get('etag'):
+                headers['If-Range'] = sidecar['etag']
 
-                    # make this easier. If there is no app_type=401, add it
-                    new_auth_url = response.geturl()
-                    if "app_type" not in new_auth_url:
-                        new_auth_url += "&app_type=401"
+        try:
+            with session.get(url, stream=True, timeout=(60, self.stall_window), headers=headers) as response:
 
+                # See if we were redirect BACK to URS for re-auth.
+                if response.url.startswith(URS_AUTHORIZE_URL):
                     print(" > While attempting to download {0}....".format(url))
-                    print(" > Need to obtain new cookie from {0}".format(new_auth_url))
-                    old_cookies = [cookie.name for cookie in self.cookie_jar]
-                    opener = build_opener(HTTPCookieProcessor(self.cookie_jar), HTTPHandler(),
-                                          HTTPSHandler(**self.context))
-                    request = Request(new_auth_url)
-                    try:
-                        response = opener.open(request)
-                        for cookie in self.cookie_jar:
-                            if cookie.name not in old_cookies:
-                                print(" > Saved new cookie: {0}".format(cookie.name))
-
-                                # A little hack to save session cookies
-                                if cookie.discard:
-                                    cookie.expires = int(time.time()) + 60 * 60 * 24 * 30
-                                    print(" > Saving session Cookie that should have been discarded! ")
-
-                        self.cookie_jar.save(self.cookie_jar_path, ignore_discard=True, ignore_expires=True)
-                    except HTTPError as e:
-                        print("HTTP Error: {0}, {1}".format(e.code, url))
-                        return False, None
+                    print(" > Redirected to URS for authentication, the cookie is not valid anymore: {0}".format(
+                        response.url))
+                    return False, None
+
+                if response.status_code == 401:
+                    print(" > IMPORTANT: Your user does not have permission to download this type of data!")
+                if response.status_code == 403:
+                    print(" > Got a 403 Error trying to download this file.  ")
+                    print(" > You MAY need to log in this app and agree to a EULA. ")
+                response.raise_for_status()
+
+                if response.url != url:
+                    print(" > 'Temporary' Redirect download @ Remote archive:\n > {0}".format(response.url))
+
+                # seems to be working
+                print("({0}/{1}) Downloading {2}".format(file_count, total, url))
+
+                if response.status_code == 206 and self.get_range_total_size(response) == sidecar['size']:
+                    print(" > Resuming {0} at byte {1}".format(download_file, offset))
+                    file_size = sidecar['size']
+                    mode = 'r+b'
+                    # the checksum of a resumed download is not known
+                    md5 = None
+                else:
+                    file_size = self.get_total_size(response)
+                    sidecar = {'url': url, 'size': file_size, 'etag': response.headers.get('ETag'), 'ranges': []}
+                    offset = 0
+                    mode = 'wb'
+                    md5 = hashlib.md5()
+
+                bytes_so_far = offset
+                self.start_stream(download_file, file_size)
+                try:
+                    with open(part_file, mode) as f:
+                        f.seek(offset)
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            if md5 is not None:
+                                md5.update(chunk)
+                            bytes_so_far += len(chunk)
+                            self.update_stream(download_file, len(chunk))
+                            f.flush()
+                            sidecar['ranges'] = [[0, bytes_so_far]]
+                            self.write_sidecar(part_file, sidecar)
+                            if self.max_concurrent_downloads == 1:
+                                self.chunk_report(bytes_so_far, file_size)
+                finally:
+                    self.end_stream(download_file)
+
+                if self.max_concurrent_downloads == 1:
+                    sys.stdout.write('\n')
 
-                    # Okay, now we have more cookies! Lets try again, recursively!
-                    print(" > Attempting download again with new cookies!")
-                    return self.download_file_with_cookiejar(url, file_count, total, recursion=True)
+        # handle errors
+        except requests.exceptions.HTTPError as e:
+            print("HTTP Error: {0}, {1}".format(e.response.status_code, url))
+            return False, None
 
-                print(" > 'Temporary' Redirect download @ Remote archive:\n > {0}".format(response.geturl()))
+        except requests.exceptions.SSLError as e:
+            print(" > ERROR: {0}".format(e))
+            print(" > Could not validate SSL Cert. You may be able to overcome this using the --insecure flag")
+            return False, None
 
-            # seems to be working
-            print("({0}/{1}) Downloading {2}".format(file_count, total, url))
+        except (requests.exceptions.RequestException, OSError) as e:
+            print("URL Error (from GET): {0}, {1}".format(e, url))
+            if os.path.exists(part_file):
+                validated_bytes = self.get_validated_bytes(self.read_sidecar(part_file))
+                if attempt < STALL_RETRIES and isinstance(e, requests.exceptions.RequestException):
+                    # stalled or broken stream: restart it with a Range request
+                    print(" > Restarting the download of {0} at byte {1} (attempt {2})".format(
+                        download_file, validated_bytes, attempt + 2))
+                    return self.download_file_with_session(session, url, file_count, total, attempt + 1, bursts)
+                print(" > Keeping {0} ({1} bytes) to resume the download".format(part_file, validated_bytes))
+            return False, None
 
-            # Open our local file for writing and build status bar
-            tf = tempfile.NamedTemporaryFile(mode='w+b', delete=False, dir='.')
-            self.chunk_read(response, tf, report_hook=self.chunk_report)
+        return self.finalize_part_file(part_file, download_file, file_size, md5.hexdigest() if md5 else None)
 
-            # Reset download status
-            sys.stdout.write('\n')
+    # Download the parts of a Sentinel-1 zip needed for the bursts in self.bounding_box into a sparse zip
+    def download_file_bursts(self, session, url, download_file, file_count, total):
+        from minsar.utils import burst_download
+        print("({0}/{1}) Downloading bursts of {2} in {3}".format(file_count, total, url, self.bounding_box))
+        try:
+            fetched_bytes, file_size = burst_download.download_bursts(session, url, download_file, self.bounding_box,
+                                                                      timeout=(60, self.stall_window))
+        except burst_download.BurstDownloadError as e:
+            # the ranges fetched so far are completed like an earlier burst download
+            print(" > Bursts of {0} cannot be retrieved ({1}). Downloading the complete file.".format(download_file, e))
+            return self.download_file_with_session(session, url, file_count, total, bursts=False)
+        except Exception as e:
+            print(" > Burst download of {0} failed: {1}".format(download_file, e))
+            return False, None
 
-            tempfile_name = tf.name
-            tf.close()
+        if fetched_bytes == 0:
+            return None, None
+        print(" > {0}: {1:.1f}MB of {2:.1f}MB".format(download_file, fetched_bytes / 1024 ** 2, file_size / 1024 ** 2))
+        return fetched_bytes, fetched_bytes
 
-        # handle errors
-        except HTTPError as e:
-            print("HTTP Error: {0}, {1}".format(e.code, url))
+    # Download a file as self.num_ranges byte ranges at the same time into a pre-allocated .part file
+    def download_file_in_ranges(self, session, url, part_file, download_file, file_count, total):
+        try:
+            response = session.head(url, allow_redirects=True, timeout=60)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print("URL Error (from HEAD): {0}, {1}".format(e, url))
+            return None
 
-            if e.code == 401:
-                # Check for a human readable 401
-                with open(tempfile_name, 'r') as myfile:
-                    redir_html = myfile.read()
-                redirect_url = self.get_redirect_url_from_error(redir_html)
-                if redirect_url:
-                    print("Found: {0}".format(redirect_url.group(0)))
-                    exit(0)
-                print(" > IMPORTANT: Your user does not have permission to download this type of data!")
-
-            if e.code == 403:
-                print(" > Got a 403 Error trying to download this file.  ")
-                print(" > You MAY need to log in this app and agree to a EULA. ")
+        file_size = self.get_total_size(response)
+        etag = response.headers.get('ETag')
+        if file_size is None or file_size < MIN_RANGE_FILE_SIZE or \
+                not response.headers.get('Accept-Ranges') == 'bytes':
+            return None
 
-            return False, None
-        except Exception as e:
-            return False, None
-        except URLError as e:
-            print("URL Error (from GET): {0}, {1}, {2}".format(e, e.reason, url))
-            if "ssl.c" in "{0}".format(e.reason):
-                print(
-                    "IMPORTANT: Remote location may not be accepting your SSL configuration. This is a terminal error.")
+        sidecar = self.read_sidecar(part_file)
+        if sidecar is None or not sidecar.get('size') == file_size or (etag and not sidecar.get('etag') == etag):
+            # sparse file of the final size, written at the positions of the ranges
+            sidecar = {'url': url, 'size': file_size, 'etag': etag, 'ranges': []}
+            with open(part_file, 'wb') as f:
+                f.truncate(file_size)
+            self.write_sidecar(part_file, sidecar)
+
+        range_size = -(-file_size // self.num_ranges)
+        ranges = []
+        for start, end in get_missing_ranges(sidecar['ranges'], file_size):
+            ranges += [(x, min(x + range_size, end)) for x in range(start, end, range_size)]
+
+        print("({0}/{1}) Downloading {2} in {3} ranges".format(file_count, total, url, len(ranges)))
+
+        lock = threading.Lock()
+        fd = os.open(part_file, os.O_WRONLY)
+        # one session per range thread
+        local = threading.local()
+        range_sessions = []
+
+        def start_range_thread():
+            local.session = self.get_session()
+            with lock:
+                range_sessions.append(local.session)
+
+        def download_range(byte_range):
+            position, end = byte_range
+            stream_name = '{0}[{1}-{2}]'.format(download_file, position, end - 1)
+            self.start_stream(stream_name, end - position)
+            try:
+                return download_range_attempts(stream_name, position, end)
+            finally:
+                self.end_stream(stream_name)
+
+        def download_range_attempts(stream_name, position, end):
+            for attempt in range(RANGE_RETRIES):
+                try:
+                    headers = {'Range': 'bytes={0}-{1}'.format(position, end - 1)}
+                    with local.session.get(url, stream=True, timeout=(60, self.stall_window),
+                                           headers=headers) as range_response:
+                        if not range_response.status_code == 206:
+                            raise requests.exceptions.RequestException(
+                                'status {0} for range request'.format(range_response.status_code))
+                        for chunk in range_response.iter_content(chunk_size=RANGE_CHUNK_SIZE):
+                            chunk = chunk[:end - position]
+                            os.pwrite(fd, chunk, position)
+                            self.update_stream(stream_name, len(chunk))
+                            with lock:
+                                sidecar['ranges'] = merge_ranges(sidecar['ranges'] + [[position, position + len(chunk)]])
+                                self.write_sidecar(part_file, sidecar)
+                            position += len(chunk)
+                            if position >= end:
+                                return True
+                except (requests.exceptions.RequestException, OSError) as e:
+                    print(" > Range {0}-{1} of {2} failed (attempt {3}): {4}".format(
+                        position, end - 1, download_file, attempt + 1, e))
+            return position >= end
+
+        start_time = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_ranges, initializer=start_range_thread) as executor:
+                results = list(executor.map(download_range, ranges))
+        finally:
+            os.close(fd)
+            for range_session in range_sessions:
+                range_session.close()
+
+        downloaded = sum(end - start for start, end in ranges)
+        elapsed = max(1.0, time.time() - start_time)
+        print(" > {0}: {1:.2f}MB in {2} ranges at {3:.2f}MB/sec".format(
+            download_file, downloaded / 1024 ** 2, len(ranges), downloaded / 1024 ** 2 / elapsed))
+
+        if not all(results):
+            print(" > Keeping {0} to resume the download".format(part_file))
             return False, None
 
-        except ssl.CertificateError as e:
-            print(" > ERROR: {0}".format(e))
-            print(" > Could not validate SSL Cert. You may be able to overcome this using the --insecure flag")
+        return self.finalize_part_file(part_file, download_file, file_size)
+
+    # Verify the .part file, rename it to the final name and record it as verified
+    def finalize_part_file(self, part_file, download_file, file_size, md5=None):
+        if not self.verify_part_file(part_file, file_size):
+            print(" > Verification of {0} failed. Removing it.".format(part_file))
+            self.remove_part_file(part_file)
             return False, None
 
-        # Return the file size
-        shutil.copy(tempfile_name, download_file)
-        os.remove(tempfile_name)
-        file_size = self.get_total_size(response)
+        # atomic rename: the final name exists only for complete downloads
+        os.replace(part_file, download_file)
+        os.remove(part_file + '.json')
+        # the url lists have no checksums: the md5 is recorded for the SLC cache but not compared
+        check_download.write_verified_marker(download_file, md5)
         actual_size = os.path.getsize(download_file)
         if file_size is None:
             # We were unable to calculate file size.
             file_size = actual_size
         return actual_size, file_size
 
-    def get_redirect_url_from_error(self, error):
-        find_redirect = re.compile(r"id=\"redir_link\"\s+href=\"(\S+)\"")
-        print("error file was: {}".format(error))
-        redirect_url = find_redirect.search(error)
-        if redirect_url:
-            print("Found: {0}".format(redirect_url.group(0)))
-            return (redirect_url.group(0))
-
-        return None
-
     #  chunk_report taken from http://stackoverflow.com/questions/2028517/python-urllib2-progress-hook
     def chunk_report(self, bytes_so_far, file_size):
         if file_size is not None:
@@ -465,38 +706,57 @@ class bulk_downloader:
             # We couldn't figure out the size.
             sys.stdout.write(" > Downloaded %d of unknown Size\r" % (bytes_so_far))
 
-    #  chunk_read modified from http://stackoverflow.com/questions/2028517/python-urllib2-progress-hook
-    def chunk_read(self, response, local_file, chunk_size=8192, report_hook=None):
-        file_size = self.get_total_size(response)
-        bytes_so_far = 0
-
-        while 1:
-            chunk = response.read(chunk_size)
-            try:
-                local_file.write(chunk)
-            except TypeError:
-                local_file.write(chunk.decode(local_file.encoding))
-            bytes_so_far += len(chunk)
-
-            if not chunk:
-                break
+    # Sidecar of a .part file: {'url', 'size', 'etag', 'ranges': [[start, end], ...]} (None if there is none)
+    def read_sidecar(self, part_file):
+        if not os.path.isfile(part_file) or not os.path.isfile(part_file + '.json'):
+            return None
+        try:
+            with open(part_file + '.json', 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
 
-            if report_hook:
-                report_hook(bytes_so_far, file_size)
+    def write_sidecar(self, part_file, sidecar):
+        with open(part_file + '.json.tmp', 'w') as f:
+            json.dump(sidecar, f)
+        os.replace(part_file + '.json.tmp', part_file + '.json')
+
+    def remove_part_file(self, part_file):
+        for file in [part_file, part_file + '.json']:
+            if os.path.exists(file):
+                os.remove(file)
+
+    # number of bytes at the beginning of the .part file that were written
+    def get_validated_bytes(self, sidecar):
+        if sidecar is None or not sidecar.get('size'):
+            return 0
+        ranges = merge_ranges(sidecar.get('ranges', []))
+        if len(ranges) == 0 or ranges[0][0] > 0:
+            return 0
+        return ranges[0][1]
+
+    # the download is complete if it has the remote size and (for zip files) a complete central directory
+    def verify_part_file(self, part_file, file_size):
+        if file_size is not None and not os.path.getsize(part_file) == file_size:
+            return False
+        if part_file.endswith('.zip.part'):
+            return check_download.check_end_of_central_directory(part_file)
+        return True
 
-        return bytes_so_far
+    # total size from the Content-Range header (bytes start-end/total) of a 206 response
+    def get_range_total_size(self, response):
+        try:
+            return int(response.headers.get('Content-Range').split('/')[-1])
+        except (AttributeError, ValueError):
+            return None
 
     def get_total_size(self, response):
-        try:
-            file_size = response.info().getheader('Content-Length').strip()
-        except AttributeError:
-            try:
-                file_size = response.getheader('Content-Length').strip()
-            except AttributeError:
-                print("> Problem getting size")
-                return None
+        file_size = response.headers.get('Content-Length')
+        if file_size is None:
+            print("> Problem getting size")
+            return None
 
-        return int(file_size)
+        return int(file_size.strip())
 
     # Get download urls from a metalink file
     def process_metalink(self, ml_file):
@@ -542,43 +802,77 @@ class bulk_downloader:
         else:
             return None
 
-    # Download all the files in the list
+    # Download all the files in the list. self.max_concurrent_downloads threads take the files from a queue, so that
+    # a thread that finished a file takes the next one. Every thread has its own session
     def download_files(self):
         self.files = self.files[0]
-        for file_name in self.files:
-
-            # download counter
-            self.cnt += 1
 
-            # set a timer
-            start = time.time()
+        self.streams = {}
+        self.streams_lock = threading.Lock()
+        self.summary_lock = threading.Lock()
+        stop_watchdog = threading.Event()
+        threading.Thread(target=self.watchdog, args=(stop_watchdog,), daemon=True).start()
 
-            # run download
-            size, total_size = self.download_file_with_cookiejar(file_name, self.cnt, len(self.files))
+        files = queue.Queue()
+        for i, file_name in enumerate(self.files):
+            files.put((i + 1, file_name))
 
-            # calculte rate
-            end = time.time()
-
-            # stats:
-            if size is None:
-                self.skipped.append(file_name)
-            # Check to see that the download didn't error and is the correct size
-            elif size is not False and (total_size < (size + (size * .01)) and total_size > (size - (size * .01))):
-                # Download was good!
-                elapsed = end - start
-                elapsed = 1.0 if elapsed < 1 else elapsed
-                rate = (size / 1024 ** 2) / elapsed
-
-                print("Downloaded {0}b in {1:.2f}secs, Average Rate: {2:.2f}MB/sec".format(size, elapsed, rate))
-
-                # add up metrics
-                self.total_bytes += size
-                self.total_time += elapsed
-                self.success.append({'file': file_name, 'size': size})
+        def download_thread():
+            session = self.get_session()
+            try:
+                while True:
+                    try:
+                        file_count, file_name = files.get_nowait()
+                    except queue.Empty:
+                        return
+
+                    # set a timer
+                    start = time.time()
+
+                    # run download
+                    size, total_size = self.download_file_cached(session, file_name, file_count, len(self.files))
+
+                    with self.summary_lock:
+                        self.add_to_summary(file_name, size, total_size, time.time() - start)
+            finally:
+                session.close()
+
+        num_threads = max(1, min(self.max_concurrent_downloads, len(self.files)))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            threads = [executor.submit(download_thread) for i in range(num_threads)]
+        for thread in threads:
+            thread.result()
+
+        stop_watchdog.set()
+
+    def add_to_summary(self, file_name, size, total_size, elapsed):
+        # download counter
+        self.cnt += 1
+
+        # stats:
+        if size is None:
+            print("[{0}/{1}] Skipped {2}".format(self.cnt, len(self.files), file_name))
+            self.skipped.append(file_name)
+        # Check to see that the download didn't error and is the correct size
+        elif size is not False and (total_size < (size + (size * .01)) and total_size > (size - (size * .01))):
+            # Download was good!
+            elapsed = 1.0 if elapsed < 1 else elapsed
+            rate = (size / 1024 ** 2) / elapsed
+
+            print("[{0}/{1}] Downloaded {2}: {3}b in {4:.2f}secs, Average Rate: {5:.2f}MB/sec".format(
+                self.cnt, len(self.files), file_name, size, elapsed, rate))
+            with open(THROUGHPUT_LOG, 'a') as f:
+                f.write("{0} {1} {2} bytes {3:.1f} secs {4:.2f} MB/sec\n".format(
+                    time.strftime('%Y%m%d:%H%M%S'), os.path.basename(file_name), size, elapsed, rate))
+
+            # add up metrics
+            self.total_bytes += size
+            self.total_time += elapsed
+            self.success.append({'file': file_name, 'size': size})
 
-            else:
-                print("There was a problem downloading {0}".format(file_name))
-                self.failed.append(file_name)
+        else:
+            print("[{0}/{1}] There was a problem downloading {2}".format(self.cnt, len(self.files), file_name))
+            self.failed.append(file_name)
 
     def print_summary(self):
         # Print summary:
@@ -600,6 +894,30 @@ class bulk_downloader:
         print("--------------------------------------------------------------------------------")
 
 
+def merge_ranges(ranges):
+    """ merges overlapping and adjacent byte ranges [start, end) """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def get_missing_ranges(ranges, size):
+    """ returns the byte ranges [start, end) of a file of the given size that are not in ranges """
+    missing = []
+    position = 0
+    for start, end in merge_ranges(ranges):
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < size:
+        missing.append((position, size))
+    return missing
+
+
 if __name__ == "__main__":
     message_rsmas.log('.', os.path.basename(__file__) + ' ' + ' '.join(sys.argv[1::]))
     downloader = bulk_downloader()
@@ -13,7 +13,6 @@ from minsar.job_submission import JOB_SUBMIT
 import glob
 from minsar.objects.auto_defaults import PathFind
 import password_config as password
-from multiprocessing.dummy import Pool as ThreadPool
 
 def main(iargs=None):
 
@@ -107,10 +106,31 @@ def main(iargs=None):
     """if inps.processes is not None:
         processes = inps.processes"""
 
+    # number of byte ranges of a file downloaded at the same time
+    global download_ranges
+    download_ranges = 1
+
+    try:
+        if dataset_template.options['ranges'] is not None:
+            download_ranges = int(dataset_template.options['ranges'])
+    except:
+        pass
+
+    # download only the bursts in topsStack.boundingBox
+    global download_bounding_box
+    download_bounding_box = None
+
+    try:
+        if dataset_template.options['burstDownload'] == 'yes':
+            download_bounding_box = dataset_template.options['topsStack.boundingBox'].strip("'").split()
+    except:
+        pass
+
     if parallel:
         run_parallel_download_asf_serial(project_slc_dir, threads)
     else:
-        succesful = run_download_asf_serial(project_slc_dir, logger)
+        succesful = run_download_asf_serial(project_slc_dir, logger, ranges=download_ranges,
+                                            bounding_box=download_bounding_box)
         logger.log(loglevel.INFO, "SUCCESS: %s", str(succesful))
 
     change_file_permissions()
@@ -236,43 +256,26 @@ def generate_files_csv(slc_dir, custom_template_file, start_date=None, end_date=
 
 
 def run_parallel_download_asf_serial(project_slc_dir, threads):
-    """ Creates the chunk files necessary for Pool and runs it for the parallel download process
-    The parameter processes is the desired number of processes to run. If no input is provided the default os.cpu_count() is used which is the number of processors
+    """ Downloads the files of new_files.csv with `threads` downloads at the same time.
+    download_ASF_serial.py takes the files from a queue, so that a download that finished takes the next file and
+    no file list is partitioned in advance
     """
 
-    comma = '^[^,]+,?'
-    file_num = 1
-    total_num = 0
-    csv_chunk_files = []
-
-    while os.stat(project_slc_dir + '/new_files.csv').st_size != 0:
-        subprocess.Popen("grep -E -o '" + comma + "' " + project_slc_dir + "/new_files.csv | tr -d '\n' >> " + project_slc_dir + "/new_files" + str(file_num) + ".csv", shell=True).wait()
-        subprocess.Popen("sed -r -i 's/" + comma + "//' " + project_slc_dir + "/new_files.csv", shell=True).wait()
-        file_num += 1
-        total_num += 1
-        if file_num > threads:
-            file_num = 1
-    if total_num < threads:
-        processes = total_num
-    for file_num in range(1, threads + 1):
-        subprocess.Popen("sed -r -i 's/,$//' " + project_slc_dir + "/new_files" + str(file_num) + ".csv", shell=True).wait()
-        csv_chunk_files.append('new_files' + str(file_num) + '.csv')
-
-    ThreadPool(threads).map(run_parallel_download_asf_serial_helper, csv_chunk_files)
-
-
-def run_parallel_download_asf_serial_helper(csv_chunk_file):
-    """ Helper function necessary to run Pool since it requires only one parameter
-    """
-
-    exit_code = run_download_asf_serial(project_slc_dir, logger, csv_file=csv_chunk_file)
+    exit_code = run_download_asf_serial(project_slc_dir, logger, ranges=download_ranges, concurrency=threads,
+                                        bounding_box=download_bounding_box)
     logger.log(loglevel.INFO, "SUCCESS: %s", exit_code)
 
 
-def run_download_asf_serial(slc_dir, logger, run_number=1, csv_file='new_files.csv'):
+def run_download_asf_serial(slc_dir, logger, run_number=1, csv_file='new_files.csv', ranges=1, concurrency=None,
+                            bounding_box=None):
     """ Runs download_ASF_serial.py with proper files.
     Runs adapted download_ASF_serial.py with a CLI username and password and a csv file containing
-    the the files needed to be downloaded (provided by ssara_federated_query.py --print)
+    the the files needed to be downloaded (provided by ssara_federated_query.py --print).
+    With ranges > 1 every file is downloaded as `ranges` byte ranges at the same time.
+    concurrency is the number of files downloaded at the same time (default: MAX_CONCURRENT_DOWNLOADS).
+    With a bounding_box (south north west east) only the bursts intersecting it are downloaded (sparse zips).
+    Stalled downloads are restarted by download_ASF_serial.py (a stream without received bytes for
+    DOWNLOAD_STALL_WINDOW seconds is resumed with a Range request).
     """
 
     logger.log(loglevel.INFO, "RUN NUMBER: %s", str(run_number))
@@ -281,47 +284,27 @@ def run_download_asf_serial(slc_dir, logger, run_number=1, csv_file='new_files.c
 
     command = ' '.join(['download_ASF_serial.py', '-username', password.asfuser, '-password', 
                                               password.asfpass, slc_dir + '/' + csv_file])
+    if ranges > 1:
+        command += ' --ranges={}'.format(ranges)
+    if concurrency is not None:
+        command += ' --concurrency={}'.format(concurrency)
+    if bounding_box is not None:
+        command += ' --bounding_box={}'.format(','.join(bounding_box))
 
     message_rsmas.log(os.getcwd(), command)
-    completion_status = subprocess.Popen(' '.join(['download_ASF_serial.py', '-username', password.asfuser, '-password',
-                                                   password.asfpass, slc_dir + '/' + csv_file]), shell=True).wait()
-
-    hang_status = False  # whether or not the download has hung
-    wait_time = 6  # wait time in 'minutes' to determine hang status
-    prev_size = -1  # initial download directory size
-    i = 0  # the iteration number (for logging only)
-
-    # while the process has not completed
-    while completion_status is None:
-
-        i = i + 1
-
-        # Computer the current download directory size
-        curr_size = int(subprocess.check_output(['du', '-s', os.getcwd()]).split()[0].decode('utf-8'))
-
-        # Compare the current and previous directory sizes to determine determine hang status
-        if prev_size == curr_size:
-            hang_status = True
-            logger.log(loglevel.WARNING, "SSARA Hung")
-            asfserial_process.terminate()  # teminate the process beacause download hung
-            break  # break the completion loop
-
-        time.sleep(60 * wait_time)  # wait 'wait_time' minutes before continuing
-        prev_size = curr_size
-        completion_status = asfserial_process.poll()
-        logger.log(loglevel.INFO,
-                   "{} minutes: {:.1f}GB, completion_status {}".format(i * wait_time, curr_size / 1024 / 1024,
-                                                                       completion_status))
-
-    exit_code = completion_status  # get the exit code of the command
+    exit_code = subprocess.Popen(command, shell=True).wait()
     logger.log(loglevel.INFO, "EXIT CODE: %s", str(exit_code))
 
     bad_codes = [137, -9]
 
-    # If the exit code is one that signifies an error, rerun the entire command
-    if exit_code in bad_codes or hang_status:
-        logger.log(loglevel.WARNING, "Something went wrong, running again")
-        run_download_asf_serial(slc_dir, logger, run_number=run_number + 1, csv_file=csv_file)
+    # If the exit code is one that signifies an error, rerun the command. Partial downloads (*.part files) are
+    # resumed by download_ASF_serial.py
+    if exit_code in bad_codes:
+        part_files = glob.glob(os.path.join(os.getcwd(), '*.part'))
+        logger.log(loglevel.WARNING, "Something went wrong, running again (resuming {} partial downloads)".format(
+            len(part_files)))
+        run_download_asf_serial(slc_dir, logger, run_number=run_number + 1, csv_file=csv_file, ranges=ranges,
+                                concurrency=concurrency, bounding_box=bounding_box)
 
     return exit_code
 
@@ -21,6 +21,7 @@ from pathlib import Path
 from natsort import natsorted
 import xml.etree.ElementTree as ET
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from minsar.objects.dataset_template import Template
 from minsar.objects.auto_defaults import PathFind
 from isceobj.Sensor.TOPS.Sentinel1 import Sentinel1
@@ -28,6 +29,13 @@ import time, datetime
 
 pathObj = PathFind()
 
+# bytes read at once when scanning job output files for error strings
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
+# suffix of the batch file with the remaining tasks of a partially processed run file (execute_runfiles --resume)
+RESUME_SUFFIX = '_resume'
+# suffix of the batch file with the unfinished tasks of a timed out launcher job (see write_unfinished_launcher_tasks)
+RERUN_BATCH_SUFFIX = '_rerun'
+
 
 ##########################################################################
 
@@ -142,6 +150,12 @@ def add_execute_runfiles(parser):
                             help='run processing at the # step only')
     run_parser.add_argument('--numBursts', dest='num_bursts', type=int, metavar='number of bursts',
                             help='number of bursts to calculate walltime')
+    run_parser.add_argument('--chain', dest='chain_flag', action='store_true',
+                            help='submit jobs of all run files at once using job dependencies')
+    run_parser.add_argument('--dag', dest='dag_flag', action='store_true',
+                            help='as --chain but jobs only depend on the jobs of the same dates of the previous run file')
+    run_parser.add_argument('--resume', dest='resume_flag', action='store_true',
+                            help='skip completed run files and completed tasks (see execution_state.db)')
 
     return parser
 
@@ -198,6 +212,11 @@ def add_process_rsmas(parser):
                      help='end processing at the named step, default: {}'.format(STEP_LIST[-1]))
     prs.add_argument('--dostep', dest='step', metavar='STEP',
                      help='run processing at the named step only')
+    prs.add_argument('--resume', dest='resume_flag', action='store_true',
+                     help='skip completed steps, run files and tasks (see execution_state.db)')
+    prs.add_argument('--pipeline', dest='pipeline_flag', action='store_true',
+                     help='run dem and unpack downloaded dates while the submitted download continues '
+                          '(dem and unpacking run on the node of process_rsmas.py)')
 
     return parser
 
@@ -487,7 +506,12 @@ def create_rerun_run_file(job_files):
 
     files = natsorted(job_files)
     for file in job_files:
-        command_line = get_line_before_last(file)
+        batch_file, tasks, unfinished_tasks = get_unfinished_launcher_tasks(file)
+        if batch_file is None:
+            command_line = get_line_before_last(file)
+        else:
+            # launcher job: only the tasks that did not finish
+            command_line = ''.join([read_task_status(task)[1] + '\n' for task in unfinished_tasks])
         print(command_line)
         with open(rerun_file, 'a+') as f:
             f.write(command_line)
@@ -554,10 +578,19 @@ def extract_step_name_from_stdout_name(job_name):
        step_name = '_'.join(step_name.split('_')[:-1])
     if step_name.split('_')[0].isdigit():
        step_name = '_'.join(step_name.split('_')[1:])
+    step_name = strip_resume_suffix(step_name)
 
     return step_name
 
 ##########################################################################
+
+def strip_resume_suffix(name):
+    """ Removes RESUME_SUFFIX from the name of a batch file or step (run_07_x_resume -> run_07_x) """
+    if name.endswith(RESUME_SUFFIX):
+        return name[:-len(RESUME_SUFFIX)]
+    return name
+
+##########################################################################
  
 def extract_config_file_from_task_string(task):
     """ Extracts the config filename from a task string """
@@ -606,21 +639,272 @@ def get_line_before_last(file):
 ##########################################################################
 
 
+def get_task_status_file(batch_file, task_number):
+    """ returns the file recording start and exit code of a task of a launcher batch file """
+
+    status_dir = os.path.join(os.path.dirname(os.path.abspath(batch_file)), 'task_status')
+
+    return os.path.join(status_dir, '{}_{}'.format(os.path.basename(batch_file), task_number))
+
+
+def add_task_status_markers(task, status_file):
+    """
+    wraps a task line (including output redirection) to write 'running <start time>' and then
+    '<exit code> <start time> <end time>' into status_file
+    """
+
+    return 'task_start=$(date +%s); echo running $task_start > {0}; {1}; echo $? $task_start $(date +%s) > {0}\n'.format(
+        status_file, task.split('\n')[0])
+
+
+def read_task_status(line):
+    """
+    reads the status of a task line written by add_task_status_markers
+    :return: status file (None for lines without markers), task command without output redirection,
+             status (None if not started, 'running' if not finished, exit code otherwise)
+    """
+
+    match = re.match(r'^task_start=\$\(date \+%s\); echo running \$task_start > (\S+); (.*); '
+                     r'echo \$\? \$task_start \$\(date \+%s\) > \S+$', line.strip())
+    if match is None:
+        return None, line.split('\n')[0], None
+
+    status_file = match.group(1)
+    task = match.group(2).split(' > ')[0]
+    try:
+        with open(status_file) as f:
+            status = f.read().split()[0]
+    except (OSError, IndexError):
+        status = None
+
+    return status_file, task, status
+
+
+def get_task_times(status_file):
+    """ returns start and end time (None if not started or not finished) of a task from its status file """
+
+    try:
+        with open(status_file) as f:
+            fields = f.read().split()
+    except OSError:
+        return None, None
+
+    if len(fields) == 2 and fields[0] == 'running':
+        return float(fields[1]), None
+    if len(fields) == 3:
+        return float(fields[1]), float(fields[2])
+
+    return None, None
+
+
+def get_unfinished_launcher_tasks(job_file):
+    """
+    returns the launcher batch file (task file of array jobs) of a job and the lines of the tasks that did not exit with 0
+    :param job_file: launcher or array job file
+    :return: batch file, all task lines, unfinished task lines (None, None, None if job has no task status markers)
+    """
+
+    batch_file = None
+    with open(job_file) as fr:
+        for line in fr.readlines():
+            if line.startswith('export LAUNCHER_JOB_FILE=') or line.startswith('export ARRAY_TASK_FILE='):
+                batch_file = line.split('=')[1].strip()
+
+    if batch_file is None or not os.path.exists(batch_file):
+        return None, None, None
+
+    with open(batch_file) as fr:
+        tasks = fr.readlines()
+
+    unfinished_tasks = []
+    for line in tasks:
+        status_file, task, status = read_task_status(line)
+        if status_file is None:
+            return None, None, None
+        if not status == '0':
+            unfinished_tasks.append(line)
+
+    return batch_file, tasks, unfinished_tasks
+
+
+def write_unfinished_launcher_tasks(job_file):
+    """
+    Writes the tasks of the launcher batch file of a job that did not exit with 0 into <batch file>_rerun, points the
+    job file to it and reduces the number of nodes (or array elements) of the job accordingly, so that a rerun of the
+    job file does not repeat completed tasks. The batch file keeps all tasks: the rerun tasks write the same status
+    files, so that get_task_exit_codes still finds the tasks completed before the rerun
+    :param job_file: launcher or array job file
+    :return: number of tasks to rerun (None if the job has no task status markers)
+    """
+
+    batch_file, tasks, unfinished_tasks = get_unfinished_launcher_tasks(job_file)
+    if batch_file is None:
+        return None
+
+    if len(unfinished_tasks) == 0 or len(unfinished_tasks) == len(tasks):
+        return len(unfinished_tasks)
+
+    if batch_file.endswith(RERUN_BATCH_SUFFIX):
+        rerun_batch_file = batch_file
+    else:
+        rerun_batch_file = batch_file + RERUN_BATCH_SUFFIX
+    with open(rerun_batch_file, 'w') as f:
+        f.writelines(unfinished_tasks)
+
+    with open(job_file) as fr:
+        lines = fr.readlines()
+
+    tasks_per_node = None
+    for line in lines:
+        if line.startswith('export LAUNCHER_PPN='):
+            tasks_per_node = int(line.split('=')[1])
+
+    new_lines = []
+    number_of_nodes = int(math.ceil(len(unfinished_tasks) / tasks_per_node)) if tasks_per_node else None
+    old_number_of_nodes = None
+    for line in lines:
+        if line.startswith('export LAUNCHER_JOB_FILE=') or line.startswith('export ARRAY_TASK_FILE='):
+            line = line.split('=')[0] + '=' + rerun_batch_file + '\n'
+        # array jobs: elements 1-N
+        line = re.sub(r'^(#SBATCH --array=1-|#BSUB -J "?[^\s\[]+\[1-|#PBS -J 1-)(\d+)',
+                      lambda x: x.group(1) + str(len(unfinished_tasks)), line)
+        match = re.match(r'^(#SBATCH -N |#BSUB -n |#PBS -l nodes=)(\d+)', line)
+        if match and number_of_nodes and int(match.group(2)) > number_of_nodes:
+            old_number_of_nodes = int(match.group(2))
+            line = line.replace(match.group(0), match.group(1) + str(number_of_nodes), 1)
+        match = re.match(r'^#SBATCH -n (\d+)', line)
+        if match and old_number_of_nodes:
+            number_of_tasks = int(match.group(1)) // old_number_of_nodes * number_of_nodes
+            line = line.replace(match.group(0), '#SBATCH -n ' + str(number_of_tasks), 1)
+        new_lines.append(line)
+
+    with open(job_file, 'w') as f:
+        f.writelines(new_lines)
+
+    return len(unfinished_tasks)
+
+
+def get_task_exit_codes(run_file):
+    """
+    returns the finished tasks of the launcher batch files of a run file (tasks still running are not included).
+    The tasks of a rerun are read from the batch file of the first run (see write_unfinished_launcher_tasks)
+    :return: list of (task, exit code, end time, config file)
+    """
+
+    tasks = []
+    for batch_file in natsorted(glob.glob(run_file + '_*')):
+        if not os.path.isfile(batch_file) or os.path.splitext(batch_file)[1] in ['.job', '.o', '.e'] or \
+                batch_file.endswith(RERUN_BATCH_SUFFIX):
+            continue
+        with open(batch_file) as fr:
+            lines = fr.readlines()
+        for line in lines:
+            status_file, task, status = read_task_status(line)
+            if status_file is None or status is None or not status.isdigit():
+                continue
+            tasks.append((task, int(status), get_task_times(status_file)[1],
+                          extract_config_file_from_task_string(task)))
+
+    return tasks
+
+
+##########################################################################
+
+
+def scan_file_for_strings(file, search_strings, pattern=None):
+    """
+    Scans a file for several strings in one pass, reading large chunks. Only lines matching the combined pattern
+    are checked for the individual strings.
+    :param file: file to scan
+    :param search_strings: list of strings
+    :param pattern: compiled alternation of search_strings (see compile_search_pattern)
+    :return: list of (line number, search string, line) for every string found in a line
+    """
+
+    if pattern is None:
+        pattern = compile_search_pattern(search_strings)
+
+    matches = []
+    line_number = 1
+    remainder = ''
+    with open(file, 'r', errors='replace') as f:
+        while True:
+            chunk = f.read(SCAN_CHUNK_SIZE)
+            text = remainder + chunk
+            if chunk:
+                # keep the incomplete last line for the next chunk
+                end = text.rfind('\n') + 1
+                if end == 0:
+                    remainder = text
+                    continue
+                text, remainder = text[:end], text[end:]
+
+            counted = 0
+            previous_line_start = -1
+            for match in pattern.finditer(text):
+                line_start = text.rfind('\n', 0, match.start()) + 1
+                if line_start == previous_line_start:
+                    continue
+                previous_line_start = line_start
+                line_number += text.count('\n', counted, line_start)
+                counted = line_start
+                line_end = text.find('\n', match.start())
+                line = text[line_start:line_end if line_end >= 0 else len(text)]
+                for search_string in search_strings:
+                    if search_string in line:
+                        matches.append((line_number, search_string, line))
+            line_number += text.count('\n', counted)
+
+            if not chunk:
+                break
+
+    return matches
+
+
+def compile_search_pattern(search_strings):
+    """ returns a regular expression matching any of the search strings """
+    return re.compile('|'.join(re.escape(x) for x in sorted(search_strings, key=len, reverse=True)))
+
+
+def scan_files_for_strings(files, search_strings, num_threads=None):
+    """
+    Scans files for several strings in parallel (see scan_file_for_strings). Files that do not exist are skipped.
+    :param files: list of files
+    :param search_strings: list of strings
+    :param num_threads: number of files scanned at the same time (default: min(32, number of files))
+    :return: dictionary of file: list of (line number, search string, line) for files with matches
+    """
+
+    if len(files) == 0:
+        return {}
+
+    pattern = compile_search_pattern(search_strings)
+
+    def scan(file):
+        try:
+            return scan_file_for_strings(file, search_strings, pattern)
+        except FileNotFoundError:
+            return []
+
+    if num_threads is None:
+        num_threads = min(32, len(files))
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = executor.map(scan, files)
+
+    return {file: matches for file, matches in zip(files, results) if len(matches) > 0}
+
+
+##########################################################################
+
+
 def find_completed_jobs_matching_search_string(run_file, search_string):
     """returns names of files that match seasrch strings (*.e files in run_files)."""
 
     files = glob.glob(run_file + '*.o*')
-    file_list = []
 
     files = natsorted(files)
-    for file in files:
-        with open(file) as fr:
-            lines = fr.readlines()
-            for line in lines:
-                if search_string in line:
-                    file_list.append(file)
-
-    file_list = natsorted(file_list)
+    file_list = natsorted(scan_files_for_strings(files, [search_string]).keys())
 
     job_file_list = []
     for file in file_list:
@@ -642,12 +926,11 @@ def raise_exception_if_job_exited(run_file):
     search_string = 'Exited with exit code'
 
     files = natsorted(files)
+    matches = scan_files_for_strings(files, [search_string])
     for file in files:
-        with open(file) as fr:
-            lines = fr.readlines()
-            for line in lines:
-                if search_string in line:
-                    raise Exception("ERROR: {0} exited; contains: {1}".format(file, line))
+        if file in matches:
+            line = matches[file][0][2]
+            raise Exception("ERROR: {0} exited; contains: {1}".format(file, line))
 
 
 ##########################################################################
@@ -1008,6 +1291,50 @@ def multiply_walltime(wall_time, factor):
 ##########################################################################
 
 
+def walltime_to_seconds(wall_time):
+    """ converts walltime in HH:MM, HH:MM:SS or D-HH:MM:SS format into seconds """
+
+    if wall_time in [None, 'None']:
+        return None
+
+    days = 0
+    if '-' in wall_time:
+        days, wall_time = wall_time.split('-')
+
+    wall_time_parts = [int(s) for s in wall_time.split(':')]
+
+    hours = wall_time_parts[0] + int(days) * 24
+    minutes = wall_time_parts[1]
+
+    try:
+        seconds = wall_time_parts[2]
+    except:
+        seconds = 0
+
+    return seconds + minutes * 60 + hours * 3600
+
+##########################################################################
+
+
+def seconds_to_walltime(seconds, scheduler='SLURM'):
+    """ converts seconds into walltime (H:MM for LSF, H:MM:SS otherwise) """
+
+    min, sec = divmod(math.ceil(seconds), 60)
+    hour, min = divmod(min, 60)
+
+    if scheduler in ['LSF']:
+        if sec > 0:
+            min += 1
+            hour, min = divmod(hour * 60 + min, 60)
+        wall_time = "%d:%02d" % (hour, min)
+    else:
+        wall_time = "%d:%02d:%02d" % (hour, min, sec)
+
+    return wall_time
+
+##########################################################################
+
+
 def replace_walltime_in_job_file(file, new_wall_time):
     """ replaces the walltime from a SLURM job file """
     new_lines=[]
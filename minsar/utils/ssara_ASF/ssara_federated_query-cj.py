@@ -57,8 +57,11 @@ except ImportError:
     from Queue import Queue
     #import requests
 import ssl
+import hashlib
 
 import password_config
+from minsar.utils import check_download
+from minsar.objects.slc_cache import get_slc_cache
 
 #SAA - 2 July 18
 # Updated to add required imports for CookieJar stuff
@@ -511,11 +514,28 @@ def check_cookie(cookie_jar):
 
 # End of 2 July 18 add
 
+def asf_dl_cached(d, opt_dict):
+    # link the granule from the site-wide SLC cache or download it once for all projects
+    slc_cache = get_slc_cache()
+    if slc_cache is None:
+        return asf_dl(d, opt_dict)
+    filename = os.path.basename(d['downloadUrl'])
+    with slc_cache.lock(os.path.splitext(filename)[0]):
+        if not check_download.is_verified(filename) and slc_cache.link(filename):
+            return True
+        status = asf_dl(d, opt_dict)
+        if status and check_download.is_verified(filename):
+            slc_cache.add(filename)
+    return status
+
 def asf_dl(d, opt_dict):
     user_name = password_config.asfuser
     user_password = password_config.asfpass
     url = d['downloadUrl']
     filename = os.path.basename(url)
+    if check_download.is_verified(filename):
+        print("%s already downloaded and verified" % filename)
+        return True
     print("ASF Download:",filename)
     start = time.time()
 
@@ -551,26 +571,44 @@ def asf_dl(d, opt_dict):
     except HTTPError as e:
         print(url)
         print(e)
-        return
+        return False
     dl_file_size = int(response.info()['Content-Length'])
     if os.path.exists(filename):
         file_size = os.path.getsize(filename)
-        if dl_file_size == file_size:
+        if dl_file_size == file_size and check_download.check_end_of_central_directory(filename):
             print("%s already downloaded" % filename)
-            return
+            check_download.write_verified_marker(filename)
+            return True
     start = time.time()
     CHUNK = 128*10240
-    with open(filename, 'wb') as fp:
+    # checksum while writing and zip check when the file is closed, the final name exists only for good files
+    part_file = filename + '.part'
+    md5 = hashlib.md5()
+    with open(part_file, 'wb') as fp:
         while True:
             chunk = response.read(CHUNK)
             if not chunk: break
             fp.write(chunk)
+            md5.update(chunk)
 
     # Check to see if you got the file properly or not
+    if not os.path.getsize(part_file) == dl_file_size or not check_download.check_end_of_central_directory(part_file):
+        print("%s failed verification (%d of %d bytes)" % (filename, os.path.getsize(part_file), dl_file_size))
+        os.remove(part_file)
+        return False
+    # compare with the catalogue checksum if the catalogue gives one
+    catalogue_md5 = d.get('md5sum') or d.get('md5')
+    if catalogue_md5 and catalogue_md5.lower() != md5.hexdigest():
+        print("%s failed verification (md5 %s, catalogue md5 %s)" % (filename, md5.hexdigest(), catalogue_md5))
+        os.remove(part_file)
+        return False
+    os.replace(part_file, filename)
+    check_download.write_verified_marker(filename, md5.hexdigest(), md5_checked=bool(catalogue_md5))
+
     total_time = time.time() - start
     mb_sec = (os.path.getsize(filename) / (1024 * 1024.0)) / total_time
     print("%s download time: %.2f secs (%.2f MB/sec)" % (filename, total_time, mb_sec))
-    fp.close()
+    return True
         
 def unavco_dl(d, opt_dict):
     user_name = password_config.unavuser
@@ -632,17 +670,11 @@ class ThreadDownload(threading.Thread):
             if 'unavco' in d['downloadUrl']:
                 unavco_dl(d, opt_dict)
             elif 'asf' in d['downloadUrl'] :
-                asf_dl(d, opt_dict)
-                url = d['downloadUrl']
-                filename = os.path.basename(url)
-                # SAA -- This is a quick check to see if the response from the server 
-                # was bad.  If the file size is less than 1600 bytes it is just a server
-                # response and the asf_dl function is called again to get the file.
-                # should be made more robust to try a few times and then give up. 
-                if os.path.getsize(filename) < 1600:
-                    print('Retrying file: %s' % filename)
-                    os.unlink(filename)
-                    asf_dl(d,opt_dict)
+                # SAA -- If the response from the server was bad (e.g. a short server response instead of
+                # the file) the asf_dl function is called again to get the file.
+                if not asf_dl_cached(d, opt_dict):
+                    print('Retrying file: %s' % os.path.basename(d['downloadUrl']))
+                    asf_dl_cached(d, opt_dict)
             elif d['collectionName'] == 'Supersites VA4':
                 va4_dl(d,opt_dict)
             self.queue.task_done()
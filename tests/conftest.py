@@ -0,0 +1,8 @@
+## minsar environment for the tests: PathFind and the queue configuration are read when the modules are imported
+
+import os
+import tempfile
+
+os.environ.setdefault('RSMASINSAR_HOME', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('OPERATIONS', tempfile.mkdtemp())
+os.environ.setdefault('SCRATCHDIR', tempfile.mkdtemp())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+## Tests of the burst-level retrieval of Sentinel-1 zips against a local HTTP server with range requests
+
+import io
+import os
+import struct
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from minsar.utils import burst_download, check_download
+from minsar.utils.download_ASF_serial import bulk_downloader
+
+LINES_PER_BURST = 10
+NUMBER_OF_BURSTS = 9
+LINE_SIZE = 64 * 1024
+MEASUREMENT = 'S1A_IW_SLC__1SDV_20200101T000000.SAFE/measurement/s1a-iw1-slc-vv-20200101t000000-001.tiff'
+ANNOTATION = 'S1A_IW_SLC__1SDV_20200101T000000.SAFE/annotation/s1a-iw1-slc-vv-20200101t000000-001.xml'
+MANIFEST = 'S1A_IW_SLC__1SDV_20200101T000000.SAFE/manifest.safe'
+# the bounding box intersects burst 2 only (latitude = line / LINES_PER_BURST)
+BOUNDING_BOX = [2.2, 2.8, 0.0, 1.0]
+
+
+def create_tiff(number_of_lines, line_size):
+    """ returns a little endian classic TIFF with one line per strip, line x is filled with the byte x """
+    entries = 7
+    ifd_offset = 8
+    strip_offsets_offset = ifd_offset + 2 + 12 * entries + 4
+    strip_byte_counts_offset = strip_offsets_offset + 4 * number_of_lines
+    data_offset = strip_byte_counts_offset + 4 * number_of_lines
+
+    def entry(tag, tag_type, count, value):
+        if tag_type == 3 and count == 1:
+            return struct.pack('<HHIHH', tag, tag_type, count, value, 0)
+        return struct.pack('<HHII', tag, tag_type, count, value)
+
+    tiff = b'II' + struct.pack('<HI', 42, ifd_offset) + struct.pack('<H', entries)
+    tiff += entry(256, 4, 1, line_size // 4)
+    tiff += entry(burst_download.TIFF_IMAGE_LENGTH, 4, 1, number_of_lines)
+    tiff += entry(258, 3, 1, 16)
+    tiff += entry(burst_download.TIFF_COMPRESSION, 3, 1, 1)
+    tiff += entry(burst_download.TIFF_STRIP_OFFSETS, 4, number_of_lines, strip_offsets_offset)
+    tiff += entry(burst_download.TIFF_ROWS_PER_STRIP, 4, 1, 1)
+    tiff += entry(burst_download.TIFF_STRIP_BYTE_COUNTS, 4, number_of_lines, strip_byte_counts_offset)
+    tiff += struct.pack('<I', 0)
+    tiff += struct.pack('<{}I'.format(number_of_lines), *[data_offset + x * line_size for x in range(number_of_lines)])
+    tiff += struct.pack('<{}I'.format(number_of_lines), *[line_size] * number_of_lines)
+    for line in range(number_of_lines):
+        tiff += bytes([line]) * line_size
+    return tiff
+
+
+def create_annotation():
+    """ returns an annotation xml with a geolocation grid point at the first and last line of every burst """
+    bursts = ''.join('<burst><azimuthTime/></burst>' for x in range(NUMBER_OF_BURSTS))
+    points = ''
+    for line in range(0, NUMBER_OF_BURSTS * LINES_PER_BURST + 1, LINES_PER_BURST):
+        for longitude in [0.2, 0.8]:
+            points += '<geolocationGridPoint><line>{0}</line><latitude>{1}</latitude><longitude>{2}</longitude>' \
+                      '</geolocationGridPoint>'.format(line, line / LINES_PER_BURST, longitude)
+    return ('<product><swathTiming><linesPerBurst>{0}</linesPerBurst><burstList count="{1}">{2}</burstList>'
+            '</swathTiming><geolocationGrid><geolocationGridPointList>{3}</geolocationGridPointList>'
+            '</geolocationGrid></product>').format(LINES_PER_BURST, NUMBER_OF_BURSTS, bursts, points).encode()
+
+
+def create_zip(measurement_compression=zipfile.ZIP_STORED):
+    """ returns a Sentinel-1 like SLC zip with one measurement tiff """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        zf.writestr(MANIFEST, b'<manifest/>', compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr(ANNOTATION, create_annotation(), compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr(MEASUREMENT, create_tiff(NUMBER_OF_BURSTS * LINES_PER_BURST, LINE_SIZE),
+                    compress_type=measurement_compression)
+    return buffer.getvalue()
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """ serves the files of the server (path -> bytes) with HEAD and single range GET requests """
+
+    def do_HEAD(self):
+        self.send_file(send_body=False)
+
+    def do_GET(self):
+        self.send_file(send_body=True)
+
+    def send_file(self, send_body):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(data)
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            start, end = int(first), min(int(last) + 1, len(data))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start if send_body else len(data)))
+        self.end_headers()
+        if send_body:
+            # counted before sending: the client may check the count as soon as it received the data
+            with self.server.lock:
+                self.server.sent_bytes += end - start
+            self.wfile.write(data[start:end])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestBurstDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.files = {'/stored.zip': create_zip(), '/deflated.zip': create_zip(zipfile.ZIP_DEFLATED)}
+        self.server.sent_bytes = 0
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def get_url(self, name):
+        return 'http://127.0.0.1:{0}/{1}'.format(self.server.server_address[1], name)
+
+    def test_get_burst_lines(self):
+        lines = burst_download.get_burst_lines(create_annotation(), BOUNDING_BOX)
+        margin = burst_download.BURST_MARGIN
+        self.assertEqual(lines, ((2 - margin) * LINES_PER_BURST, (3 + margin) * LINES_PER_BURST))
+        self.assertIsNone(burst_download.get_burst_lines(create_annotation(), [10.0, 11.0, 0.0, 1.0]))
+
+    def test_get_tiff_line_ranges(self):
+        tiff = create_tiff(NUMBER_OF_BURSTS * LINES_PER_BURST, LINE_SIZE)
+        ranges = burst_download.get_tiff_line_ranges(io.BytesIO(tiff), 0, 10, 20)
+        self.assertEqual(len(ranges), 1)
+        start, end = ranges[0]
+        self.assertEqual(end - start, 10 * LINE_SIZE)
+        self.assertEqual(tiff[start:end], b''.join(bytes([x]) * LINE_SIZE for x in range(10, 20)))
+
+    def test_download_bursts(self):
+        data = self.server.files['/stored.zip']
+        download_file = os.path.join(self.work_dir, 'stored.zip')
+        fetched_bytes, file_size = burst_download.download_bursts(self.session, self.get_url('stored.zip'),
+                                                                  download_file, BOUNDING_BOX)
+        self.assertEqual(file_size, len(data))
+        self.assertLess(fetched_bytes, len(data) / 2)
+        self.assertEqual(self.server.sent_bytes, fetched_bytes)
+
+        # the local zip has the layout of the remote zip: the metadata and the lines of the bursts are readable
+        lines = burst_download.get_burst_lines(create_annotation(), BOUNDING_BOX)
+        with zipfile.ZipFile(download_file) as zf:
+            self.assertEqual(zf.read(ANNOTATION), create_annotation())
+            with zf.open(MEASUREMENT) as f:
+                start, end = burst_download.get_tiff_line_ranges(f, 0, lines[0], lines[1])[0]
+                f.seek(start)
+                self.assertEqual(f.read(end - start), b''.join(bytes([x]) * LINE_SIZE for x in range(*lines)))
+                # the lines after the bursts were not fetched (the last line is not read: zipfile checks the CRC)
+                f.seek(end + (NUMBER_OF_BURSTS * LINES_PER_BURST - lines[1] - 2) * LINE_SIZE)
+                self.assertEqual(f.read(LINE_SIZE), bytes(LINE_SIZE))
+
+        # the same bounding box is not fetched again
+        self.assertEqual(burst_download.download_bursts(self.session, self.get_url('stored.zip'), download_file,
+                                                        BOUNDING_BOX), (0, len(data)))
+
+    def test_download_bursts_of_compressed_measurement(self):
+        download_file = os.path.join(self.work_dir, 'deflated.zip')
+        with self.assertRaises(burst_download.BurstDownloadError):
+            burst_download.download_bursts(self.session, self.get_url('deflated.zip'), download_file, BOUNDING_BOX)
+        # the metadata fetched so far is recorded, so that the complete download resumes it
+        self.assertIsNotNone(burst_download.read_burst_record(download_file))
+
+    def test_complete_download_of_compressed_measurement(self):
+        # bulk_downloader without the command line and the ASF cookie
+        downloader = bulk_downloader.__new__(bulk_downloader)
+        downloader.num_ranges = 1
+        downloader.max_concurrent_downloads = 1
+        downloader.stall_window = 60
+        downloader.slc_cache = None
+        downloader.bounding_box = BOUNDING_BOX
+        downloader.streams = {}
+        downloader.streams_lock = threading.Lock()
+
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        try:
+            downloader.download_file_with_session(self.session, self.get_url('deflated.zip'), 1, 1)
+        finally:
+            os.chdir(cwd)
+
+        download_file = os.path.join(self.work_dir, 'deflated.zip')
+        with open(download_file, 'rb') as f:
+            self.assertEqual(f.read(), self.server.files['/deflated.zip'])
+        self.assertTrue(check_download.is_verified(download_file))
+        self.assertIsNone(burst_download.read_burst_record(download_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
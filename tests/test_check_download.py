@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+## Tests of the zip checks of check_download with small zips built with zipfile
+
+import io
+import os
+import json
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+from contextlib import redirect_stdout
+from minsar.utils import check_download
+
+
+def write_zip(file, members=None):
+    """ writes a zip with a stored and a deflated member """
+    if members is None:
+        members = {'a.SAFE/manifest.safe': b'<manifest/>' * 100, 'a.SAFE/measurement/s1.tiff': bytes(range(256)) * 400}
+    with zipfile.ZipFile(file, 'w') as zf:
+        for i, (name, data) in enumerate(sorted(members.items())):
+            zf.writestr(name, data, compress_type=zipfile.ZIP_STORED if i % 2 else zipfile.ZIP_DEFLATED)
+    return file
+
+
+class TestCheckDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def get_file(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def test_valid(self):
+        file = write_zip(self.get_file('valid.zip'))
+        self.assertIsNone(check_download.get_zip_error(file))
+        self.assertTrue(check_download.check_end_of_central_directory(file))
+        results = check_download.check_zipfiles([file], deep=True)
+        self.assertEqual(results, [{'file': file, 'size': os.path.getsize(file), 'valid': True, 'reason': None}])
+
+    def test_truncated(self):
+        file = write_zip(self.get_file('truncated.zip'))
+        size = os.path.getsize(file)
+        for truncated_size in [size - 1, size - check_download.EOCD_SIZE - 10, size // 2, 10, 0]:
+            with open(file, 'r+b') as f:
+                f.truncate(truncated_size)
+            with self.subTest(size=truncated_size):
+                self.assertIsNotNone(check_download.get_zip_error(file))
+
+    def test_corrupted_end_of_central_directory(self):
+        file = write_zip(self.get_file('corrupted.zip'))
+        with open(file, 'rb') as f:
+            data = f.read()
+        eocd = data.rfind(check_download.EOCD_SIGNATURE)
+        entries, cd_size, cd_offset = struct.unpack('<HLL', data[eocd + 10:eocd + 20])
+
+        # field of the end of central directory record, start and end of the field
+        cases = [('central directory offset', struct.pack('<L', cd_offset + 1), eocd + 16, eocd + 20),
+                 ('central directory size', struct.pack('<L', cd_size - 1), eocd + 12, eocd + 16),
+                 ('number of entries', struct.pack('<H', entries + 1), eocd + 10, eocd + 12),
+                 ('signature', b'PK\x00\x00', eocd, eocd + 4)]
+        for name, value, start, end in cases:
+            with open(file, 'wb') as f:
+                f.write(data[:start] + value + data[end:])
+            with self.subTest(field=name):
+                self.assertIsNotNone(check_download.get_zip_error(file))
+
+        # a corrupted central directory entry
+        with open(file, 'wb') as f:
+            f.write(data[:cd_offset] + b'XX' + data[cd_offset + 2:])
+        self.assertEqual(check_download.get_zip_error(file), 'bad central directory entry 1')
+
+    def test_corrupted_member_data(self):
+        # the structure is good, only the CRC check of --deep finds the error
+        file = write_zip(self.get_file('crc.zip'))
+        with zipfile.ZipFile(file) as zf:
+            info = zf.getinfo('a.SAFE/measurement/s1.tiff')
+        with open(file, 'r+b') as f:
+            f.seek(info.header_offset + 30 + len(info.filename) + 1000)
+            f.write(b'\xff\xfe')
+        self.assertIsNone(check_download.get_zip_error(file))
+        result = check_download.check_zipfiles([file], deep=True)[0]
+        self.assertFalse(result['valid'])
+        self.assertIn('CRC error', result['reason'])
+
+    def test_json_output(self):
+        valid_file = write_zip(self.get_file('S1A_valid.zip'))
+        bad_file = write_zip(self.get_file('S1A_bad.zip'))
+        with open(bad_file, 'r+b') as f:
+            f.truncate(os.path.getsize(bad_file) - 5)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            bad_files = check_download.main([self.work_dir, '--json'])
+        report = json.loads(output.getvalue())
+
+        self.assertEqual(bad_files, ['S1A_bad.zip'])
+        self.assertEqual(report['number_of_files'], 2)
+        self.assertEqual(report['number_of_bad_files'], 1)
+        self.assertFalse(report['deep'])
+        results = {x['file']: x for x in report['results']}
+        self.assertTrue(results['S1A_valid.zip']['valid'])
+        self.assertFalse(results['S1A_bad.zip']['valid'])
+        self.assertTrue(results['S1A_bad.zip']['reason'])
+        # good files are recorded as verified and not checked again
+        self.assertTrue(check_download.is_verified(valid_file))
+        self.assertFalse(check_download.is_verified(bad_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+## Tests of the task packing and of the scheduler output parsers of job_submission
+
+import unittest
+import pytest
+
+# process_utilities (imported by job_submission) requires ISCE
+pytest.importorskip('isceobj')
+from minsar import job_submission
+
+
+class TestPlanTaskPacking(unittest.TestCase):
+
+    def check_plan(self, task_walltimes, number_of_slots_per_node, max_jobs_per_queue, stack_tasks=True):
+        """ returns the plan after checking that every task is in exactly one job """
+        plan = job_submission.plan_task_packing(task_walltimes, number_of_slots_per_node, max_jobs_per_queue,
+                                                stack_tasks=stack_tasks)
+        number_of_nodes_per_job, job_task_indices, job_walltimes = plan
+        self.assertEqual(sorted(i for job in job_task_indices for i in job), list(range(len(task_walltimes))))
+        self.assertEqual(len(job_task_indices), len(job_walltimes))
+        self.assertLessEqual(len(job_task_indices), max_jobs_per_queue)
+        return plan
+
+    def test_short_tasks_share_slots(self):
+        # the short tasks run one after another in the slot next to the long task
+        number_of_nodes_per_job, job_task_indices, job_walltimes = self.check_plan([100] + [1] * 12, 2, 5)
+        self.assertEqual(number_of_nodes_per_job, 1)
+        self.assertEqual(job_task_indices, [[0] + list(range(1, 13))])
+        self.assertEqual(job_walltimes, [100])
+
+    def test_slot_cap_without_launcher(self):
+        # tasks started at once: at most number_of_slots_per_node tasks per node
+        number_of_slots_per_node = 2
+        number_of_nodes_per_job, job_task_indices, job_walltimes = self.check_plan(
+            [100] + [1] * 12, number_of_slots_per_node, 5, stack_tasks=False)
+        for task_indices in job_task_indices:
+            self.assertLessEqual(len(task_indices), number_of_slots_per_node * number_of_nodes_per_job)
+        self.assertEqual(job_walltimes[0], 100)
+        self.assertEqual(max(job_walltimes[1:]), 1)
+
+    def test_unknown_walltimes(self):
+        # all tasks cost the same: one task per slot and jobs with zero walltime (the default walltime is used)
+        number_of_nodes_per_job, job_task_indices, job_walltimes = self.check_plan([0] * 10, 4, 10)
+        self.assertEqual(number_of_nodes_per_job, 1)
+        self.assertEqual([len(x) for x in job_task_indices], [4, 3, 3])
+        self.assertEqual(job_walltimes, [0, 0, 0])
+
+    def test_max_jobs_per_queue(self):
+        # 40 slots needed with 4 slots per node and at most 3 jobs: 10 nodes in 3 jobs of 4 nodes
+        number_of_nodes_per_job, job_task_indices, job_walltimes = self.check_plan([60] * 40, 4, 3)
+        self.assertEqual(number_of_nodes_per_job, 4)
+        self.assertEqual(len(job_task_indices), 3)
+        for task_indices in job_task_indices:
+            self.assertLessEqual(len(task_indices), 4 * number_of_nodes_per_job)
+        self.assertEqual(job_walltimes, [60, 60, 60])
+
+    def test_single_job_longer_than_makespan(self):
+        # more tasks than slots of max_jobs_per_queue jobs are never needed: the nodes per job grow instead
+        number_of_nodes_per_job, job_task_indices, job_walltimes = self.check_plan([10] * 100, 1, 1)
+        self.assertEqual(number_of_nodes_per_job, 100)
+        self.assertEqual(job_walltimes, [10])
+
+
+# captured scheduler output (job numbers shortened), as called by query_job_states
+SACCT_OUTPUT = """1001|COMPLETED
+1002|TIMEOUT
+1003|CANCELLED by 5000
+1004|FAILED
+1005|PENDING
+1006_1|COMPLETED
+1006_2|RUNNING
+1006_[3-4]|PENDING
+1007_1|COMPLETED
+1007_2|TIMEOUT
+1008_1|COMPLETED
+1008_2|OUT_OF_MEMORY
+"""
+
+BJOBS_OUTPUT = """1001|DONE|-
+1002|EXIT|140
+1003|EXIT|1
+1004|PEND|-
+1005|RUN|-
+1006[1]|DONE|-
+1006[2]|EXIT|140
+1007[1]|DONE|-
+1007[2]|RUN|-
+"""
+
+QSTAT_OUTPUT = """Job Id: 1001.pbs01
+    Job_Name = unwrap_0
+    job_state = F
+    Exit_status = 0
+
+Job Id: 1002.pbs01
+    Job_Name = unwrap_1
+    job_state = F
+    Exit_status = -29
+
+Job Id: 1003.pbs01
+    Job_Name = unwrap_2
+    job_state = F
+    Exit_status = 271
+
+Job Id: 1004.pbs01
+    Job_Name = unwrap_3
+    job_state = F
+
+Job Id: 1005.pbs01
+    Job_Name = unwrap_4
+    job_state = Q
+
+Job Id: 1006[].pbs01
+    Job_Name = resample
+    job_state = F
+
+Job Id: 1006[1].pbs01
+    Job_Name = resample
+    job_state = F
+    Exit_status = 0
+
+Job Id: 1006[2].pbs01
+    Job_Name = resample
+    job_state = F
+    Exit_status = -29
+
+Job Id: 1007[].pbs01
+    Job_Name = merge
+    job_state = B
+
+Job Id: 1007[1].pbs01
+    Job_Name = merge
+    job_state = F
+    Exit_status = 0
+
+Job Id: 1007[2].pbs01
+    Job_Name = merge
+    job_state = R
+"""
+
+JOB_STATES_CASES = [
+    ('SLURM', SACCT_OUTPUT, {'1001': 'COMPLETED', '1002': 'TIMEOUT', '1003': 'FAILED', '1004': 'FAILED',
+                             '1005': 'PENDING', '1006': 'RUNNING', '1007': 'TIMEOUT', '1008': 'FAILED'}),
+    ('LSF', BJOBS_OUTPUT, {'1001': 'COMPLETED', '1002': 'TIMEOUT', '1003': 'FAILED', '1004': 'PENDING',
+                           '1005': 'RUNNING', '1006': 'TIMEOUT', '1007': 'RUNNING'}),
+    ('PBS', QSTAT_OUTPUT, {'1001': 'COMPLETED', '1002': 'TIMEOUT', '1003': 'FAILED', '1004': 'FAILED',
+                           '1005': 'PENDING', '1006': 'TIMEOUT', '1007': 'RUNNING'}),
+    ('SLURM', '', {}),
+    ('LSF', 'Job <1009> is not found\n', {}),
+]
+
+
+class TestParseJobStates(unittest.TestCase):
+
+    def test_parse_job_states(self):
+        for scheduler, output, expected in JOB_STATES_CASES:
+            with self.subTest(scheduler=scheduler, output=output[:20]):
+                self.assertEqual(job_submission.parse_job_states(output, scheduler), expected)
+
+    def test_parse_pbs_job_states(self):
+        # array elements are listed separately, the array job itself is COMPLETED without Exit_status
+        job_states = job_submission.parse_pbs_job_states(QSTAT_OUTPUT)
+        self.assertIn(('1006', 'COMPLETED'), job_states)
+        self.assertIn(('1006', 'TIMEOUT'), job_states)
+        self.assertEqual(len(job_states), 11)
+
+    def test_get_pbs_job_ids(self):
+        self.assertEqual(job_submission.get_pbs_job_ids(['1001', '1002']), ['1001', '1002'])
+        self.assertEqual(job_submission.get_pbs_job_ids(['1001', '1002'], array_jobs={'1002'}),
+                         ['-t', '1001', '1002[]'])
+
+
+if __name__ == '__main__':
+    unittest.main()
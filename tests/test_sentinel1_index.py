@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+## Tests of the orbit and aux file interval index of additions/Sentinel1.py with a synthetic orbit directory
+
+import os
+import datetime
+import shutil
+import tempfile
+import importlib.util
+import unittest
+import pytest
+
+# Sentinel1.py replaces isceobj/Sensor/TOPS/Sentinel1.py of ISCE and imports its neighbours
+pytest.importorskip('isceobj.Sensor.TOPS')
+SENTINEL1_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'minsar', 'additions',
+                              'Sentinel1.py')
+spec = importlib.util.spec_from_file_location('isceobj.Sensor.TOPS.minsar_Sentinel1', SENTINEL1_FILE)
+Sentinel1 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(Sentinel1)
+
+DATE_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def get_orbit_name(orbit_type, start, end, mission='S1A'):
+    """ returns the name of an orbit file valid from start to end """
+    return '{0}_OPER_AUX_{1}_OPOD_{2}_V{3}_{4}.EOF'.format(mission, orbit_type, end.strftime(DATE_FORMAT),
+                                                          start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+
+
+def to_epoch(time_stamp):
+    return int(Sentinel1.s1_toEpoch(time_stamp))
+
+
+class TestFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.orbit_dir = tempfile.mkdtemp()
+        # daily precise orbits valid for 26 hours (overlapping by 2 hours) and restituted orbits of 3 hours
+        start = datetime.datetime(2020, 1, 1, 22, 59, 42)
+        self.files = []
+        for day in range(10):
+            self.add_file(get_orbit_name('POEORB', start + datetime.timedelta(days=day),
+                                         start + datetime.timedelta(days=day, hours=26)))
+        for hour in range(0, 48, 2):
+            self.add_file(get_orbit_name('RESORB', start + datetime.timedelta(hours=hour),
+                                         start + datetime.timedelta(hours=hour + 3)))
+        # a precise orbit with a long validity interval overlapping the daily ones
+        self.add_file(get_orbit_name('POEORB', start - datetime.timedelta(days=2),
+                                     start + datetime.timedelta(days=4)))
+        self.add_file('S1B_OPER_AUX_POEORB_OPOD_20200110T120000.txt')
+        Sentinel1._s1_fileIndices.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.orbit_dir)
+        Sentinel1._s1_fileIndices.clear()
+
+    def add_file(self, name):
+        open(os.path.join(self.orbit_dir, name), 'w').close()
+        self.files.append(name)
+
+    def find_linear(self, key, tstart, tstop):
+        """ the files valid from tstart to tstop found by parsing every file name """
+        match = []
+        for name in self.files:
+            entry = Sentinel1.s1_parseFileName(name)
+            if entry is not None and entry[0] == key and entry[1] <= tstart and entry[2] >= tstop:
+                match.append(name)
+        return sorted(match)
+
+    def find_indexed(self, key, tstart, tstop):
+        intervals = Sentinel1.s1_getFileIndex(self.orbit_dir).get(key)
+        return sorted(name for name, tbef, taft in Sentinel1.s1_findIntervals(intervals, tstart, tstop))
+
+    def test_parse_file_name(self):
+        start = datetime.datetime(2020, 1, 1, 22, 59, 42)
+        end = datetime.datetime(2020, 1, 3, 0, 59, 42)
+        self.assertEqual(Sentinel1.s1_parseFileName(get_orbit_name('POEORB', start, end)),
+                         ['S1A_POEORB', to_epoch(start), to_epoch(end)])
+        self.assertEqual(Sentinel1.s1_parseFileName('S1B_AUX_CAL_V20190228T092500_G20190227T161813.SAFE'),
+                         ['S1B_AUX_CAL', to_epoch(datetime.datetime(2019, 2, 28, 9, 25)),
+                          to_epoch(datetime.datetime(2019, 2, 27, 16, 18, 13))])
+        self.assertIsNone(Sentinel1.s1_parseFileName('S1A_OPER_AUX_POEORB_OPOD_bad.EOF'))
+        self.assertIsNone(Sentinel1.s1_parseFileName('.s1_index'))
+
+    def test_boundaries(self):
+        name = self.files[3]
+        key, tbef, taft = Sentinel1.s1_parseFileName(name)
+        self.assertIn(name, self.find_indexed(key, tbef, tbef))
+        self.assertIn(name, self.find_indexed(key, taft, taft))
+        self.assertIn(name, self.find_indexed(key, tbef, taft))
+        self.assertNotIn(name, self.find_indexed(key, tbef - 1, taft))
+        self.assertNotIn(name, self.find_indexed(key, tbef, taft + 1))
+
+    def test_overlapping_intervals(self):
+        # the index finds the same files as checking every file, including the long interval starting much earlier
+        boundaries = sorted(set(x for name in self.files if Sentinel1.s1_parseFileName(name)
+                                for x in Sentinel1.s1_parseFileName(name)[1:]))
+        times = sorted(set(boundaries + [x + d for x in boundaries for d in (-1, 1)] +
+                           [(x + y) // 2 for x, y in zip(boundaries[:-1], boundaries[1:])]))
+        for key in ['S1A_POEORB', 'S1A_RESORB', 'S1B_POEORB']:
+            for tstart in times:
+                for duration in [0, 30, 3600]:
+                    self.assertEqual(self.find_indexed(key, tstart, tstart + duration),
+                                     self.find_linear(key, tstart, tstart + duration))
+
+    def test_find_orbit_file(self):
+        # the precise orbit whose middle is closest to the acquisition
+        start = datetime.datetime(2020, 1, 5, 12, 0, 0)
+        orbit_file = Sentinel1.s1_findOrbitFile(self.orbit_dir, start, start + datetime.timedelta(seconds=30))
+        self.assertEqual(os.path.basename(orbit_file),
+                         get_orbit_name('POEORB', datetime.datetime(2020, 1, 4, 22, 59, 42),
+                                        datetime.datetime(2020, 1, 6, 0, 59, 42)))
+        with self.assertRaises(Exception):
+            Sentinel1.s1_findOrbitFile(self.orbit_dir, datetime.datetime(2021, 1, 1),
+                                       datetime.datetime(2021, 1, 1, 0, 0, 30))
+
+    def test_index_file(self):
+        Sentinel1.s1_getFileIndex(self.orbit_dir)
+        index = Sentinel1.s1_readFileIndex(self.orbit_dir)
+        self.assertEqual(index['version'], Sentinel1.S1_INDEX_VERSION)
+        self.assertEqual(len(index['files']), len(self.files) - 1)
+
+        # a new file changes the directory and is added to the index
+        start = datetime.datetime(2021, 1, 1)
+        self.add_file(get_orbit_name('POEORB', start, start + datetime.timedelta(hours=26)))
+        self.assertEqual(self.find_indexed('S1A_POEORB', to_epoch(start) + 60, to_epoch(start) + 90),
+                         [self.files[-1]])
+        self.assertEqual(len(Sentinel1.s1_readFileIndex(self.orbit_dir)['files']), len(self.files) - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()